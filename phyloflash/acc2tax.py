@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# import
+## batteries
+import os
+from array import array
+## package
+from phyloflash.seqstore import (SeqStore, write_section, write_footer,
+                                 map_sections, split_header)
+from phyloflash.fasta import read_fasta
+
+# Index file layout: accessions sorted bytewise and concatenated, their
+# offsets, the taxonomy ID of each accession, the interned taxonomy
+# strings and their offsets, followed by a footer (see seqstore.map_sections)
+MAGIC = b'PFACC2TX'
+SECTIONS = ('accs', 'acc_offsets', 'tax_ids', 'taxa', 'tax_offsets')
+
+
+def write_acc2tax(records, out_file: str) -> str:
+    """
+    Write an accession -> taxonomy string index.
+    records: iterable of (accession, taxonomy) tuples of bytes; or a SeqStore
+    out_file: str, output file path
+    Return: str, output file path
+    """
+    if isinstance(records, SeqStore):
+        store = records
+        taxa = [store.taxon(i) for i in range(store.n_taxa())]
+        pairs = [(store.acc(i), store.tax_ids[i]) for i in range(len(store))]
+    else:
+        tax_index = {}
+        pairs = [(acc, tax_index.setdefault(tax, len(tax_index))) for acc,tax in records]
+        taxa = sorted(tax_index, key=tax_index.get)
+    pairs.sort()
+    # accession and taxonomy tables
+    accs = b''.join(x[0] for x in pairs)
+    acc_offsets = array('Q', [0])
+    for acc,_ in pairs:
+        acc_offsets.append(acc_offsets[-1] + len(acc))
+    tax_ids = array('I', (x[1] for x in pairs))
+    tax_offsets = array('Q', [0])
+    for tax in taxa:
+        tax_offsets.append(tax_offsets[-1] + len(tax))
+    data = {
+        'accs' : accs,
+        'acc_offsets' : acc_offsets,
+        'tax_ids' : tax_ids,
+        'taxa' : b''.join(taxa),
+        'tax_offsets' : tax_offsets
+    }
+    tmp_file = out_file + '.tmp'
+    with open(tmp_file, 'wb') as outF:
+        positions = []
+        for name in SECTIONS:
+            positions += write_section(outF, data[name])
+        write_footer(outF, MAGIC, SECTIONS, len(pairs), positions)
+    os.replace(tmp_file, out_file)
+    return out_file
+
+def acc2tax_from_fasta(fasta_file: str, out_file: str) -> str:
+    """
+    Write an accession -> taxonomy string index from SILVA fasta headers
+    """
+    records = (split_header(header) for header,_ in read_fasta(fasta_file))
+    return write_acc2tax(records, out_file)
+
+
+class Acc2Tax(object):
+    """
+    Read-only accession -> taxonomy string lookup on a memory-mapped index.
+    Lookups are binary searches over the sorted accession table, so opening
+    the index does not depend on its size and only the touched pages are read;
+    concurrent processes share the mapped pages through the page cache.
+    index_file: str, index written by write_acc2tax
+    """
+    def __init__(self, index_file: str):
+        self._mm,self.n_records,buffers = map_sections(index_file, MAGIC, SECTIONS)
+        self.accs = buffers['accs']
+        self.acc_offsets = buffers['acc_offsets'].cast('Q')
+        self.tax_ids = buffers['tax_ids'].cast('I')
+        self.taxa = buffers['taxa']
+        self.tax_offsets = buffers['tax_offsets'].cast('Q')
+        self._taxa_cache = {}
+
+    def close(self) -> None:
+        if self._mm is not None:
+            for x in (self.accs, self.acc_offsets, self.tax_ids, self.taxa, self.tax_offsets):
+                x.release()
+            self._mm.close()
+            self._mm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def __len__(self):
+        return self.n_records
+
+    def _acc(self, i: int) -> bytes:
+        return self.accs[self.acc_offsets[i] : self.acc_offsets[i + 1]].tobytes()
+
+    def _find(self, acc: bytes) -> int:
+        # binary search over the sorted accessions
+        lo,hi = 0,self.n_records
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._acc(mid) < acc:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.n_records and self._acc(lo) == acc:
+            return lo
+        return -1
+
+    def taxon(self, tax_id: int) -> str:
+        """
+        Taxonomy string with ID tax_id (decoded strings are cached)
+        """
+        try:
+            return self._taxa_cache[tax_id]
+        except KeyError:
+            tax = self.taxa[self.tax_offsets[tax_id] : self.tax_offsets[tax_id + 1]].tobytes().decode()
+            self._taxa_cache[tax_id] = tax
+            return tax
+
+    def get(self, acc, default=None):
+        """
+        Taxonomy string of an accession, or `default` if it is not in the index
+        """
+        if isinstance(acc, str):
+            acc = acc.encode()
+        i = self._find(acc)
+        if i < 0:
+            return default
+        return self.taxon(self.tax_ids[i])
+
+    def __getitem__(self, acc) -> str:
+        tax = self.get(acc)
+        if tax is None:
+            raise KeyError(acc)
+        return tax
+
+    def __contains__(self, acc) -> bool:
+        if isinstance(acc, str):
+            acc = acc.encode()
+        return self._find(acc) >= 0
+
+    def items(self):
+        """
+        Iterate over (accession, taxonomy string) in accession order
+        """
+        for i in range(self.n_records):
+            yield self._acc(i).decode(), self.taxon(self.tax_ids[i])
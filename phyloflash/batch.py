@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# import
+## batteries
+import os
+import csv
+import copy
+import logging
+## package
+from phyloflash import core
+from phyloflash.scheduler import run_stages
+from phyloflash.checkpoint import Checkpoints
+from phyloflash.runner import set_timeout
+from phyloflash.profiling import start_profile, write_profile
+
+# manifest columns; lib and read1 are required
+MANIFEST_COLUMNS = ['lib', 'read1', 'read2', 'interleaved', 'read_length']
+# per-sample stages, in pipeline order
+SAMPLE_STAGES = ['reads', 'map', 'classify', 'assemble']
+TRUE_VALUES = ('1', 'true', 't', 'yes', 'y')
+
+
+def read_manifest(manifest_file: str) -> list:
+    """
+    Read a tab-separated sample manifest with a header line. Columns:
+    lib (library name), read1, read2 (optional), interleaved (optional, true/false),
+    read_length (optional). Relative read paths are relative to the manifest.
+    Lines starting with "#" are ignored.
+    Return: list of dicts, one per sample
+    """
+    base_dir = os.path.dirname(os.path.abspath(manifest_file))
+    with open(manifest_file, newline='') as inF:
+        lines = [x for x in inF if x.strip() and not x.startswith('#')]
+    reader = csv.DictReader(lines, delimiter='\t')
+    missing = {'lib', 'read1'} - set(reader.fieldnames or [])
+    if missing:
+        raise ValueError(f'Manifest {manifest_file} lacks the column(s): {", ".join(sorted(missing))}')
+    samples = []
+    libs = set()
+    for i,row in enumerate(reader, 2):
+        sample = {k : (row.get(k) or '').strip() or None for k in MANIFEST_COLUMNS}
+        if sample['lib'] is None or sample['read1'] is None:
+            raise ValueError(f'Manifest {manifest_file}, line {i}: lib and read1 are required')
+        if sample['lib'] in libs:
+            raise ValueError(f'Manifest {manifest_file}: duplicate library name "{sample["lib"]}"')
+        libs.add(sample['lib'])
+        for k in ('read1', 'read2'):
+            if sample[k] is not None:
+                sample[k] = os.path.join(base_dir, sample[k])
+                if not os.path.isfile(sample[k]):
+                    raise ValueError(f'Manifest {manifest_file}, line {i}: file not found: {sample[k]}')
+        sample['interleaved'] = (sample['interleaved'] or '').lower() in TRUE_VALUES
+        if sample['read_length'] is not None:
+            sample['read_length'] = int(sample['read_length'])
+        samples.append(sample)
+    return samples
+
+def sample_args(args, sample: dict):
+    """
+    Arguments of one sample: the batch arguments with the sample's
+    reads, and output files under <outdir>/<lib>/
+    """
+    sargs = copy.copy(args)
+    sargs.lib = os.path.join(args.outdir, sample['lib'], sample['lib'])
+    sargs.read1 = sample['read1']
+    sargs.read2 = sample['read2']
+    sargs.interleaved = sample['interleaved']
+    if sample['read_length'] is not None:
+        sargs.read_length = sample['read_length']
+    return sargs
+
+def batch_stages(args, samples: list) -> list:
+    """
+    Stages of all samples, named <lib>:<stage>, with fixed per-stage budgets
+    """
+    budgets = {'map' : (args.map_threads, args.map_memory),
+               'assemble' : (args.assembly_threads, args.assembly_memory)}
+    stages = []
+    for sample in samples:
+        stages += core.sample_stages(sample_args(args, sample), prefix=f'{sample["lib"]}:',
+                                     budgets=budgets)
+    return stages
+
+def write_status(samples: list, status: dict, out_file: str) -> str:
+    """
+    Write the per-sample status table: overall status, the status of each
+    stage, the total stage run time and the first error
+    """
+    with open(out_file, 'w', newline='') as outF:
+        writer = csv.writer(outF, delimiter='\t', lineterminator='\n')
+        writer.writerow(['lib', 'status'] + SAMPLE_STAGES + ['seconds', 'error'])
+        for sample in samples:
+            stages = [status[f'{sample["lib"]}:{x}'] for x in SAMPLE_STAGES]
+            states = [x['status'] for x in stages]
+            if 'failed' in states:
+                overall = 'failed'
+            elif all(x in ('done', 'cached') for x in states):
+                overall = 'done'
+            else:
+                overall = 'incomplete'
+            error = next((x['error'] for x in stages if x['error']), '')
+            seconds = sum(x['seconds'] for x in stages)
+            writer.writerow([sample['lib'], overall] + states +
+                            [f'{seconds:.1f}', ' '.join(error.split())])
+    return out_file
+
+def run_samples(args, samples: list) -> dict:
+    """
+    Run the pipeline on several samples (see read_manifest for the sample
+    dicts) and write the status table
+    Return: dict, status of each stage (see scheduler.run_stages)
+    """
+    # environment and database are checked once for all samples
+    core.check_environment(args)
+    os.makedirs(args.outdir, exist_ok=True)
+    set_timeout(args.timeout * 60 if args.timeout else None)
+
+    # run the stages of all samples on one worker pool; a failing sample
+    # only stops its own remaining stages, and stages unchanged since a
+    # previous run of the batch are skipped
+    status = {}
+    checkpoints = Checkpoints(os.path.join(args.outdir, 'checkpoints'), resume=not args.force)
+    profile = start_profile()
+    try:
+        run_stages(batch_stages(args, samples), threads=args.threads, memory=args.memory,
+                   checkpoints=checkpoints, keep_going=True, status=status)
+    finally:
+        write_profile(profile, os.path.join(args.outdir, 'batch_profile'))
+
+    # status table
+    status_file = args.status_file or os.path.join(args.outdir, 'batch_status.tsv')
+    write_status(samples, status, status_file)
+    n_failed = sum(1 for x in status.values() if x['status'] == 'failed')
+    logging.info(f'Finished {len(samples)} samples ({n_failed} failed stages); status table: {status_file}')
+    return status
+
+def main(args):
+    # samples
+    samples = read_manifest(args.manifest)
+    logging.info(f'Read {len(samples)} samples from {args.manifest}')
+    if not samples:
+        return
+    run_samples(args, samples)
@@ -0,0 +1,796 @@
+#!/usr/bin/env python
+# import
+## batteries
+import gc
+import os
+import sys
+import json
+import gzip
+import time
+import random
+import shutil
+import logging
+import platform
+import resource
+import tempfile
+import statistics
+import contextlib
+## package
+from phyloflash import make_db, batch, core, fastq, compare, prefilter
+from phyloflash.fasta import read_fasta, split_fasta, accession
+from phyloflash.sam import process_bbmap_sam
+from phyloflash.taxonomy import TaxonomyTrie
+from phyloflash.runner import stream, CommandError
+
+# benchmark cases, in the order they are run (see Workload)
+CASES = ('silva_uncompress', 'fasta_normalize', 'remove_lsu', 'acc2tax', 'split_fasta',
+         'taxonomy_trie', 'sam_process', 'fastq_stats', 'prefilter_index', 'prefilter', 'compare',
+         'make_db', 'run_batch')
+DOMAINS = [(b'Bacteria', 0.7), (b'Archaea', 0.1), (b'Eukaryota', 0.2)]
+RANK_NAMES = [b'Phylum', b'Class', b'Order', b'Family', b'Genus']
+IUPAC = b'RYMKWSBDHVN'
+COMPLEMENT = bytes.maketrans(b'ACGTN', b'TGCAN')
+# stand-in executables, linked to one script (see STAND_IN)
+STAND_IN_TOOLS = ['bbmap.sh', 'bbmask.sh', 'bbduk.sh', 'vsearch', 'barrnap_HGV', 'indexdb_rna',
+                  'spades.py', 'reformat.sh', 'mafft', 'fastaFromBed']
+# mapping rate of the stand-in bbmap (reads per second and thread) in the
+# prefilter case, about that of bbmap fast=t on the SILVA database
+STAND_IN_MAP_RATE = 20000
+
+# Stand-in for the external tools: produces outputs of the right shape with
+# minimal work, so that only the orchestration overhead is measured.
+STAND_IN = r'''
+import os
+import sys
+import time
+import shutil
+
+tool = os.path.basename(sys.argv[0])
+argv = sys.argv[1:]
+kv = dict(x.split('=', 1) for x in argv if '=' in x and not x.startswith('-'))
+
+def opt(name):
+    return argv[argv.index(name) + 1]
+
+def copy(src, dst):
+    inF = sys.stdin.buffer if src.startswith('stdin') else open(src, 'rb')
+    outF = sys.stdout.buffer if dst.startswith('stdout') else open(dst, 'wb')
+    shutil.copyfileobj(inF, outF, 1 << 20)
+    outF.flush()
+
+def touch(path):
+    open(path, 'w').close()
+
+def records(src):
+    inF = sys.stdin.buffer if src.startswith('stdin') else open(src, 'rb')
+    while True:
+        rec = b''.join(inF.readline() for _ in range(4))
+        if not rec:
+            return
+        yield rec
+
+sys.stderr.write(f'{tool} stand-in: {" ".join(argv)}\n')
+if tool == 'barrnap_HGV':
+    # LSU hits for every 50th sequence
+    print('##gff-version 3')
+    with open(argv[-1]) as inF:
+        i = 0
+        for line in inF:
+            if line.startswith('>'):
+                i += 1
+                if i % 50 == 0:
+                    name = line[1:].split()[0]
+                    print(f'{name}\tbarrnap:0.7\trRNA\t1\t100\t1e-20\t+\t.\tName=23S_rRNA;product=23S ribosomal RNA')
+elif tool in ('bbmask.sh', 'bbduk.sh'):
+    copy(kv['in'], kv['out'])
+    if 'stats' in kv:
+        touch(kv['stats'])
+elif tool == 'vsearch':
+    if '--makeudb_usearch' in argv:
+        copy(opt('--makeudb_usearch'), opt('--output'))
+    else:
+        # keep a fraction of the sequences that decreases with the clustering identity
+        keep = 1 - 10 * (1 - float(opt('--id')))
+        with open(opt('--cluster_fast'), 'rb') as inF, open(opt('--centroids'), 'wb') as outF:
+            i,write = 0,True
+            for line in inF:
+                if line.startswith(b'>'):
+                    i += 1
+                    write = (i * 0.6180339887) % 1 < keep
+                if write:
+                    outF.write(line)
+elif tool == 'bbmap.sh':
+    if 'ref' in kv:
+        index_dir = os.path.join(kv.get('path', '.'), 'ref', 'genome', '1')
+        os.makedirs(index_dir, exist_ok=True)
+        touch(os.path.join(index_dir, 'summary.txt'))
+    elif 'PHYLOFLASH_BENCH_MAP_RATE' in os.environ:
+        # map at a fixed rate (reads per second and thread), keeping the SSU reads (ssu<i>)
+        it = records(kv['in'])
+        if 'in2' in kv:
+            pairs = zip(it, records(kv['in2']))
+        elif kv.get('interleaved') == 't':
+            pairs = zip(it, it)
+        else:
+            pairs = ((rec, None) for rec in it)
+        out1 = open(kv['outm'], 'wb')
+        out2 = open(kv['outm2'], 'wb') if 'outm2' in kv else out1
+        n = bases = 0
+        for rec1,rec2 in pairs:
+            for rec in (rec1, rec2):
+                if rec is not None:
+                    n += 1
+                    bases += len(rec.split(b'\n')[1])
+            if rec1.startswith(b'@ssu'):
+                out1.write(rec1)
+                if rec2 is not None:
+                    out2.write(rec2)
+        out1.close()
+        out2.close()
+        for k in ('out', 'bhist', 'ihist', 'idhist', 'scafstats'):
+            touch(kv[k])
+        time.sleep(n / (float(os.environ['PHYLOFLASH_BENCH_MAP_RATE']) * int(kv['threads'])))
+        sys.stderr.write(f'Reads Used:\t{n}\t({bases} bases)\ninsert median:\t300\ninsert std dev:\t50\n')
+    else:
+        shutil.copyfile(os.environ['PHYLOFLASH_BENCH_SAM'], kv['out'])
+        for k in ('outm', 'outm2', 'bhist', 'ihist', 'idhist', 'scafstats'):
+            if k in kv:
+                touch(kv[k])
+        n = int(os.environ['PHYLOFLASH_BENCH_READS']) * 2
+        sys.stderr.write(f'Reads Used:\t{n}\t({n * 150} bases)\ninsert median:\t300\ninsert std dev:\t50\n')
+elif tool == 'indexdb_rna':
+    prefix = opt('--ref').split(',')[1]
+    for ext in ('.bursttrie_0.dat', '.kmer_0.dat', '.pos_0.dat', '.stats'):
+        touch(prefix + ext)
+elif tool == 'spades.py':
+    os.makedirs(opt('-o'), exist_ok=True)
+    touch(os.path.join(opt('-o'), 'scaffolds.fasta'))
+'''
+
+
+def random_taxonomy(rng, branching=4) -> bytes:
+    """
+    SILVA-like taxonomy string of 7 ranks drawn from a tree with `branching`
+    children per node; some paths are shorter, as in SILVA
+    """
+    domain = rng.choices([x for x,_ in DOMAINS], [w for _,w in DOMAINS])[0]
+    path = [domain]
+    code = b''
+    for rank in RANK_NAMES:
+        code += b'%d' % rng.randrange(branching)
+        path.append(rank + b'_' + code)
+    path.append(b'%s sp. %d' % (path[-1], rng.randrange(branching * 4)))
+    if rng.random() < 0.1:
+        path = path[:rng.randint(3, 6)]
+    return b';'.join(path) + b';'
+
+def random_rna(rng, pool: bytes, length: int) -> bytes:
+    """
+    Aligned SILVA-like RNA sequence: a slice of a random base pool with a
+    few alignment gaps, rare IUPAC ambiguity codes, sometimes lowercase
+    """
+    start = rng.randrange(len(pool) - length)
+    seq = bytearray(pool[start:start + length])
+    for _ in range(rng.randrange(3)):
+        seq[rng.randrange(length)] = rng.choice(IUPAC)
+    if rng.random() < 0.2:
+        seq = seq.lower()
+    for _ in range(rng.randrange(4)):
+        i = rng.randrange(length)
+        seq[i:i] = rng.choice((b'.', b'-')) * rng.randint(1, 10)
+    return bytes(seq)
+
+def synthetic_silva(out_file: str, n_seqs=20000, mean_length=1450, seed=1, branching=4) -> str:
+    """
+    Write a SILVA-like FASTA file (gzip-compressed if the name ends in .gz):
+    one line per sequence, headers "<acc>.<start>.<end> <taxonomy>"
+    """
+    rng = random.Random(seed)
+    pool = bytes(rng.choices(b'ACGU', k=1 << 20))
+    opener = gzip.open if out_file.endswith('.gz') else open
+    with opener(out_file, 'wb') as outF:
+        for i in range(n_seqs):
+            length = min(len(pool) // 2, max(900, int(rng.gauss(mean_length, 100))))
+            header = b'AB%06d.1.%d %s' % (i, length, random_taxonomy(rng, branching))
+            outF.write(b'>' + header + b'\n' + random_rna(rng, pool, length) + b'\n')
+    return out_file
+
+def reference_dna(silva_file: str, max_refs=2000) -> list:
+    """
+    Unaligned, uppercase DNA of the first sequences of a SILVA-like FASTA
+    """
+    table = bytes.maketrans(b'acgunU' + IUPAC.lower() + IUPAC, b'ACGTNT' + b'N' * 2 * len(IUPAC))
+    refs = []
+    for _,seq in read_fasta(silva_file):
+        refs.append(seq.translate(table, b'.-'))
+        if len(refs) >= max_refs:
+            break
+    return refs
+
+def synthetic_reads(silva_file: str, read1: str, read2: str, n_pairs=100000, read_length=150,
+                    insert=300, seed=1) -> tuple:
+    """
+    Write paired FASTQ files of read pairs sampled from the reference sequences
+    """
+    rng = random.Random(seed)
+    refs = reference_dna(silva_file)
+    qual = b'I' * read_length
+    with open(read1, 'wb') as out1, open(read2, 'wb') as out2:
+        for i in range(n_pairs):
+            ref = rng.choice(refs)
+            start = rng.randrange(max(1, len(ref) - insert))
+            frag = ref[start:start + insert]
+            r1 = frag[:read_length]
+            r2 = frag[-read_length:].translate(COMPLEMENT)[::-1]
+            out1.write(b'@read%d/1\n%s\n+\n%s\n' % (i, r1, qual[:len(r1)]))
+            out2.write(b'@read%d/2\n%s\n+\n%s\n' % (i, r2, qual[:len(r2)]))
+    return read1, read2
+
+def mixed_reads(silva_file: str, read1: str, read2: str, n_pairs=100000, read_length=150,
+                ssu_fraction=0.1, divergence=0.03, seed=1) -> tuple:
+    """
+    Write paired FASTQ files of SSU read pairs, sampled from the reference
+    sequences with `divergence` substitutions (named ssu<i>), mixed with
+    random non-SSU read pairs (named other<i>), to measure the prefilter
+    """
+    rng = random.Random(seed)
+    # the reference sequences are drawn from a base pool generated with `seed`
+    other_rng = random.Random(f'non-SSU {seed}')
+    refs = reference_dna(silva_file)
+    qual = b'I' * read_length
+    with open(read1, 'wb') as out1, open(read2, 'wb') as out2:
+        for i in range(n_pairs):
+            if rng.random() < ssu_fraction:
+                ref = rng.choice(refs)
+                start = rng.randrange(max(1, len(ref) - 2 * read_length))
+                frag = bytearray(ref[start:start + 2 * read_length])
+                for _ in range(int(len(frag) * divergence)):
+                    j = rng.randrange(len(frag))
+                    frag[j] = rng.choice(b'ACGT'.replace(bytes([frag[j]]), b''))
+                name = b'ssu%d' % i
+            else:
+                frag = bytearray(other_rng.choices(b'ACGT', k=2 * read_length))
+                name = b'other%d' % i
+            r1 = bytes(frag[:read_length])
+            r2 = bytes(frag[-read_length:]).translate(COMPLEMENT)[::-1]
+            out1.write(b'@%s/1\n%s\n+\n%s\n' % (name, r1, qual[:len(r1)]))
+            out2.write(b'@%s/2\n%s\n+\n%s\n' % (name, r2, qual[:len(r2)]))
+    return read1, read2
+
+def synthetic_sam(silva_file: str, out_file: str, n_pairs=100000, read_length=150, max_hits=4,
+                  unmapped=0.1, seed=1) -> str:
+    """
+    Write a bbmap-like SAM file (no header) of paired reads with ambiguous
+    hits: secondary alignments of the reverse read carry the 0x40 flag of
+    the forward read, as written by bbmap
+    """
+    rng = random.Random(seed)
+    refs = [h for h,_ in read_fasta(silva_file)][:5000]
+    rest = b'%d\t%d\t' + b'%dM' % read_length + b'\t=\t%d\t%d\t*\t*\tNM:i:0\n'
+    with open(out_file, 'wb') as outF:
+        for i in range(n_pairs):
+            name = b'read%d' % i
+            if rng.random() < unmapped:
+                outF.write(name + b'\t77\t*\t0\t0\t*\t*\t0\t0\t*\t*\n')
+                outF.write(name + b'\t141\t*\t0\t0\t*\t*\t0\t0\t*\t*\n')
+                continue
+            # hits on neighbouring references, which tend to share a taxonomy
+            first = rng.randrange(len(refs))
+            hits = refs[first:first + rng.randint(1, max_hits)]
+            pos = rng.randint(1, 1200)
+            lines = []
+            for j,ref in enumerate(hits):
+                flag = 99 if j == 0 else 0x100 | 99
+                lines.append(b'%s\t%d\t%s\t' % (name, flag, ref) + rest % (pos, 40, pos + 150, 300))
+            for j,ref in enumerate(hits):
+                flag = 147 if j == 0 else 0x100 | 0x40 | 0x10 | 0x1
+                lines.append(b'%s\t%d\t%s\t' % (name, flag, ref) + rest % (pos + 150, 40, pos, -300))
+            outF.write(b''.join(lines))
+    return out_file
+
+def synthetic_ntu_tables(out_dir: str, n_samples=50, n_taxa=2000, taxa_per_sample=300,
+                         seed=1) -> list:
+    """
+    Write NTU abundance tables of samples drawn from a shared pool of taxa,
+    with Zipf-like abundances
+    """
+    rng = random.Random(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    pool = sorted(set(random_taxonomy(rng).rstrip(b';').decode() for _ in range(n_taxa)))
+    files = []
+    for i in range(n_samples):
+        taxa = rng.sample(pool, min(taxa_per_sample, len(pool)))
+        out_file = os.path.join(out_dir, f'sample{i}.phyloFlash.NTUabundance.csv')
+        with open(out_file, 'w') as outF:
+            for rank,tax in enumerate(taxa, 1):
+                outF.write(f'{tax},{int(1000 / rank) + 1}\n')
+        files.append(out_file)
+    return files
+
+def write_stand_ins(bin_dir: str) -> str:
+    """
+    Write the stand-in executables to `bin_dir`
+    Return: str, bin_dir
+    """
+    os.makedirs(bin_dir, exist_ok=True)
+    script = os.path.join(bin_dir, 'stand_in.py')
+    with open(script, 'w') as outF:
+        outF.write(f'#!{sys.executable}\n' + STAND_IN)
+    os.chmod(script, 0o755)
+    for tool in STAND_IN_TOOLS:
+        path = os.path.join(bin_dir, tool)
+        if os.path.lexists(path):
+            os.remove(path)
+        os.symlink(script, path)
+    return bin_dir
+
+@contextlib.contextmanager
+def stand_ins(bin_dir: str, env=None):
+    """
+    Put the stand-in executables first in PATH (and set extra environment
+    variables) while in the context
+    """
+    saved = dict(os.environ)
+    barrnap = make_db.BARRNAP_EXE
+    os.environ['PATH'] = bin_dir + os.pathsep + os.environ.get('PATH', '')
+    os.environ.update(env or {})
+    make_db.BARRNAP_EXE = os.path.join(bin_dir, 'barrnap_HGV')
+    try:
+        yield bin_dir
+    finally:
+        os.environ.clear()
+        os.environ.update(saved)
+        make_db.BARRNAP_EXE = barrnap
+
+@contextlib.contextmanager
+def quiet(level=logging.WARNING):
+    """
+    Raise the logging level while in the context
+    """
+    logger = logging.getLogger()
+    saved = logger.level
+    logger.setLevel(level)
+    try:
+        yield
+    finally:
+        logger.setLevel(saved)
+
+
+class Workload(object):
+    """
+    Synthetic inputs of the benchmark cases, generated on first use in `work_dir`.
+    Each bench_* method runs one case and returns the number of items processed.
+    """
+    def __init__(self, work_dir: str, n_seqs=20000, n_reads=100000, n_samples=50, n_libs=4,
+                 threads=2, seed=1):
+        self.work_dir = work_dir
+        self.n_seqs = n_seqs
+        self.n_reads = n_reads
+        self.n_samples = n_samples
+        self.n_libs = n_libs
+        self.threads = threads
+        self.seed = seed
+        self._files = {}
+        self._run = 0
+        # case-specific results besides the timings, e.g. prefilter sensitivity
+        self.metrics = {}
+
+    def path(self, *names) -> str:
+        return os.path.join(self.work_dir, *names)
+
+    def fresh_dir(self, name: str) -> str:
+        """
+        New empty output directory for one run of a case
+        """
+        self._run += 1
+        out_dir = self.path('runs', f'{name}.{self._run}')
+        shutil.rmtree(out_dir, ignore_errors=True)
+        os.makedirs(out_dir)
+        return out_dir
+
+    def _input(self, name: str, func):
+        if name not in self._files:
+            logging.info(f'Generating synthetic {name}...')
+            self._files[name] = func()
+        return self._files[name]
+
+    @property
+    def silva_gz(self) -> str:
+        return self._input('SILVA database', lambda: synthetic_silva(
+            self.path('SILVA_bench.fasta.gz'), self.n_seqs, seed=self.seed))
+
+    @property
+    def silva(self) -> str:
+        """
+        Uncompressed database with its SeqStore (as after silva_uncompress)
+        """
+        return self._input('uncompressed SILVA database', lambda: make_db.silva_uncompress(
+            self.silva_gz, self.work_dir))
+
+    @property
+    def reads(self) -> tuple:
+        return self._input('reads', lambda: synthetic_reads(
+            self.silva, self.path('reads_R1.fq'), self.path('reads_R2.fq'), self.n_reads,
+            seed=self.seed))
+
+    @property
+    def mixed_reads(self) -> tuple:
+        return self._input('SSU and non-SSU reads', lambda: mixed_reads(
+            self.silva, self.path('mixed_R1.fq'), self.path('mixed_R2.fq'), self.n_reads,
+            seed=self.seed))
+
+    @property
+    def silva_fixed(self) -> str:
+        """
+        Normalized database (as after fix_NR99), with its SeqStore
+        """
+        def fixed():
+            silva_file = self.path('prefilter', 'SILVA_SSU.fasta')
+            os.makedirs(os.path.dirname(silva_file), exist_ok=True)
+            shutil.copyfile(self.silva, silva_file)
+            return make_db.fasta_copy_iupac_randomize(silva_file, seed=self.seed)
+        return self._input('normalized SILVA database', fixed)
+
+    @property
+    def kmer_index(self) -> str:
+        return self._input('k-mer prefilter index', lambda: prefilter.build_index(
+            self.silva_fixed, threads=self.threads))
+
+    @property
+    def mixed_counts(self) -> dict:
+        """
+        Number of SSU and non-SSU read pairs of mixed_reads
+        """
+        def counts():
+            total = {b'ssu' : 0, b'other' : 0}
+            for header,_,_ in fastq.read_fastq(self.mixed_reads[0]):
+                total[header.rstrip(b'0123456789/')] += 1
+            return total
+        return self._input('SSU and non-SSU read counts', counts)
+
+    @property
+    def prefilter_db(self) -> str:
+        """
+        Database directory with the k-mer prefilter index (bbmap is a stand-in)
+        """
+        def db():
+            db_home = self.path('prefilter_db')
+            os.makedirs(db_home, exist_ok=True)
+            index_file = os.path.join(db_home, core.PREFILTER_INDEX)
+            if os.path.lexists(index_file):
+                os.remove(index_file)
+            os.symlink(os.path.abspath(self.kmer_index), index_file)
+            return db_home
+        return self._input('prefilter database', db)
+
+    def map_mixed(self, *options) -> tuple:
+        """
+        Map the mixed reads with the stand-in bbmap at STAND_IN_MAP_RATE
+        Return: tuple, (wall time in seconds, options of the run)
+        """
+        from phyloflash.cli import make_parser
+        read1,read2 = self.mixed_reads
+        args = make_parser().parse_args([
+            'run', '--read1', read1, '--read2', read2, '--read-length', '150',
+            '--lib', os.path.join(self.fresh_dir('prefilter'), 'mixed'),
+            '--db-home', self.prefilter_db, '--threads', str(self.threads)] + list(options))
+        env = {'PHYLOFLASH_BENCH_MAP_RATE' : str(STAND_IN_MAP_RATE)}
+        t0 = time.perf_counter()
+        with stand_ins(self.bin_dir, env):
+            core.bbmap_map(args, threads=self.threads, memory=4)
+        return time.perf_counter() - t0, args
+
+    @property
+    def unfiltered_map(self) -> float:
+        """
+        Wall time of mapping the mixed reads without the prefilter
+        """
+        return self._input('unfiltered bbmap run', lambda: self.map_mixed()[0])
+
+    @property
+    def sam(self) -> str:
+        return self._input('SAM file', lambda: synthetic_sam(
+            self.silva, self.path('bbmap.sam'), self.n_reads, seed=self.seed))
+
+    @property
+    def ntu_tables(self) -> list:
+        return self._input('NTU tables', lambda: synthetic_ntu_tables(
+            self.path('ntu'), self.n_samples, seed=self.seed))
+
+    @property
+    def acc2tax(self) -> str:
+        return self._input('acc2tax index', lambda: make_db.hash_SILVA_acc_taxstrings_from_fasta(
+            self.silva))
+
+    @property
+    def lsu_hits(self) -> set:
+        """
+        Accessions of every 50th sequence, as LSU hits to remove
+        """
+        return self._input('LSU hits', lambda: set(
+            accession(h) for i,(h,_) in enumerate(read_fasta(self.silva)) if i % 50 == 0))
+
+    @property
+    def bin_dir(self) -> str:
+        return self._input('stand-in executables', lambda: write_stand_ins(self.path('bin')))
+
+    def prepare(self, case: str) -> None:
+        """
+        Generate the inputs of a case, so that generation is not timed
+        """
+        inputs = {
+            'silva_uncompress' : ['silva_gz'],
+            'sam_process' : ['silva', 'sam'],
+            'fastq_stats' : ['reads'],
+            'prefilter_index' : ['silva_fixed'],
+            'prefilter' : ['mixed_counts', 'prefilter_db', 'bin_dir', 'unfiltered_map'],
+            'compare' : ['ntu_tables'],
+            'remove_lsu' : ['silva', 'lsu_hits'],
+            'taxonomy_trie' : ['acc2tax'],
+            'make_db' : ['silva_gz', 'bin_dir'],
+            'run_batch' : ['reads', 'sam', 'bin_dir']
+        }
+        for name in inputs.get(case, ['silva']):
+            getattr(self, name)
+
+    def bench_silva_uncompress(self) -> int:
+        make_db.silva_uncompress(self.silva_gz, self.fresh_dir('silva_uncompress'))
+        return self.n_seqs
+
+    def bench_fasta_normalize(self) -> int:
+        silva_file = self.path(self.fresh_dir('fasta_normalize'), 'SILVA_SSU.fasta')
+        os.symlink(self.silva, silva_file)
+        make_db.fasta_copy_iupac_randomize(silva_file, seed=self.seed)
+        return self.n_seqs
+
+    def bench_remove_lsu(self) -> int:
+        silva_file = self.path(self.fresh_dir('remove_lsu'), 'SILVA_SSU.fasta')
+        os.symlink(self.silva, silva_file)
+        make_db.remove_LSU_contamination(silva_file, self.lsu_hits)
+        return self.n_seqs
+
+    def bench_acc2tax(self) -> int:
+        silva_file = self.path(self.fresh_dir('acc2tax'), 'SILVA_SSU.fasta')
+        os.symlink(self.silva, silva_file)
+        make_db.hash_SILVA_acc_taxstrings_from_fasta(silva_file)
+        return self.n_seqs
+
+    def bench_split_fasta(self) -> int:
+        out_dir = self.fresh_dir('split_fasta')
+        split_fasta(self.silva, max(2, self.threads), os.path.join(out_dir, 'shard'))
+        return self.n_seqs
+
+    def bench_taxonomy_trie(self) -> int:
+        return len(TaxonomyTrie.from_acc2tax(self.acc2tax))
+
+    def bench_sam_process(self) -> int:
+        out_file = self.path(self.fresh_dir('sam_process'), 'fixed.sam')
+        process_bbmap_sam(self.sam, out_file, paired=True)
+        return self.n_reads
+
+    def bench_fastq_stats(self) -> int:
+        read1,read2 = self.reads
+        return fastq.fastq_stats(read1, read2)['pairs']
+
+    def bench_prefilter_index(self) -> int:
+        silva_file = self.path(self.fresh_dir('prefilter_index'), 'SILVA_SSU.fixed.fasta')
+        os.symlink(self.silva_fixed, silva_file)
+        prefilter.build_index(silva_file, threads=self.threads)
+        return self.n_seqs
+
+    def bench_prefilter(self) -> int:
+        """
+        Map SSU and non-SSU reads (see mixed_reads) with --prefilter, with a
+        stand-in bbmap that maps at a fixed rate and keeps the SSU reads; the
+        wall time is compared to that of the unfiltered run, and the fraction
+        of each kept is recorded as sensitivity and false positive rate
+        """
+        wall,args = self.map_mixed('--prefilter', '--prefilter-check', '0')
+        files = core.sample_files(args)
+        with open(files['prefilter_csv']) as inF:
+            kept = int(dict(line.rstrip('\n').split(',') for line in inF)['kept'])
+        kept_ssu = sum(1 for _ in fastq.read_fastq(files['reads_mapped_f']))
+        total = self.mixed_counts
+        self.metrics['prefilter'] = {
+            'sensitivity' : round(kept_ssu / total[b'ssu'], 5) if total[b'ssu'] else None,
+            'false_positive_rate' : round((kept - kept_ssu) / total[b'other'], 5) if total[b'other'] else None,
+            'unfiltered_wall_s' : round(self.unfiltered_map, 4),
+            'filtered_wall_s' : round(wall, 4),
+            'speedup' : round(self.unfiltered_map / wall, 2)
+        }
+        return self.n_reads
+
+    def bench_compare(self) -> int:
+        matrix = compare.SampleMatrix()
+        for ntu_file in self.ntu_tables:
+            matrix.add(compare.sample_name(ntu_file), compare.read_ntu_csv(ntu_file, 7))
+        compare.distance_matrices(matrix, 7, threads=self.threads)
+        n = len(matrix.samples)
+        return n * (n - 1) // 2
+
+    def bench_make_db(self) -> int:
+        """
+        make-db from the (already downloaded) database to the indices, with stand-in tools
+        """
+        from phyloflash.cli import make_parser
+        out_dir = self.fresh_dir('make_db')
+        os.link(self.silva_gz, os.path.join(out_dir, os.path.basename(self.silva_gz)))
+        with open(os.path.join(out_dir, 'UniVec'), 'w') as outF:
+            outF.write('>uv1\nACGTACGTACGTACGT\n')
+        args = make_parser().parse_args([
+            'make-db', out_dir, '--debug', '--force', '--num-lines', str(2 * self.n_seqs),
+            '--threads', str(self.threads), '--memory', '4',
+            '--silva-url', f'file:///{os.path.basename(self.silva_gz)}'])
+        with stand_ins(self.bin_dir):
+            make_db.main(args)
+        return self.n_seqs
+
+    def bench_run_batch(self) -> int:
+        """
+        run-batch of `n_libs` libraries, with stand-in tools (bbmap returns the synthetic SAM file)
+        """
+        from phyloflash.cli import make_parser
+        out_dir = self.fresh_dir('run_batch')
+        read1,read2 = self.reads
+        db_home = os.path.join(out_dir, 'db')
+        os.makedirs(os.path.join(db_home, 'ref', 'genome', '1'))
+        # files checked by core.check_database
+        for x in ('ref/genome/1/summary.txt', 'SILVA_SSU.noLSU.masked.trimmed.udb'):
+            open(os.path.join(db_home, x), 'w').close()
+        manifest = os.path.join(out_dir, 'manifest.tsv')
+        with open(manifest, 'w') as outF:
+            outF.write('lib\tread1\tread2\tread_length\n')
+            for i in range(self.n_libs):
+                outF.write(f'lib{i}\t{read1}\t{read2}\t150\n')
+        args = make_parser().parse_args([
+            'run-batch', manifest, '--db-home', db_home, '--outdir', out_dir,
+            '--threads', str(self.threads), '--memory', str(4 * self.threads),
+            '--map-threads', '1', '--map-memory', '4', '--assembly-threads', '1',
+            '--assembly-memory', '4'])
+        env = {'PHYLOFLASH_BENCH_SAM' : self.sam, 'PHYLOFLASH_BENCH_READS' : str(self.n_reads)}
+        with stand_ins(self.bin_dir, env):
+            batch.main(args)
+        return self.n_libs * self.n_reads
+
+def time_case(func, repeat=3) -> dict:
+    """
+    Run a case `repeat` times.
+    Return: dict, wall and CPU times (CPU includes child processes) and throughput
+    """
+    walls,cpus = [],[]
+    n = 0
+    for _ in range(repeat):
+        gc.collect()
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        t0,c0 = time.perf_counter(),time.process_time()
+        with quiet():
+            n = func()
+        wall = time.perf_counter() - t0
+        children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu = time.process_time() - c0
+        cpu += (children_after.ru_utime - children.ru_utime) + (children_after.ru_stime - children.ru_stime)
+        walls.append(round(wall, 4))
+        cpus.append(round(cpu, 4))
+    median = statistics.median(walls)
+    return {
+        'items' : n,
+        'wall_s' : walls,
+        'wall_median_s' : median,
+        'wall_min_s' : min(walls),
+        'cpu_median_s' : statistics.median(cpus),
+        'items_per_s' : round(n / median, 1) if median else None
+    }
+
+def git_commit(path: str):
+    """
+    Commit hash of the checkout containing `path` (with a "+" if it has changes), or None
+    """
+    try:
+        commit = b''.join(stream(['git', '-C', path, 'rev-parse', 'HEAD'])).decode().strip()
+        dirty = b''.join(stream(['git', '-C', path, 'status', '--porcelain', '--untracked-files=no']))
+    except CommandError:
+        return None
+    return commit + ('+' if dirty.strip() else '')
+
+def run_benchmarks(workload: Workload, cases: list, repeat=3) -> dict:
+    """
+    Run benchmark cases
+    Return: dict, {'meta' : run description, 'cases' : {case : timings (see time_case)}}
+    """
+    results = {}
+    for case in cases:
+        workload.prepare(case)
+        logging.info(f'Running benchmark "{case}" ({repeat}x)...')
+        results[case] = time_case(getattr(workload, f'bench_{case}'), repeat)
+        results[case].update(workload.metrics.get(case, {}))
+        logging.info(f'  median {results[case]["wall_median_s"]:.3f} s; '
+                     f'{results[case]["items_per_s"]} items/s')
+        for name,value in workload.metrics.get(case, {}).items():
+            logging.info(f'  {name}: {value}')
+    meta = {
+        'created' : time.strftime('%Y-%m-%d %H:%M:%S'),
+        'commit' : git_commit(os.path.dirname(os.path.abspath(__file__))),
+        'python' : platform.python_version(),
+        'platform' : platform.platform(),
+        'cpus' : os.cpu_count(),
+        'scale' : {'n_seqs' : workload.n_seqs, 'n_reads' : workload.n_reads,
+                   'n_samples' : workload.n_samples, 'n_libs' : workload.n_libs,
+                   'threads' : workload.threads, 'seed' : workload.seed},
+        'repeat' : repeat
+    }
+    return {'meta' : meta, 'cases' : results}
+
+def write_results(results: dict, results_dir: str) -> str:
+    """
+    Save results as <results_dir>/<date>_<commit>.json
+    """
+    os.makedirs(results_dir, exist_ok=True)
+    stamp = time.strftime('%Y%m%d-%H%M%S')
+    commit = (results['meta']['commit'] or 'nocommit')[:12]
+    out_file = os.path.join(results_dir, f'{stamp}_{commit}.json')
+    with open(out_file, 'w') as outF:
+        json.dump(results, outF, indent=1)
+    return out_file
+
+def compare_results(results: dict, baseline: dict, threshold=0.1) -> list:
+    """
+    Compare median wall times to a baseline and log the ratios.
+    Return: list, cases slower than the baseline by more than `threshold`
+    """
+    if results['meta']['scale'] != baseline['meta']['scale']:
+        logging.warning('Baseline was run at a different scale; timings are not comparable')
+    logging.info(f'Comparison to baseline {baseline["meta"]["commit"]} ({baseline["meta"]["created"]}):')
+    logging.info(f'  {"case":<18} {"baseline_s":>10} {"current_s":>10} {"ratio":>7}')
+    regressions = []
+    for case,timing in results['cases'].items():
+        base = baseline['cases'].get(case)
+        if base is None:
+            continue
+        ratio = timing['wall_median_s'] / base['wall_median_s'] if base['wall_median_s'] else 1.0
+        flag = ''
+        if ratio > 1 + threshold:
+            regressions.append(case)
+            flag = ' REGRESSION'
+        logging.info(f'  {case:<18} {base["wall_median_s"]:>10.3f} {timing["wall_median_s"]:>10.3f} '
+                     f'{ratio:>7.2f}{flag}')
+    return regressions
+
+def parse_cases(case_str: str) -> list:
+    """
+    Comma-separated case names, or "all"
+    """
+    if case_str.strip() == 'all':
+        return list(CASES)
+    cases = [x.strip() for x in case_str.split(',') if x.strip()]
+    unknown = [x for x in cases if x not in CASES]
+    if unknown:
+        raise ValueError(f'Unknown benchmark case(s): {", ".join(unknown)}; valid cases are: {", ".join(CASES)}')
+    return [x for x in CASES if x in cases]
+
+def main(args):
+    cases = parse_cases(args.cases)
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as inF:
+            baseline = json.load(inF)
+
+    # synthetic data and stand-in tools
+    work_dir = args.workdir or tempfile.mkdtemp(prefix='phyloflash_benchmark.')
+    os.makedirs(work_dir, exist_ok=True)
+    workload = Workload(work_dir, n_seqs=args.n_seqs, n_reads=args.n_reads, n_samples=args.n_samples,
+                        n_libs=args.n_libs, threads=args.threads, seed=args.seed)
+    try:
+        results = run_benchmarks(workload, cases, args.repeat)
+    finally:
+        # the generated inputs are kept in a given work directory
+        shutil.rmtree(os.path.join(work_dir, 'runs'), ignore_errors=True)
+        if args.workdir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    # results
+    out_file = write_results(results, args.results_dir)
+    logging.info(f'Benchmark results written to {out_file}')
+    if baseline is not None:
+        regressions = compare_results(results, baseline, args.threshold)
+        if regressions:
+            raise ValueError(f'Benchmark regressions (> {args.threshold:.0%} slower): {", ".join(regressions)}')
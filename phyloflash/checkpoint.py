@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+# import
+## batteries
+import os
+import sys
+import json
+import time
+import hashlib
+from functools import partial
+## package
+from phyloflash.tools import registry, binary_identity
+
+# sha256 of the module files of stage functions: {(path, size, mtime_ns) : hex digest}
+_code_hashes = {}
+
+
+def file_sha256(file_path: str, blocksize=1 << 20) -> str:
+    """
+    sha256 hex digest of a file's contents
+    """
+    h = hashlib.sha256()
+    with open(file_path, 'rb') as inF:
+        for block in iter(lambda: inF.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def list_files(path: str) -> list:
+    """
+    All files at `path` (the path itself, or all files below a directory)
+    """
+    if os.path.isdir(path):
+        files = []
+        for root,dirs,names in os.walk(path):
+            dirs.sort()
+            files += [os.path.join(root, x) for x in sorted(names)]
+        return files
+    return [path]
+
+def file_record(file_path: str, known=None) -> dict:
+    """
+    Size, mtime and content hash of a file.
+    If `known` (a previous record) has the same size and mtime, the
+    file is not re-hashed and the known hash is reused.
+    """
+    st = os.stat(file_path)
+    record = {'size' : st.st_size, 'mtime_ns' : st.st_mtime_ns}
+    if known is not None and all(known.get(k) == v for k,v in record.items()):
+        record['sha256'] = known['sha256']
+    else:
+        record['sha256'] = file_sha256(file_path)
+    return record
+
+def file_identity(file_path: str):
+    """
+    Size and mtime of an input file that is too large to hash on every
+    run (e.g. reads), or None if it does not exist
+    """
+    try:
+        st = os.stat(file_path)
+    except FileNotFoundError:
+        return None
+    return {'size' : st.st_size, 'mtime_ns' : st.st_mtime_ns}
+
+def result_paths(result) -> list:
+    """
+    Existing files/directories referenced by a stage result (also within
+    lists and dict values)
+    """
+    if isinstance(result, str):
+        return [result] if os.path.exists(result) else []
+    if isinstance(result, (list, tuple)):
+        return [p for x in result for p in result_paths(x)]
+    if isinstance(result, dict):
+        return [p for x in result.values() for p in result_paths(x)]
+    return []
+
+def encode_result(result):
+    """
+    JSON-serializable version of a stage result (sets are tagged, also
+    within lists and dict values)
+    """
+    if isinstance(result, (set, frozenset)):
+        return {'__set__' : sorted(result)}
+    if isinstance(result, (list, tuple)):
+        return [encode_result(x) for x in result]
+    if isinstance(result, dict):
+        return {k : encode_result(v) for k,v in result.items()}
+    return result
+
+def decode_result(result):
+    """
+    Inverse of encode_result
+    """
+    if isinstance(result, dict) and '__set__' in result:
+        return set(result['__set__'])
+    if isinstance(result, list):
+        return [decode_result(x) for x in result]
+    if isinstance(result, dict):
+        return {k : decode_result(v) for k,v in result.items()}
+    return result
+
+def output_records(result, known=None) -> dict:
+    """
+    {file_path : file_record} for all files referenced by a stage result
+    """
+    known = known or {}
+    records = {}
+    for path in result_paths(result):
+        for file_path in list_files(path):
+            records[file_path] = file_record(file_path, known.get(file_path))
+    return records
+
+def output_fingerprint(result, records: dict) -> str:
+    """
+    Fingerprint of a stage's outputs: the output file hashes, or the
+    result value itself for stages that do not write files
+    """
+    if records:
+        data = sorted((k, v['sha256']) for k,v in records.items())
+    else:
+        data = encode_result(result)
+    return hashlib.sha256(json.dumps(data, default=str).encode()).hexdigest()
+
+def code_fingerprint(func):
+    """
+    sha256 of the source file of the module defining a stage function, so
+    that changing the code of a stage (also of one without tools, e.g.
+    fix_NR99) invalidates its outputs. Hashed once per file version.
+    Return: str, or None if the module has no source file
+    """
+    module = sys.modules.get(getattr(func, '__module__', None) or '')
+    path = getattr(module, '__file__', None)
+    if path is None:
+        return None
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    key = (path, st.st_size, st.st_mtime_ns)
+    if key not in _code_hashes:
+        _code_hashes[key] = file_sha256(path)
+    return _code_hashes[key]
+
+def func_params(func) -> dict:
+    """
+    Function name, code fingerprint and bound arguments of a (possibly
+    partial) stage function
+    """
+    args,kwargs = [],{}
+    while isinstance(func, partial):
+        args = list(func.args) + args
+        kwargs = {**func.keywords, **kwargs}
+        func = func.func
+    name = f'{getattr(func, "__module__", "")}.{getattr(func, "__qualname__", repr(func))}'
+    return {'func' : name, 'code' : code_fingerprint(func), 'args' : args, 'kwargs' : kwargs}
+
+def tool_fingerprint(exe: str) -> dict:
+    """
+    Identity of an executable: resolved path, size, mtime and version,
+    looked up in the shared tool registry (see tools.registry)
+    """
+    tools = registry()
+    path = tools.resolve(exe)
+    identity = binary_identity(path) if path is not None else None
+    if identity is None:
+        return {'path' : None}
+    identity['version'] = tools.version(exe)
+    return identity
+
+def stage_fingerprint(params: dict, tools: dict, inputs: dict) -> str:
+    """
+    Fingerprint of everything that determines a stage's outputs
+    """
+    data = {'params' : params, 'tools' : tools, 'inputs' : inputs}
+    return hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class Checkpoints(object):
+    """
+    Per-stage manifests stored as JSON files in a directory.
+    A manifest records the stage fingerprint (parameters, code, tool versions
+    and input fingerprints), the output file hashes and the stage result,
+    so that an unchanged stage can be skipped on rerun.
+    checkpoint_dir: str, directory for the manifests
+    resume: bool, if False, previous manifests are ignored (but still rewritten)
+    """
+    def __init__(self, checkpoint_dir: str, resume=True):
+        self.checkpoint_dir = checkpoint_dir
+        self.resume = resume
+        os.makedirs(checkpoint_dir, exist_ok=True)
+
+    def manifest_path(self, name: str) -> str:
+        return os.path.join(self.checkpoint_dir, f'{name}.json')
+
+    def load(self, name: str):
+        """
+        Manifest of stage `name`, or None if it does not exist/cannot be read
+        """
+        try:
+            with open(self.manifest_path(name)) as inF:
+                return json.load(inF)
+        except (OSError, ValueError):
+            return None
+
+    def fingerprint(self, stage, inputs: dict) -> tuple:
+        """
+        Stage parameters, tool identities and fingerprint
+        stage: Stage object
+        inputs: dict, {dep_name : output fingerprint of the dependency}
+        """
+        params = func_params(stage.func)
+        tools = {x : tool_fingerprint(x) for x in stage.tools}
+        return params, tools, stage_fingerprint(params, tools, inputs)
+
+    def lookup(self, stage, fingerprint: str):
+        """
+        Previous manifest of `stage` if it is still valid: same fingerprint
+        and all recorded output files unchanged. Otherwise None.
+        """
+        if not self.resume:
+            return None
+        manifest = self.load(stage.name)
+        if manifest is None or manifest.get('fingerprint') != fingerprint:
+            return None
+        result = decode_result(manifest['result'])
+        try:
+            records = output_records(result, manifest['outputs'])
+        except OSError:
+            return None
+        if records.keys() != manifest['outputs'].keys():
+            return None
+        if output_fingerprint(result, records) != manifest['output_fingerprint']:
+            return None
+        return manifest
+
+    def record(self, stage, params: dict, tools: dict, inputs: dict,
+               fingerprint: str, result) -> dict:
+        """
+        Hash the outputs of a finished stage and write its manifest
+        """
+        records = output_records(result)
+        manifest = {
+            'stage' : stage.name,
+            'fingerprint' : fingerprint,
+            'params' : params,
+            'tools' : tools,
+            'inputs' : inputs,
+            'outputs' : records,
+            'output_fingerprint' : output_fingerprint(result, records),
+            'result' : encode_result(result),
+            'finished' : time.strftime('%Y-%m-%dT%H:%M:%S')
+        }
+        tmp_file = self.manifest_path(stage.name) + '.tmp'
+        with open(tmp_file, 'w') as outF:
+            json.dump(manifest, outF, indent=1, default=str)
+        os.replace(tmp_file, self.manifest_path(stage.name))
+        return manifest
+
+    def invalidate(self, name: str) -> None:
+        """
+        Remove the manifest of stage `name`
+        """
+        try:
+            os.remove(self.manifest_path(name))
+        except FileNotFoundError:
+            pass
@@ -1,20 +1,70 @@
 #!/usr/bin/env python
 # import
 ## batteries
-import logging
 import argparse
-## package
-from phyloflash import core
-from phyloflash import make_db
-
-# logging
-logging.basicConfig(format='%(asctime)s - %(message)s', level=logging.DEBUG)
+import importlib
 
 # parser description formatting
 class CustomFormatter(argparse.ArgumentDefaultsHelpFormatter,
                       argparse.RawDescriptionHelpFormatter):
     pass
 
+def subcommand(module: str):
+    """
+    main() of a subcommand module, which is only imported when the
+    subcommand is run (not to parse arguments or print help)
+    """
+    def main(args):
+        return importlib.import_module(f'phyloflash.{module}').main(args)
+    return main
+
+def add_run_options(parser):
+    """
+    Options of the analysis of each library, shared by run, run-batch and ena
+    """
+    parser.add_argument('--db-home', type=str, help='phyloFlash DB folder')
+    parser.add_argument('--read-limit', type=int,
+                        help='Reads (pairs) used per library (remote reads are only streamed up to this); default: all')
+    parser.add_argument('--max-insert', type=int, help='Maxinsert')
+    parser.add_argument('--id', type=int, help='Read mapping identity')
+    parser.add_argument('--tax-level', type=int, default=4, help='Taxon report level')
+    parser.add_argument('--tophit', action='store_true', help='Top hit flag')
+    parser.add_argument('--timeout', type=float, default=None,
+                        help='Time limit (minutes) of each external command; default: no limit')
+    parser.add_argument('--sortmerna', action='store_true', help='Use sortmerna')
+    parser.add_argument('--evalue-sortmerna', type=str, help='E-value sortmerna')
+    parser.add_argument('--prefilter', action='store_true', default=False,
+                        help='Only map reads with k-mers in the SSU database (k-mer index built by make-db)')
+    parser.add_argument('--prefilter-check', type=int, default=100000,
+                        help='Reads (pairs) mapped unfiltered to measure the sensitivity of --prefilter')
+    parser.add_argument('--scatter', type=int, default=1,
+                        help='Number of chunks the reads are split into for mapping')
+    parser.add_argument('--scatter-queue', type=str, default=None,
+                        help='Job queue directory (shared file system) of the chunks, '
+                        'mapped by `phyloflash scatter-worker`; default: local processes')
+    parser.add_argument('--poscov', action='store_true', help='Positional coverage flag')
+    parser.add_argument('--poscov-sample', type=int, default=10000,
+                        help='Number of mapped reads (pairs) sampled for the positional coverage')
+    parser.add_argument('--skip-spades', action='store_true', help='Skip spades')
+    parser.add_argument('--sc', action='store_true', help='SC flag')
+
+def add_batch_options(parser):
+    """
+    Options of running many libraries on one pool of threads and memory,
+    shared by run-batch and ena
+    """
+    parser.add_argument('--outdir', type=str, default='.', help='Output directory; one subdirectory per library')
+    parser.add_argument('--status-file', type=str, default=None,
+                        help='Status table (default: <outdir>/batch_status.tsv)')
+    parser.add_argument('--threads', type=int, default=4, help='Total number of threads')
+    parser.add_argument('--memory', type=int, default=40, help='Total memory limit in GB')
+    parser.add_argument('--map-threads', type=int, default=4, help='Threads per mapping job')
+    parser.add_argument('--map-memory', type=int, default=20, help='Memory (GB) per mapping job')
+    parser.add_argument('--assembly-threads', type=int, default=4, help='Threads per assembly job')
+    parser.add_argument('--assembly-memory', type=int, default=20, help='Memory (GB) per assembly job')
+    parser.add_argument('-f', '--force', action='store_true', default=False,
+                        help='Rerun all stages, ignoring the checkpoints of a previous run (<outdir>/checkpoints/)')
+
 def cmd_make_db(subparsers):
      # subcommand: make-db
     desc = 'Create database for phyloFlash'
@@ -24,72 +74,267 @@ def cmd_make_db(subparsers):
     """
     parser_make_db = subparsers.add_parser("make-db", formatter_class=CustomFormatter,
                                            description = desc, epilog = epi)
-    parser_make_db.set_defaults(func=make_db.main)
+    parser_make_db.set_defaults(func=subcommand('make_db'))
     ## add arguments
     parser_make_db.add_argument("outdir", type=str, 
                                 help = "Output directory path")
     parser_make_db.add_argument("-s", "--skip-sortmerna", action='store_true', default=False,
                                 help = "Skip sortmerna database")
     parser_make_db.add_argument("-t", "--threads", type=int, default=4,
-                                help = "Number of threads to use")
+                                help = "Number of threads to use (shared by steps running in parallel)")
     parser_make_db.add_argument("-m", "--memory", type=int, default=12,
-                                help = "Memory limit in GB")
+                                help = "Memory limit in GB (shared by steps running in parallel)")
     parser_make_db.add_argument("-U", "--univec-url", type=str, 
                                 default='https://ftp.ncbi.nlm.nih.gov/pub/UniVec/UniVec',
                                 help = "UniVec database URL")
     parser_make_db.add_argument("-S", "--silva-url", type=str, 
                                 default='https://www.arb-silva.de/fileadmin/silva_databases/release_138_1/Exports/SILVA_138.1_LSURef_NR99_tax_silva_trunc.fasta.gz',
                                 help = "SILVA database URL")
+    parser_make_db.add_argument("-M", "--mirror-dir", type=str, default=None,
+                                help = "Local mirror directory for downloads, shared between builds")
+    parser_make_db.add_argument("-c", "--connections", type=int, default=4,
+                                help = "Number of parallel connections per download")
+    parser_make_db.add_argument("-r", "--seed", type=int, default=1,
+                                help = "Random seed for replacing ambiguous IUPAC bases")
+    parser_make_db.add_argument("-T", "--timeout", type=float, default=None,
+                                help = "Time limit (minutes) of each external command; default: no limit")
+    parser_make_db.add_argument("-f", "--force", action='store_true', default=False,
+                                help = "Rerun all steps, even if unchanged since a previous run")
     parser_make_db.add_argument("-d", "--debug", action='store_true', default=False,
                                 help = "Debug mode")
     parser_make_db.add_argument("-N", "--num-lines", type=int, default=1000,
-                                help = "Max number of lines to used from the SILVA database, if debug=True")
+                                help = "Max number of lines (2 per sequence) used from the SILVA database, if debug=True")
 
 def cmd_run(subparsers):
        # subcommand: run
     desc = 'Run phyloFlash pipeline'
     epi = """DESCRIPTION:
     Run phyloFlash pipeline.
+    Stages are checkpointed in <lib>.checkpoints/: on rerun, a stage is only
+    run again if its options, input files, tools or upstream results changed
+    (e.g. changing --tax-level reruns the taxonomy summary, not the mapping).
+    With --scatter N, the reads are split into N chunks mapped by separate
+    bbmap runs (concurrent local processes, or `scatter-worker` processes
+    on other hosts with --scatter-queue) and the outputs merged.
+    With --prefilter, only reads with a k-mer in the SSU database are
+    mapped (filtered by --threads processes); the first --prefilter-check
+    reads are mapped unfiltered to measure the sensitivity of the filter
+    (<lib>.prefilter.csv).
     """
     parser_run = subparsers.add_parser("run", formatter_class=CustomFormatter,
                                        description = desc, epilog = epi)
-    parser_run.set_defaults(func=core.main)
+    parser_run.set_defaults(func=subcommand('core'))
     ## Add arguments specific to cmd2, e.g.
     parser_run.add_argument('--read1', type=str, help='Forward read file')
     parser_run.add_argument('--read2', type=str, help='Reverse read file')
     parser_run.add_argument('--lib', type=str, help='Output file basename')
-    parser_run.add_argument('--db-home', type=str, help='phyloFlash DB folder')
     parser_run.add_argument('--interleaved', action='store_true', help='Interleaved reads')
     parser_run.add_argument('--read-length', type=int, help='Read length')
-    parser_run.add_argument('--read-limit', type=int, help='Read limit')
     parser_run.add_argument('--amp-limit', type=int, help='Amplimit')
-    parser_run.add_argument('--max-insert', type=int, help='Maxinsert')
-    parser_run.add_argument('--id', type=int, help='Read mapping identity')
     parser_run.add_argument('--cluster-id', type=int, help='Clustering identity')
-    parser_run.add_argument('--tax-level', type=int, default=4, help='Taxon report level')
     parser_run.add_argument('--threads', type=int, default=1, help='threads')
+    parser_run.add_argument('--memory', type=int, default=20, help='Memory limit in GB')
     parser_run.add_argument('--html', action='store_true', help='HTML flag')
     parser_run.add_argument('--treemap', action='store_true', help='Treemap flag')
     parser_run.add_argument('--crlf', action='store_true', help='CRLF flag')
     parser_run.add_argument('--decimal-comma', action='store_true', help='Decimal comma flag')
-    parser_run.add_argument('--sortmerna', action='store_true', help='Use sortmerna')
-    parser_run.add_argument('--evalue-sortmerna', type=str, help='E-value sortmerna')
     parser_run.add_argument('--emirge', action='store_true', help='Use emirge')
     parser_run.add_argument('--skip-emirge', action='store_true', help='Skip emirge')
-    parser_run.add_argument('--skip-spades', action='store_true', help='Skip spades')
     parser_run.add_argument('--trusted', type=str, help='Trusted contigs')
-    parser_run.add_argument('--poscov', action='store_true', help='Positional coverage flag')
-    parser_run.add_argument('--sc', action='store_true', help='SC flag')
     parser_run.add_argument('--zip', action='store_true', help='Zip flag')
     parser_run.add_argument('--log', action='store_true', help='Save log flag')
     parser_run.add_argument('--keeptmp', action='store_true', help='Keep temporary files')
     parser_run.add_argument('--everything', action='store_true', help='Everything flag')
     parser_run.add_argument('--almost-everything', action='store_true', help='Almost everything flag')
-    parser_run.add_argument('--tophit', action='store_true', help='Top hit flag')
     parser_run.add_argument('--check-env', action='store_true', help='Check environment flag')
+    parser_run.add_argument('-f', '--force', action='store_true', default=False,
+                            help='Rerun all stages, ignoring the checkpoints of a previous run (<lib>.checkpoints/)')
     parser_run.add_argument('--outfiles', action='store_true', help='Output description flag')
+    add_run_options(parser_run)
 
-def main():
+def cmd_run_batch(subparsers):
+    # subcommand: run-batch
+    desc = 'Run phyloFlash pipeline on many libraries'
+    epi = """DESCRIPTION:
+    Run the phyloFlash pipeline on all libraries in a sample manifest.
+    The manifest is a tab-separated table with a header line and the columns
+    lib, read1 and (optionally) read2, interleaved and read_length.
+    The environment and database are checked once, and the stages of all
+    libraries share one pool of threads and memory. A per-sample status
+    table is written to the output directory.
+    """
+    parser_batch = subparsers.add_parser("run-batch", formatter_class=CustomFormatter,
+                                         description = desc, epilog = epi)
+    parser_batch.set_defaults(func=subcommand('batch'))
+    ## add arguments
+    parser_batch.add_argument('manifest', type=str, help='Sample manifest (tab-separated)')
+    parser_batch.add_argument('--read-length', type=int, help='Read length (unless given in the manifest)')
+    add_batch_options(parser_batch)
+    add_run_options(parser_batch)
+
+def cmd_ena(subparsers):
+    # subcommand: ena
+    desc = 'Run phyloFlash pipeline on read runs from ENA'
+    epi = """DESCRIPTION:
+    Run the phyloFlash pipeline on the read runs of ENA accessions (studies,
+    samples, experiments or runs). The FASTQ files of each run are listed by
+    the ENA portal API and streamed over HTTP: the reads are decompressed on
+    the fly and piped into the mapping stage, without storing them, and the
+    transfer stops once --read-limit reads have been mapped. Several runs
+    are processed concurrently, as with run-batch (one subdirectory per run,
+    status table and <outdir>/ena_runs.tsv with the runs and their URLs).
+    """
+    parser_ena = subparsers.add_parser("ena", formatter_class=CustomFormatter,
+                                       description = desc, epilog = epi)
+    parser_ena.set_defaults(func=subcommand('ena'))
+    ## add arguments
+    parser_ena.add_argument('accession', type=str, nargs='*', help='ENA accessions')
+    parser_ena.add_argument('--accession-file', type=str, default=None,
+                            help='File of ENA accessions, one per line')
+    parser_ena.add_argument('--portal-url', type=str,
+                            default='https://www.ebi.ac.uk/ena/portal/api/filereport',
+                            help='ENA portal API filereport endpoint')
+    parser_ena.add_argument('--protocol', type=str, default='https', choices=('https', 'http', 'ftp'),
+                            help='Protocol of the FASTQ URLs')
+    parser_ena.add_argument('--read-length', type=int, help='Read length (default: detected per run)')
+    add_batch_options(parser_ena)
+    add_run_options(parser_ena)
+
+def cmd_scatter_worker(subparsers):
+    # subcommand: scatter-worker
+    desc = 'Map read chunks queued by run --scatter-queue'
+    epi = """DESCRIPTION:
+    Run the mapping jobs of `phyloflash run --scatter N --scatter-queue DIR`.
+    Start workers on any hosts that see the queue directory (and the read,
+    database and output paths); each claims one job at a time and runs it
+    with its own --threads and --memory.
+    """
+    parser_worker = subparsers.add_parser("scatter-worker", formatter_class=CustomFormatter,
+                                          description = desc, epilog = epi)
+    parser_worker.set_defaults(func=subcommand('scatter'))
+    ## add arguments
+    parser_worker.add_argument('queue_dir', type=str, help='Job queue directory')
+    parser_worker.add_argument('--threads', type=int, default=4, help='Threads per job')
+    parser_worker.add_argument('--memory', type=int, default=20, help='Memory (GB) per job')
+    parser_worker.add_argument('--poll', type=float, default=5,
+                               help='Seconds between checks for new jobs')
+    parser_worker.add_argument('--idle-exit', type=float, default=None,
+                               help='Exit after this many minutes without jobs; default: run until stopped')
+    parser_worker.add_argument('--max-jobs', type=int, default=None,
+                               help='Exit after this many jobs; default: no limit')
+
+def cmd_compare(subparsers):
+    # subcommand: compare
+    desc = 'Compare phyloFlash NTU results for multiple libraries'
+    epi = """DESCRIPTION:
+    Compare the taxonomic composition of libraries using their phyloFlash
+    NTU abundance tables. Tasks (comma-separated):
+      ntu_table : taxon/sample/count table (<out>.ntu_table.tsv)
+      matrix    : weighted taxonomic UniFrac, Bray-Curtis and Jaccard distances
+                  (<out>.matrix.tsv, <out>.bray_curtis.matrix.tsv, <out>.jaccard.matrix.tsv)
+      heatmap   : per-sample tables for phyloFlash_heatmap.R (<out>.heatmap/)
+      barplot   : table for phyloFlash_barplot.R (<out>.barplot.csv)
+    """
+    parser_compare = subparsers.add_parser("compare", formatter_class=CustomFormatter,
+                                           description = desc, epilog = epi)
+    parser_compare.set_defaults(func=subcommand('compare'))
+    ## add arguments
+    parser_compare.add_argument('csv', type=str, nargs='+',
+                                help='NTU abundance tables (<lib>.phyloFlash.NTU*.csv)')
+    parser_compare.add_argument('--task', type=str, default='ntu_table,matrix',
+                                help='Comparison tasks: ntu_table, matrix, heatmap, barplot')
+    parser_compare.add_argument('--level', type=int, default=4, help='Taxonomic level to compare at')
+    parser_compare.add_argument('--out', type=str, default='phyloFlash_compare', help='Output file prefix')
+    parser_compare.add_argument('--threads', type=int, default=1, help='Number of processes for distance calculations')
+
+def cmd_fastg_fishing(subparsers):
+    # subcommand: fastg-fishing
+    desc = 'Bin genomes from an assembly graph by SSU rRNA'
+    epi = """DESCRIPTION:
+    Find clusters of connected contigs in a (meta)genome assembly graph
+    (FASTG or GFA, from MEGAHIT or SPAdes) and report those containing
+    SSU rRNA predicted by barrnap, or the contigs/graph edges listed with
+    --list-fasta/--list-fastg, or all clusters (--clusteronly). Each
+    cluster is likely to originate from a single genome (a putative
+    genome bin). Outputs:
+      <out>.cluster_stats.tab     : bins above the length cutoff
+      <out>.cluster_ssu_summary.tab : bin of each SSU rRNA found
+      <out>.nodes_to_cluster.tab  : contigs of each bin
+      <out>.barrnap.gff           : barrnap predictions
+    """
+    parser_fishing = subparsers.add_parser("fastg-fishing", formatter_class=CustomFormatter,
+                                           description = desc, epilog = epi)
+    parser_fishing.set_defaults(func=subcommand('fastg_fishing'))
+    ## add arguments
+    parser_fishing.add_argument('--fastg', type=str, required=True,
+                                help='Assembly graph (FASTG or GFA) from MEGAHIT or SPAdes')
+    parser_fishing.add_argument('--fasta', type=str, required=True,
+                                help='Contigs (MEGAHIT: *.contigs.fa; SPAdes: contigs or scaffolds)')
+    parser_fishing.add_argument('--paths', type=str, default=None,
+                                help='SPAdes paths file of the contigs (not needed with a GFA graph)')
+    parser_fishing.add_argument('-a', '--assembler', type=str, default='megahit',
+                                choices=('megahit', 'spades'), help='Assembler')
+    parser_fishing.add_argument('--list-fastg', type=str, default=None,
+                                help='List of graph edges to use as bait')
+    parser_fishing.add_argument('--list-fasta', type=str, default=None,
+                                help='List of contigs to use as bait')
+    parser_fishing.add_argument('--compare-ssu', type=str, default=None,
+                                help='FASTA of SSU sequences (e.g. from phyloFlash) to compare to those found')
+    parser_fishing.add_argument('--compare-zip', type=str, default=None,
+                                help='phyloFlash archive (<lib>.phyloFlash.tar.gz) with SSU sequences to compare')
+    parser_fishing.add_argument('-o', '--out', type=str, default='test', help='Output file prefix')
+    parser_fishing.add_argument('-c', '--cutoff', type=int, default=100000,
+                                help='Minimum total length (bp) of reported clusters')
+    parser_fishing.add_argument('--min-ssu-frac', type=float, default=0.2,
+                                help='Minimum fraction of full-length SSU to report (barrnap --reject)')
+    parser_fishing.add_argument('--outfasta', action='store_true', default=False,
+                                help='Write the contigs of each bin to <out>.binXX.fasta')
+    parser_fishing.add_argument('--clusteronly', action='store_true', default=False,
+                                help='Do not search for SSU rRNA, report all clusters above the cutoff')
+    parser_fishing.add_argument('--threads', type=int, default=1, help='Number of threads for barrnap')
+    parser_fishing.add_argument('--barrnap-path', type=str, default=None,
+                                help='barrnap executable (default: barrnap-HGV shipped with phyloFlash)')
+
+def cmd_benchmark(subparsers):
+    # subcommand: benchmark
+    desc = 'Benchmark phyloFlash on synthetic data'
+    epi = """DESCRIPTION:
+    Time the database formatting steps, SAM/taxonomy processing, read
+    statistics, the k-mer read prefilter, sample comparison and the
+    make-db/run-batch orchestration on synthetic SILVA-like databases,
+    reads, SAM files and NTU tables. External tools (bbmap, vsearch,
+    barrnap, ...) are replaced by fast stand-in executables, so no tools or
+    network access are needed. In the prefilter case, the stand-in bbmap
+    maps at a fixed rate, and the wall time of mapping with --prefilter is
+    compared to that without (besides sensitivity and false positive rate).
+    Results are saved as JSON, and can be compared to a previous run.
+    Cases: silva_uncompress, fasta_normalize, remove_lsu, acc2tax, split_fasta,
+    taxonomy_trie, sam_process, fastq_stats, prefilter_index,
+    prefilter, compare, make_db, run_batch
+    """
+    parser_bench = subparsers.add_parser("benchmark", formatter_class=CustomFormatter,
+                                         description = desc, epilog = epi)
+    parser_bench.set_defaults(func=subcommand('benchmark'))
+    ## add arguments
+    parser_bench.add_argument('--cases', type=str, default='all',
+                              help='Comma-separated benchmark cases (see DESCRIPTION), or "all"')
+    parser_bench.add_argument('--n-seqs', type=int, default=20000, help='Number of synthetic SILVA sequences')
+    parser_bench.add_argument('--n-reads', type=int, default=100000, help='Number of synthetic read pairs (FASTQ and SAM)')
+    parser_bench.add_argument('--n-samples', type=int, default=50, help='Number of synthetic NTU tables to compare')
+    parser_bench.add_argument('--n-libs', type=int, default=4, help='Number of libraries in the run-batch benchmark')
+    parser_bench.add_argument('--repeat', type=int, default=3, help='Runs per case; the median is reported')
+    parser_bench.add_argument('--threads', type=int, default=2, help='Number of threads')
+    parser_bench.add_argument('--seed', type=int, default=1, help='Random seed of the data generators')
+    parser_bench.add_argument('--workdir', type=str, default=None,
+                              help='Directory for the synthetic data (default: a temporary directory)')
+    parser_bench.add_argument('--results-dir', type=str, default='benchmark_results',
+                              help='Directory of the saved results')
+    parser_bench.add_argument('--baseline', type=str, default=None,
+                              help='Results file of a previous run to compare to')
+    parser_bench.add_argument('--threshold', type=float, default=0.1,
+                              help='Relative slowdown vs. the baseline reported as a regression')
+
+def make_parser():
     parser = argparse.ArgumentParser(
         description="A pipeline to rapidly reconstruct the SSU rRNAs",
         formatter_class=CustomFormatter
@@ -99,11 +344,25 @@ def main():
     # subcommands
     cmd_make_db(subparsers)
     cmd_run(subparsers)
+    cmd_run_batch(subparsers)
+    cmd_ena(subparsers)
+    cmd_scatter_worker(subparsers)
+    cmd_compare(subparsers)
+    cmd_fastg_fishing(subparsers)
+    cmd_benchmark(subparsers)
+    return parser
+
+def main():
+    parser = make_parser()
 
     # parse arguments
     args = parser.parse_args()
-    ## call subcommand function
+    ## call subcommand function; external commands are stopped on interrupt
     if 'func' in args:
+        import logging
+        from phyloflash.runner import install_signal_handlers
+        logging.basicConfig(format='%(asctime)s - %(message)s', level=logging.DEBUG)
+        install_signal_handlers()
         args.func(args)
     else:
         parser.print_help()
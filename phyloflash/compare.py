@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+# import
+## batteries
+import os
+import re
+import csv
+import logging
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+## package
+from phyloflash.taxonomy import TaxonomyTrie
+from phyloflash.sam import diversity_stats
+
+# distance metrics, in the order computed by pair_distances
+METRICS = ('unifrac', 'bray_curtis', 'jaccard')
+TASKS = ('ntu_table', 'matrix', 'heatmap', 'barplot')
+# sample name from a phyloFlash NTU abundance file name
+NTU_FILE = re.compile(r'^(.+)\.phyloFlash\.NTU.*\.csv$')
+
+
+def sample_name(ntu_file: str) -> str:
+    """
+    Library name of a phyloFlash NTU abundance table (<lib>.phyloFlash.NTU*.csv)
+    """
+    name = os.path.basename(ntu_file)
+    m = NTU_FILE.match(name)
+    if m is None:
+        logging.warning(f'Filename of {ntu_file} does not match standard name of a phyloFlash NTU abundance file')
+        return os.path.splitext(name)[0]
+    return m.group(1)
+
+def read_ntu_csv(ntu_file: str, level=None) -> dict:
+    """
+    Read an NTU abundance table, summarized to a taxonomic level. Taxonomy
+    strings shallower than `level` are padded with the lowest rank in brackets.
+    Lines without a count (e.g. a header) are skipped.
+    Return: dict, {taxonomy string : count}
+    """
+    counts = {}
+    with open(ntu_file, newline='') as inF:
+        for row in csv.reader(inF):
+            if len(row) < 2:
+                continue
+            try:
+                n = int(float(row[-1]))
+            except ValueError:
+                continue
+            path = ','.join(row[:-1]).strip().split(';')
+            if level is not None:
+                if len(path) < level:
+                    path += [f'({path[-1]})'] * (level - len(path))
+                path = path[:level]
+            tax = ';'.join(path)
+            counts[tax] = counts.get(tax, 0) + n
+    return counts
+
+
+class SampleMatrix(object):
+    """
+    Sparse sample x taxon matrix. Taxa are interned as nodes of a TaxonomyTrie;
+    each sample is stored as its leaf counts {node : count} and as the relative
+    abundance of every node of the taxonomy tree {node : fraction}, i.e. each
+    count is also added to all ancestors of its taxon.
+    """
+    def __init__(self):
+        self.trie = TaxonomyTrie()
+        self.samples = []
+        self.counts = []
+        self.tree = []
+
+    def add(self, name: str, counts: dict) -> None:
+        """
+        Add a sample from {taxonomy string : count}
+        """
+        leaves = {}
+        for tax,n in counts.items():
+            node = self.trie.node(tax.encode())
+            leaves[node] = leaves.get(node, 0) + n
+        total = sum(leaves.values())
+        tree = {}
+        parent = self.trie.parent
+        for node,n in leaves.items():
+            frac = n / total if total else 0
+            while node:
+                tree[node] = tree.get(node, 0) + frac
+                node = parent[node]
+        self.samples.append(name)
+        self.counts.append(leaves)
+        self.tree.append(tree)
+
+    def taxa(self, i: int) -> dict:
+        """
+        {taxonomy string : count} of sample i
+        """
+        return {self.trie.taxstring(node) : n for node,n in self.counts[i].items()}
+
+
+# sample vectors of the worker processes (set by _init_worker)
+_VECTORS = None
+
+def _init_worker(vectors) -> None:
+    global _VECTORS
+    _VECTORS = vectors
+
+def _shared_min(a: dict, b: dict, keys) -> float:
+    """
+    Sum of the smaller value of a and b over the shared keys
+    """
+    return sum(map(min, map(a.__getitem__, keys), map(b.__getitem__, keys)))
+
+def pair_distances(rows: list, level: int) -> list:
+    """
+    Distances between samples `rows` and all samples after them.
+    Each L1 distance is computed from the shared nodes only, using
+    sum|a - b| = sum(a) + sum(b) - 2 sum(min(a, b)).
+    Return: list of (i, [array of distances to samples i+1.. for each metric in METRICS])
+    """
+    counts,tree,count_sums,tree_sums = _VECTORS
+    n = len(counts)
+    out = []
+    for i in rows:
+        ci,ti = counts[i],tree[i]
+        ci_keys,ti_keys = ci.keys(),ti.keys()
+        unifrac,bray,jaccard = array('d'),array('d'),array('d')
+        for j in range(i + 1, n):
+            cj,tj = counts[j],tree[j]
+            # weighted taxonomic UniFrac: unit branch lengths, depth `level`
+            shared = ti_keys & tj.keys()
+            l1 = tree_sums[i] + tree_sums[j] - 2 * _shared_min(ti, tj, shared)
+            unifrac.append(max(0.0, l1 / (2 * level)))
+            # Bray-Curtis and Jaccard on the taxon counts
+            shared = ci_keys & cj.keys()
+            total = count_sums[i] + count_sums[j]
+            bray.append(1 - 2 * _shared_min(ci, cj, shared) / total if total else 0.0)
+            union = len(ci) + len(cj) - len(shared)
+            jaccard.append(1 - len(shared) / union if union else 0.0)
+        out.append((i, [unifrac, bray, jaccard]))
+    return out
+
+
+class DistanceMatrix(object):
+    """
+    Symmetric distance matrix with a zero diagonal, stored as the upper
+    triangle: row i holds the distances to samples i+1..n-1
+    """
+    def __init__(self, samples: list):
+        self.samples = samples
+        self.rows = [array('d') for _ in samples]
+
+    def __getitem__(self, ij: tuple) -> float:
+        i,j = ij
+        if i == j:
+            return 0.0
+        if i > j:
+            i,j = j,i
+        return self.rows[i][j - i - 1]
+
+    def write(self, out_file: str) -> str:
+        """
+        Write sample1/sample2/distance lines (all ordered pairs, as phyloFlash_compare.pl)
+        """
+        samples = self.samples
+        with open(out_file, 'w') as outF:
+            for i,a in enumerate(samples):
+                if i > 0:
+                    outF.write('\n')
+                outF.write('\n'.join(f'{a}\t{b}\t{self[i, j]}' for j,b in enumerate(samples)))
+        return out_file
+
+def distance_matrices(matrix: SampleMatrix, level: int, threads=1) -> dict:
+    """
+    Weighted taxonomic UniFrac, Bray-Curtis and Jaccard distances between
+    all samples, computed in blocks of rows in parallel processes.
+    Return: dict, {metric : DistanceMatrix}
+    """
+    n = len(matrix.samples)
+    vectors = (matrix.counts, matrix.tree,
+               [sum(x.values()) for x in matrix.counts],
+               [sum(x.values()) for x in matrix.tree])
+    dists = {m : DistanceMatrix(matrix.samples) for m in METRICS}
+    # rows distributed round-robin, so blocks have similar numbers of pairs
+    n_blocks = max(1, min(n, threads * 4))
+    blocks = [list(range(b, n, n_blocks)) for b in range(n_blocks)]
+    if threads > 1 and n > 1:
+        with ProcessPoolExecutor(max_workers=threads, initializer=_init_worker,
+                                 initargs=(vectors,)) as pool:
+            results = list(pool.map(pair_distances, blocks, [level] * len(blocks)))
+    else:
+        _init_worker(vectors)
+        results = [pair_distances(rows, level) for rows in blocks]
+    for res in results:
+        for i,rows in res:
+            for m,row in zip(METRICS, rows):
+                dists[m].rows[i] = row
+    return dists
+
+
+def write_ntu_table(matrix: SampleMatrix, out_file: str, delim='\t') -> str:
+    """
+    Write the taxon/sample/count table, sorted by taxon and sample
+    """
+    rows = []
+    for i,sample in enumerate(matrix.samples):
+        for tax,n in matrix.taxa(i).items():
+            rows.append((tax, sample, n))
+    rows.sort()
+    with open(out_file, 'w', newline='') as outF:
+        csv.writer(outF, delimiter=delim, lineterminator='\n').writerows(rows)
+    return out_file
+
+def write_heatmap_tables(matrix: SampleMatrix, out_dir: str) -> str:
+    """
+    Write the per-sample NTU abundance and report CSV files read by
+    phyloFlash_heatmap.R, summarized to the comparison level
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    for i,sample in enumerate(matrix.samples):
+        taxa = matrix.taxa(i)
+        with open(os.path.join(out_dir, f'{sample}.phyloFlash.NTUabundance.csv'), 'w') as outF:
+            outF.write(''.join(f'{tax},{n}\n' for tax,n in taxa.items()))
+        chao1 = diversity_stats(taxa)[0]
+        with open(os.path.join(out_dir, f'{sample}.phyloFlash.report.csv'), 'w') as outF:
+            outF.write(f'library name,{sample}\nNTU Chao1 richness estimate,{chao1}\n')
+    return out_dir
+
+def parse_tasks(task_str: str) -> set:
+    """
+    Comma-separated task names (or prefixes thereof)
+    """
+    tasks = set()
+    for task in task_str.split(','):
+        task = task.strip()
+        hits = [x for x in TASKS if x.startswith(task)] if task else []
+        if len(hits) != 1:
+            raise ValueError(f'Unrecognized task "{task}"; valid tasks are: {", ".join(TASKS)}')
+        tasks.add(hits[0])
+    return tasks
+
+def main(args):
+    tasks = parse_tasks(args.task)
+    if len(args.csv) < 2:
+        raise ValueError('Cannot perform a comparison with fewer than two input samples')
+    if args.level > 7:
+        logging.warning('Taxonomic level is > 7, this is unlikely to provide a meaningful result')
+
+    # sample x taxon matrix
+    logging.info(f'Reading taxonomy from {len(args.csv)} NTU abundance tables')
+    matrix = SampleMatrix()
+    for ntu_file in args.csv:
+        matrix.add(sample_name(ntu_file), read_ntu_csv(ntu_file, args.level))
+    if len(set(matrix.samples)) != len(matrix.samples):
+        raise ValueError('Duplicate sample names in the NTU abundance tables')
+    out_dir = os.path.dirname(os.path.abspath(args.out))
+    os.makedirs(out_dir, exist_ok=True)
+
+    # tables
+    if 'ntu_table' in tasks:
+        out_file = write_ntu_table(matrix, f'{args.out}.ntu_table.tsv')
+        logging.info(f'NTU abundance table written to file: {out_file}')
+    if 'barplot' in tasks:
+        out_file = write_ntu_table(matrix, f'{args.out}.barplot.csv', delim=',')
+        logging.info(f'NTU abundance by sample table for barplot written to file: {out_file}')
+    if 'heatmap' in tasks:
+        out_dir = write_heatmap_tables(matrix, f'{args.out}.heatmap')
+        logging.info(f'Tables for heatmap written to folder: {out_dir}')
+
+    # distance matrices
+    if 'matrix' in tasks:
+        logging.info(f'Calculating distances between {len(matrix.samples)} samples...')
+        dists = distance_matrices(matrix, args.level, threads=args.threads)
+        out_file = dists['unifrac'].write(f'{args.out}.matrix.tsv')
+        logging.info(f'Matrix of Unifrac-like abundance-weighted taxonomic distances written to file {out_file}')
+        for metric in METRICS[1:]:
+            out_file = dists[metric].write(f'{args.out}.{metric}.matrix.tsv')
+            logging.info(f'{metric} distance matrix written to file {out_file}')
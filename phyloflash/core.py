@@ -3,18 +3,78 @@
 ## batteries
 import os
 import re
-import shutil
+import csv
+import argparse
+import logging
 import pathlib
+import shutil
 import platform
+import threading
 import importlib.resources
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+## package
+from phyloflash.scheduler import Stage, run_stages
+from phyloflash.checkpoint import Checkpoints, file_identity
+from phyloflash.db_manifest import verify_database
+from phyloflash.tools import tool_path, check_version
+from phyloflash.runner import run, feed, set_timeout, bind_stage
+from phyloflash.download import is_url
+from phyloflash.profiling import start_profile, write_profile
+from phyloflash.sam import process_bbmap_sam, read_bbmap_log, diversity_stats
+from phyloflash.sortmerna import process_sortmerna_sam, read_sortmerna_log
+from phyloflash.fastq import fastq_stats, fastq_chunks
+from phyloflash.poscov import nhmmer_model_pos, NHMMER_EXE
+from phyloflash.prefilter import ReadPrefilter
+from phyloflash.taxonomy import TaxonomyTrie
+from phyloflash import scatter
+
+# executables needed by phyloFlash
+REQUIRED_TOOLS = ['bbmap.sh', 'reformat.sh', 'vsearch', 'mafft',
+                  'fastaFromBed', 'sed', 'grep', 'awk', 'cat']
+# SPAdes exceeds its memory limit with too many threads
+SPADES_MAX_THREADS = 24
+# number of reads (pairs) used for automatic read length detection
+READLENGTH_READS = 10000
+# sortmerna database (index and FASTA file) in the database directory
+SORTMERNA_DB = 'SILVA_SSU.noLSU.masked.trimmed.NR96.fixed'
+# accession -> taxonomy index of the database (built along with the sortmerna database)
+ACC2TAX_INDEX = f'{SORTMERNA_DB}.acc2taxstring.idx'
+# k-mer prefilter index of the bbmap database (NR99), built by make-db
+PREFILTER_INDEX = 'SILVA_SSU.noLSU.masked.trimmed.NR99.fixed.kmerfilter'
+# default E-value cutoff of sortmerna
+SORTMERNA_EVALUE = '1e-09'
+# output files of the map stage (see sample_files)
+BBMAP_FILES = ['bbmap_sam', 'bbmap_log', 'reads_mapped_f', 'reads_mapped_r',
+               'basecompositionhist', 'inserthistogram', 'idhistogram', 'hitstats']
+SORTMERNA_FILES = ['sortmerna_sam', 'sortmerna_fastq', 'sortmerna_log',
+                   'reads_mapped_f', 'reads_mapped_r']
+# options that determine the outputs of each stage (and, for the map stage,
+# where and how long its scatter jobs run); a stage is only given these (see
+# stage_args), so that changing any other option keeps its checkpoint
+STAGE_OPTIONS = {
+    'reads' : ['lib', 'read1', 'read2', 'interleaved', 'read_length'],
+    'map' : ['lib', 'read1', 'read2', 'interleaved', 'db_home', 'read_limit', 'id', 'max_insert',
+             'scatter', 'scatter_queue', 'timeout', 'prefilter', 'prefilter_check'],
+    'classify' : ['lib', 'read1', 'read2', 'interleaved', 'db_home', 'sortmerna', 'tax_level',
+                  'tophit'],
+    'assemble' : ['lib', 'read1', 'read2', 'interleaved', 'skip_spades', 'sc'],
+    'poscov' : ['lib', 'read1', 'read2', 'interleaved', 'poscov_sample']
+}
+SORTMERNA_OPTIONS = {
+    'map' : ['evalue_sortmerna', 'tophit']
+}
+
+# taxonomy tries of the database, built once per acc2tax index (see database_trie)
+_tries = {}
+_tries_lock = threading.Lock()
 
 
 def which(exe):
     """
-    Check that executable is in PATH
+    Check that executable is in PATH (resolved once, see tools.ToolRegistry)
     """
-    if shutil.which(exe) is None:
-        raise OSError(f"Executable '{exe}' not found in PATH")
+    return tool_path(exe)
 
 def which_barrnap():
     """
@@ -30,28 +90,54 @@ def which_barrnap():
                 raise OSError(f"Executable '{exe_path}' not found in package data path")
     return data_dir
 
-def check_database(db_home: str, use_sortmerna=False):
+def check_database(db_home: str, use_sortmerna=False, threads=1, prefilter=False):
     """
-    Check whether the required database files are present in "db_home".
+    Check that the required database files are present in "db_home" and,
+    if make-db wrote a manifest, unchanged since (see db_manifest.verify_database).
+    Return: dict, database manifest; or None if there is none
     """
     emirge_db   = "SILVA_SSU.noLSU.masked.trimmed.NR96.fixed"
     vsearch_db  = "SILVA_SSU.noLSU.masked.trimmed"
     sortmerna_db = emirge_db
     required = ['ref/genome/1/summary.txt',
                 #f'{emirge_db}.fasta',
-                'SILVA_SSU.noLSU.masked.trimmed']
+                f'{vsearch_db}.udb']
     if use_sortmerna:
-        required += [f'${sortmerna_db}.bursttrie_0.dat',
-                     f'${sortmerna_db}.acc2taxstring.hashimage']
-    required = [os.path.join(db_home, x) for x in required]
-    return required
+        required += [f'{sortmerna_db}.bursttrie_0.dat',
+                     f'{sortmerna_db}.acc2taxstring.idx']
+    if prefilter:
+        required.append(PREFILTER_INDEX)
+    logging.info(f'Checking database {db_home}...')
+    manifest = verify_database(db_home, required, threads=threads)
+    if manifest is not None and manifest.get('silva_version'):
+        logging.info(f'  SILVA release {manifest["silva_version"]}')
+    return manifest
 
-def main(args):
-    # environment
-    ## check for executables needed by phyloFlash
-    for exe in ['bbmap.sh', 'reformat.sh', 'vsearch', 'mafft', 
-                'fastaFromBed', 'sed', 'grep', 'awk', 'cat']:
+def required_tools(args) -> list:
+    """
+    Executables needed for a run with the given options
+    """
+    tools = list(REQUIRED_TOOLS)
+    if args.sortmerna:
+        tools.append('sortmerna')
+    if args.scatter > 1:
+        tools.append('partition.sh')
+    if not args.skip_spades:
+        tools.append('spades.py')
+    return tools
+
+def check_environment(args) -> str:
+    """
+    Check executables, operating system and database once per run (or batch).
+    Return: str, package data directory
+    """
+    ## check for executables needed by phyloFlash, and their versions;
+    ## both are cached across runs (see tools.ToolRegistry)
+    for exe in required_tools(args):
         which(exe)
+        version = check_version(exe)
+        if version is not None:
+            logging.info(f'  Using {exe} version {version}')
     ## check that nhmmer is in package data path
     data_dir = which_barrnap()
     
@@ -62,6 +148,504 @@ def main(args):
     
     # database
     ## verify precence of database
-    check_database(args.db_home, use_sortmerna=args.sortmerna)
+    check_database(args.db_home, use_sortmerna=args.sortmerna,
+                   threads=args.threads, prefilter=args.prefilter)
+    return data_dir
+
+def sample_files(args) -> dict:
+    """
+    Output files of one library, named as by phyloFlash.pl
+    """
+    lib = args.lib
+    readsf = os.path.basename(args.read1)
+    return {
+        'bbmap_sam' : f'{lib}.bbmap.sam',
+        'bbmap_log' : f'{lib}.bbmap.out',
+        'sam_map' : f'{lib}.{readsf}.SSU.sam',
+        'reads_mapped_f' : f'{lib}.{readsf}.SSU.1.fq',
+        'reads_mapped_r' : f'{lib}.{readsf}.SSU.2.fq',
+        'basecompositionhist' : f'{lib}.basecompositionhistogram',
+        'inserthistogram' : f'{lib}.inserthistogram',
+        'idhistogram' : f'{lib}.idhistogram',
+        'hitstats' : f'{lib}.hitstats',
+        'mapratio_csv' : f'{lib}.mapratio.csv',
+        'prefilter_csv' : f'{lib}.prefilter.csv',
+        'ntu_csv' : f'{lib}.phyloFlash.NTUabundance.csv',
+        'ntu_full_csv' : f'{lib}.phyloFlash.NTUfull_abundance.csv',
+        'readlength_out' : f'{lib}.readlength.txt',
+        'spades_dir' : f'{lib}.spades',
+        'spades_log' : f'{lib}.spades.out',
+        'reads_uncompressed' : f'{lib}.{readsf}.uncompressed.fastq',
+        'sortmerna_sam' : f'{lib}.sortmerna.sam',
+        'sortmerna_fastq' : f'{lib}.sortmerna.fastq',
+        'sortmerna_log' : f'{lib}.sortmerna.log'
+    }
+
+def database_files(db_home: str, use_sortmerna=False, prefilter=False) -> list:
+    """
+    Database files read by the map stage (and by classify with sortmerna)
+    """
+    files = ['ref/genome/1/summary.txt']
+    if prefilter:
+        files.append(PREFILTER_INDEX)
+    if use_sortmerna:
+        files += [f'{SORTMERNA_DB}.bursttrie_0.dat', ACC2TAX_INDEX]
+    return [os.path.join(db_home, x) for x in files]
+
+def stage_args(args, stage: str):
+    """
+    Options of one stage (see STAGE_OPTIONS), bound to the stage function
+    and thus part of its checkpoint fingerprint. The read and database
+    files a stage reads are added by size and mtime (`input_files`), so
+    that replaced inputs invalidate the stage without hashing them.
+    Return: argparse.Namespace
+    """
+    sortmerna = args.sortmerna
+    names = STAGE_OPTIONS[stage] + (SORTMERNA_OPTIONS.get(stage, []) if sortmerna else [])
+    sargs = argparse.Namespace(**{k : getattr(args, k) for k in names})
+    inputs = []
+    if stage in ('reads', 'map'):
+        inputs += [x for x in (args.read1, args.read2) if x is not None and not is_url(x)]
+    if stage == 'map' or (stage == 'classify' and sortmerna):
+        inputs += database_files(args.db_home, sortmerna,
+                                 stage == 'map' and args.prefilter)
+    elif stage == 'classify':
+        # taxonomy of the database (see database_trie)
+        inputs.append(os.path.join(args.db_home, ACC2TAX_INDEX))
+    if inputs:
+        sargs.input_files = {x : file_identity(x) for x in inputs}
+    return sargs
+
+def read_length(args) -> int:
+    """
+    Read length of a library: as given, or the longest of the first reads
+    (read in-process; the histogram is written as readlength.sh did)
+    """
+    if args.read_length is not None:
+        return args.read_length
+    logging.info(f'Automatic read length detection for {args.lib}...')
+    files = sample_files(args)
+    stats = fastq_stats(args.read1, args.read2, args.interleaved, READLENGTH_READS)['segments']
+    os.makedirs(os.path.dirname(os.path.abspath(args.lib)), exist_ok=True)
+    stats.write_histogram(files['readlength_out'])
+    length = stats.max_length()
+    if len(stats.lengths) > 1:
+        logging.info('  Reads are not all the same length, using longest read length found...')
+    logging.info(f'  Auto-detected read length: {length}')
+    if not 50 <= length <= 500:
+        raise ValueError(f'Read length must be within 50...500 (detected: {length})')
+    return length
+
+def run_on_reads(cmd: list, args, log_file=None, append=True, prefilter=None) -> None:
+    """
+    Run a bbtools command on the reads of a library, adding the input
+    arguments (in=, in2=, interleaved=). Remote reads (URLs, e.g. from ENA)
+    are decompressed in-process and piped into the command as interleaved
+    FASTQ, only up to --read-limit reads: they are not stored on disk, and
+    the download stops once the limit is reached. Reads are also piped if
+    they are filtered (`prefilter`, see prefilter.ReadPrefilter).
+    """
+    paired = args.read2 is not None or args.interleaved
+    remote = any(is_url(x) for x in (args.read1, args.read2) if x is not None)
+    if not remote and prefilter is None:
+        cmd = cmd + [f'in={args.read1}']
+        if args.read2 is not None:
+            cmd.append(f'in2={args.read2}')
+        elif args.interleaved:
+            cmd.append('interleaved=t')
+        run(cmd, log_file=log_file, append=append)
+        return
+    if remote:
+        logging.info(f'  Streaming reads of {args.lib} from {args.read1}' +
+                     (f' and {args.read2}' if args.read2 is not None else ''))
+    cmd = cmd + ['in=stdin.fq'] + (['interleaved=t'] if paired else [])
+    if prefilter is not None:
+        chunks = prefilter.chunks(args.read1, args.read2, args.interleaved, args.read_limit)
+    else:
+        chunks = fastq_chunks(args.read1, args.read2, args.interleaved, args.read_limit)
+    feed(cmd, chunks, log_file=log_file, append=append)
+
+def read_prefilter(args, threads=1):
+    """
+    k-mer prefilter of the reads of a library (--prefilter, see
+    prefilter.ReadPrefilter), run by `threads` processes; or None
+    """
+    if not args.prefilter:
+        return None
+    index_file = os.path.join(args.db_home, PREFILTER_INDEX)
+    if not os.path.exists(index_file):
+        raise OSError(f'Database {args.db_home} has no k-mer prefilter index ({PREFILTER_INDEX}); '
+                      'rebuild the database with make-db')
+    logging.info(f'  Prefiltering reads of {args.lib} with the k-mer index {index_file}')
+    return ReadPrefilter(index_file, threads,
+                         check_reads=args.prefilter_check)
+
+def prefilter_report(args, filt, log_file: str, total_line: str) -> str:
+    """
+    Log the reads kept by the prefilter and its sensitivity, measured on
+    the unfiltered first reads, and write both to <lib>.prefilter.csv.
+    The number of input reads is appended to the mapper log (`total_line`,
+    in the mapper's format), as the mapper only saw the kept reads.
+    Return: str, CSV file
+    """
+    files = sample_files(args)
+    check = filt.sensitivity(files['reads_mapped_f'])
+    with open(log_file, 'a') as outF:
+        outF.write(f'\n# reads before the k-mer prefilter\n{total_line}\n')
+    kept_pc = 100 * filt.kept / filt.pairs if filt.pairs else 0
+    logging.info(f'  Prefilter kept {filt.kept} of {filt.pairs} reads (pairs) ({kept_pc:.2f}%)')
+    if check['sensitivity'] is not None:
+        logging.info(f'  Prefilter sensitivity: {100 * check["sensitivity"]:.2f}% '
+                     f'({check["missed"]} of {check["mapped"]} mapped reads (pairs) among the first '
+                     f'{min(filt.pairs, filt.check_reads)} would have been removed)')
+    rows = [('pairs', filt.pairs), ('kept', filt.kept), ('kept_pc', f'{kept_pc:.3f}'),
+            ('check_pairs', min(filt.pairs, filt.check_reads)), ('check_mapped', check['mapped']),
+            ('check_missed', check['missed']),
+            ('sensitivity_pc', f'{100 * check["sensitivity"]:.3f}' if check['sensitivity'] is not None else 'NA')]
+    with open(files['prefilter_csv'], 'w') as outF:
+        outF.write('\n'.join(f'{k},{v}' for k,v in rows) + '\n')
+    return files['prefilter_csv']
+
+def bbmap_cmd(args, files: dict, threads=1, memory=20) -> list:
+    """
+    bbmap command mapping reads against the SSU database (input arguments not included)
+    files: dict, output files (see sample_files)
+    """
+    # minimum mapping identity of 50%
+    min_id = max(0.5, (args.id if args.id is not None else 70) / 100)
+    read_limit = args.read_limit if args.read_limit is not None else -1
+    max_insert = args.max_insert if args.max_insert is not None else 1200
+    cmd = ['bbmap.sh', f'-Xmx{memory}g', 'fast=t', f'minidentity={min_id}', f'reads={read_limit}',
+           f'threads={threads}', 'po=f', 'outputunmapped=f', f'path={args.db_home}',
+           f'out={files["bbmap_sam"]}', f'outm={files["reads_mapped_f"]}',
+           'noheader=t', 'ambiguous=all', 'build=1', 'overwrite=t',
+           f'bhist={files["basecompositionhist"]}',
+           f'ihist={files["inserthistogram"]}', f'idhist={files["idhistogram"]}',
+           f'scafstats={files["hitstats"]}']
+    if args.read2 is not None or args.interleaved:
+        cmd += [f'outm2={files["reads_mapped_r"]}', f'pairlen={max_insert}']
+    return cmd
+
+def bbmap_reads_line(reads: int, bases: int) -> str:
+    """
+    Read count line of a bbmap log (see sam.read_bbmap_log)
+    """
+    return f'Reads Used:           \t{reads}\t({bases} bases)'
+
+def bbmap_map(args, threads=1, memory=20) -> dict:
+    """
+    Map reads against the SSU database with bbmap, keeping the mapped reads
+    Return: dict, output files (see BBMAP_FILES)
+    """
+    if args.scatter > 1:
+        return bbmap_scatter_map(args, threads, memory)
+    logging.info(f'Mapping reads of {args.lib} to the SSU database...')
+    which('bbmap.sh')
+    files = sample_files(args)
+    os.makedirs(os.path.dirname(os.path.abspath(args.lib)), exist_ok=True)
+    filt = read_prefilter(args, threads)
+    ## run command; the log is parsed for the read count and insert size
+    run_on_reads(bbmap_cmd(args, files, threads, memory), args,
+                 log_file=files['bbmap_log'], append=False, prefilter=filt)
+    out_files = {k : files[k] for k in BBMAP_FILES}
+    if filt is not None:
+        out_files['prefilter_csv'] = prefilter_report(args, filt, files['bbmap_log'],
+                                                      bbmap_reads_line(filt.reads, filt.bases))
+    return out_files
+
+def chunk_args(args, scatter_dir: str, i: int, reads: tuple):
+    """
+    Options of the bbmap run on one chunk of reads (see bbmap_scatter_map),
+    with absolute paths, as the chunk may be mapped on another host
+    """
+    cargs = argparse.Namespace(**vars(args))
+    cargs.lib = os.path.join(scatter_dir, f'chunk{i}')
+    cargs.read1,cargs.read2 = reads
+    cargs.interleaved = False
+    cargs.read_limit = None
+    cargs.db_home = os.path.abspath(args.db_home)
+    return cargs
+
+def bbmap_scatter_map(args, threads=1, memory=20) -> dict:
+    """
+    Scatter-gather mode of bbmap_map (--scatter N) for libraries too large
+    for one host: the reads are split round-robin into N chunks with
+    partition.sh, each chunk is mapped by its own bbmap run, and the
+    outputs are merged into the files of a single run (see scatter.py).
+    The chunks are mapped by concurrent local processes sharing the
+    stage's threads and memory or, with --scatter-queue, by
+    `phyloflash scatter-worker` processes on other hosts.
+    Return: dict, output files (see BBMAP_FILES)
+    """
+    n = args.scatter
+    queue_dir = os.path.abspath(args.scatter_queue) if args.scatter_queue else None
+    logging.info(f'Mapping reads of {args.lib} to the SSU database in {n} chunks' +
+                 (f' queued in {queue_dir}...' if queue_dir is not None else '...'))
+    which('bbmap.sh')
+    files = sample_files(args)
+    paired = args.read2 is not None or args.interleaved
+    scatter_dir = os.path.abspath(f'{args.lib}.scatter')
+    os.makedirs(scatter_dir, exist_ok=True)
+    try:
+        ## split the reads (pairs) round-robin into chunks
+        which('partition.sh')
+        cmd = scatter.partition_cmd(scatter_dir, n, paired, args.read_limit, threads,
+                                    min(memory, scatter.PARTITION_MEMORY))
+        filt = read_prefilter(args, threads)
+        run_on_reads(cmd, args, log_file=os.path.join(scatter_dir, 'partition.out'), append=False,
+                     prefilter=filt)
+        chunks = [chunk_args(args, scatter_dir, i, x)
+                  for i,x in enumerate(scatter.chunk_reads(scatter_dir, n, paired))]
+        chunk_files = [sample_files(x) for x in chunks]
+        ## map the chunks
+        if queue_dir is not None:
+            queue = scatter.JobQueue(queue_dir)
+            timeout = args.timeout * 60 if args.timeout else None
+            job_ids = []
+            try:
+                for i,(cargs,cfiles) in enumerate(zip(chunks, chunk_files)):
+                    cmd = bbmap_cmd(cargs, cfiles, scatter.THREADS, scatter.MEMORY) + \
+                          [f'in={cargs.read1}'] + ([f'in2={cargs.read2}'] if paired else [])
+                    job_ids.append(queue.submit(f'{os.path.basename(args.lib)}.chunk{i}', cmd,
+                                                cfiles['bbmap_log'], timeout=timeout))
+            except BaseException:
+                queue.cancel(job_ids)
+                raise
+            queue.wait(job_ids)
+        else:
+            workers = max(1, min(n, threads))
+            cmds = [bbmap_cmd(cargs, cfiles, max(1, threads // workers), max(1, memory // workers)) +
+                    [f'in={cargs.read1}'] + ([f'in2={cargs.read2}'] if paired else [])
+                    for cargs,cfiles in zip(chunks, chunk_files)]
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                jobs = [pool.submit(bind_stage(run), cmd, log_file=cfiles['bbmap_log'], append=False)
+                        for cmd,cfiles in zip(cmds, chunk_files)]
+                for x in jobs:
+                    x.result()
+        ## merge the outputs into those of a single run
+        logging.info(f'  Merging the bbmap outputs of {n} chunks...')
+        reads = [scatter.bbmap_log_reads(x['bbmap_log'])[0] for x in chunk_files]
+        for k in ('bbmap_sam', 'reads_mapped_f', 'reads_mapped_r'):
+            if k != 'reads_mapped_r' or paired:
+                scatter.concat_files([x[k] for x in chunk_files], files[k])
+        for k in ('inserthistogram', 'idhistogram', 'basecompositionhist'):
+            scatter.merge_histograms([x[k] for x in chunk_files], files[k], reads,
+                                     average=k == 'basecompositionhist')
+        scatter.merge_scafstats([x['hitstats'] for x in chunk_files], files['hitstats'])
+        scatter.merge_bbmap_logs([x['bbmap_log'] for x in chunk_files], files['bbmap_log'],
+                                 files['inserthistogram'])
+    finally:
+        shutil.rmtree(scatter_dir, ignore_errors=True)
+    out_files = {k : files[k] for k in BBMAP_FILES}
+    if filt is not None:
+        out_files['prefilter_csv'] = prefilter_report(args, filt, files['bbmap_log'],
+                                                      bbmap_reads_line(filt.reads, filt.bases))
+    return out_files
+
+def sortmerna_map(args, threads=1, memory=20) -> dict:
+    """
+    Extract SSU reads with sortmerna instead of bbmap. sortmerna reads
+    uncompressed FASTQ, so the reads are first converted with reformat.sh.
+    Both segments of each pair with an aligned segment are kept (--paired_in)
+    and split into the forward and reverse read files afterwards (single-end
+    reads are renamed to the forward read file). The SAM file is fixed in
+    the classify stage (see process_sortmerna_sam).
+    Return: dict, output files (see SORTMERNA_FILES)
+    """
+    logging.info(f'Extracting SSU reads of {args.lib} with sortmerna...')
+    for exe in ('reformat.sh', 'sortmerna'):
+        which(exe)
+    files = sample_files(args)
+    os.makedirs(os.path.dirname(os.path.abspath(args.lib)), exist_ok=True)
+    paired = args.read2 is not None or args.interleaved
+    read_limit = args.read_limit if args.read_limit is not None else -1
+    cmd = ['reformat.sh', f'-Xmx{memory}g', f'reads={read_limit}',
+           f'threads={threads}', f'out={files["reads_uncompressed"]}', 'overwrite=t']
+    filt = read_prefilter(args, threads)
+    run_on_reads(cmd, args, prefilter=filt)
+    db = os.path.join(args.db_home, SORTMERNA_DB)
+    evalue = args.evalue_sortmerna or SORTMERNA_EVALUE
+    cmd = ['sortmerna', '--ref', f'{db}.fasta,{db}', '--reads', files['reads_uncompressed'],
+           '--aligned', f'{args.lib}.sortmerna', '--fastx', '--paired_in', '--sam', '--log',
+           '--min_lis', 10, '-e', evalue, '-a', threads, '-v',
+           '--best', 1 if args.tophit else 10]
+    run(cmd)
+    os.remove(files['reads_uncompressed'])
+    if paired:
+        cmd = ['reformat.sh', f'-Xmx{memory}g', f'in={files["sortmerna_fastq"]}', 'interleaved=t',
+               f'out={files["reads_mapped_f"]}', f'out2={files["reads_mapped_r"]}',
+               f'threads={threads}', 'overwrite=t']
+        run(cmd)
+    else:
+        os.replace(files['sortmerna_fastq'], files['reads_mapped_f'])
+    out_files = {k : files[k] for k in SORTMERNA_FILES}
+    if filt is not None:
+        out_files['prefilter_csv'] = prefilter_report(args, filt, files['sortmerna_log'],
+                                                      f'    Total reads = {filt.reads}')
+    return out_files
+
+def write_ntu_csv(taxa: dict, out_file: str) -> str:
+    """
+    Write taxon read counts, sorted by decreasing count
+    """
+    with open(out_file, 'w', newline='') as outF:
+        writer = csv.writer(outF, lineterminator='\n')
+        for tax,n in sorted(taxa.items(), key=lambda x: -x[1]):
+            writer.writerow([tax, n])
+    return out_file
+
+def database_trie(db_home: str):
+    """
+    Taxonomy trie of the database, built from its acc2tax index once per
+    process (see TaxonomyTrie.from_acc2tax). Each library gets a copy, as
+    the taxonomy strings of its hits are added to the trie.
+    Return: TaxonomyTrie, or None if the database has no acc2tax index
+    """
+    index_file = os.path.join(db_home, ACC2TAX_INDEX)
+    identity = file_identity(index_file)
+    if identity is None:
+        return None
+    key = (index_file, identity['size'], identity['mtime_ns'])
+    with _tries_lock:
+        trie = _tries.get(key)
+        if trie is None:
+            trie = _tries[key] = TaxonomyTrie.from_acc2tax(index_file)
+    return trie.copy()
+
+def classify(args, files: dict, length: int, threads=1) -> dict:
+    """
+    Fix the bbmap (or sortmerna) SAM file and summarize mapping statistics and taxonomy,
+    in one pass over the SAM file (single-threaded; the stage claims one thread)
+    files: dict, output files of bbmap_map (or sortmerna_map)
+    length: int, read length
+    Return: dict, mapping statistics, diversity, whether assembly should be skipped
+      and the output files
+    """
+    logging.info(f'Summarizing taxonomy of {args.lib} from mapping hits to SILVA database...')
+    out_files = {k : v for k,v in sample_files(args).items()
+                 if k in ('sam_map', 'mapratio_csv', 'ntu_csv', 'ntu_full_csv')}
+    paired = args.read2 is not None or args.interleaved
+    tax_level = args.tax_level if args.tax_level is not None else 4
+    levels = [tax_level] if args.tophit else [tax_level, 7]
+    trie = database_trie(args.db_home)
+    if args.sortmerna:
+        acc2tax = os.path.join(args.db_home, ACC2TAX_INDEX)
+        fastq_file = files['sortmerna_fastq'] if paired else files['reads_mapped_f']
+        stats,taxonomy = process_sortmerna_sam(fastq_file, files['sortmerna_sam'],
+                                               out_files['sam_map'], acc2tax, paired=paired,
+                                               levels=levels, tophit=args.tophit, trie=trie)
+        log = {'reads' : read_sortmerna_log(files['sortmerna_log']),
+               'insert_median' : None, 'insert_std' : None}
+    else:
+        stats,taxonomy = process_bbmap_sam(files['bbmap_sam'], out_files['sam_map'], paired=paired,
+                                           levels=levels, tophit=args.tophit, trie=trie)
+        log = read_bbmap_log(files['bbmap_log'])
+    if not log['reads']:
+        raise ValueError('No reads were detected! Possible reasons: Coverage in library too low; '
+                         'option --read-limit too low; input is not a (meta)genome/transcriptome dataset.')
+    summary = stats.summary(log['reads'])
+    logging.info(f'  Mapping rate: {summary["ssu_tot_pair_ratio_pc"]}%')
+    with open(out_files['mapratio_csv'], 'w') as outF:
+        outF.write('\n'.join(f'{k},{v}' for k,v in summary.pop('mapratio')))
+    counts = taxonomy.counts()
+    write_ntu_csv(counts[tax_level], out_files['ntu_csv'])
+    if args.tophit:
+        out_files.pop('ntu_full_csv')
+    else:
+        write_ntu_csv(counts[7], out_files['ntu_full_csv'])
+    chao1,*xtons = diversity_stats(counts[tax_level])
+    skip_assembly = stats.low_coverage(length)
+    if skip_assembly:
+        logging.info('  WARNING: mapping coverage lower than 1x; reconstruction with SPAdes disabled')
+    summary.update({'insert_median' : log['insert_median'], 'insert_std' : log['insert_std'],
+                    'chao1' : chao1, 'xtons' : xtons, 'read_length' : length,
+                    'skip_assembly' : skip_assembly, 'files' : out_files})
+    return summary
+
+def spades_assemble(args, files: dict, summary: dict, threads=1, memory=20):
+    """
+    Assemble full-length SSU sequences from the mapped reads with SPAdes.
+    A failed assembly is not an error (e.g. too low or uneven coverage).
+    files: dict, output files of the map stage
+    Return: str, SPAdes output directory; or None if skipped or failed
+    """
+    if args.skip_spades or summary['skip_assembly']:
+        return None
+    out_files = sample_files(args)
+    logging.info(f'Creating phylotypes of {args.lib} with SPAdes...')
+    exe = 'spades.py'
+    which(exe)
+    cmd = [exe, '-o', out_files['spades_dir'], '-t', min(threads, SPADES_MAX_THREADS), '-m', memory]
+    if summary['read_length'] >= 134:
+        cmd += ['-k', '99,111,127']
+    else:
+        rl = summary['read_length'] - summary['read_length'] % 2
+        cmd += ['-k', f'{rl - 27},{rl - 17},{rl - 7}']
+    if args.sc:
+        cmd.append('--sc')
+    if args.read2 is not None or args.interleaved:
+        cmd += ['-1', files['reads_mapped_f'], '-2', files['reads_mapped_r']]
+    else:
+        cmd += ['-s', files['reads_mapped_f']]
+    try:
+        run(cmd, log_file=out_files['spades_log'], append=False)
+    except ValueError:
+        logging.info('  SPAdes exited with error, this may happen if no sequences were assembled. '
+                     'Possible causes include coverage per sequence too low or uneven')
+        return None
+    return out_files['spades_dir']
+
+def sample_stages(args, prefix='', budgets=None) -> list:
+    """
+    Pipeline stages of one library (see scheduler.run_stages). Each stage
+    is given only its own options (see stage_args), so that on rerun with
+    checkpoints only the stages affected by changed options are run again.
+    prefix: str, prefix of the stage names (to run several libraries together)
+    budgets: dict, {stage : (threads, memory)}; fixed per-stage budgets for the
+      'map' and 'assemble' stages (default: a share of the total budget)
+    """
+    budgets = budgets if budgets is not None else {}
+    map_threads,map_memory = budgets.get('map', (True, True))
+    asm_threads,asm_memory = budgets.get('assemble', (True, True))
+    scattered = args.scatter > 1
+    if args.sortmerna:
+        if scattered:
+            raise ValueError('--scatter is only supported for mapping with bbmap, not with --sortmerna')
+        map_func,map_tools = sortmerna_map,['reformat.sh', 'sortmerna']
+    else:
+        map_func,map_tools = bbmap_map,['bbmap.sh'] + (['partition.sh'] if scattered else [])
+    stages = [
+        # Detect the read length
+        Stage(f'{prefix}reads', partial(read_length, stage_args(args, 'reads'))),
+        # Map reads to the SSU database
+        Stage(f'{prefix}map', partial(map_func, stage_args(args, 'map')),
+              threads=map_threads, memory=map_memory, tools=map_tools),
+        # Fix the SAM file and summarize mapping statistics and taxonomy
+        Stage(f'{prefix}classify', partial(classify, stage_args(args, 'classify')),
+              deps=[f'{prefix}map', f'{prefix}reads'], threads=1),
+        # Assemble full-length SSU sequences
+        Stage(f'{prefix}assemble', partial(spades_assemble, stage_args(args, 'assemble')),
+              deps=[f'{prefix}map', f'{prefix}classify'],
+              threads=asm_threads, memory=asm_memory, tools=['spades.py'])
+    ]
+    if args.poscov:
+        # Positional coverage of the SSU reads along the SSU models
+        stages.append(Stage(f'{prefix}poscov', partial(nhmmer_model_pos, stage_args(args, 'poscov')),
+                            deps=[f'{prefix}map'], threads=True, tools=[NHMMER_EXE]))
+    return stages
+
+def main(args):
+    # environment and database
+    check_environment(args)
+    set_timeout(args.timeout * 60 if args.timeout else None)
+    
+    # stages unchanged since a previous run (same options, inputs and tools) are skipped
+    checkpoints = Checkpoints(f'{args.lib}.checkpoints', resume=not args.force)
     
-    
\ No newline at end of file
+    # run the pipeline stages; resource usage is written to <lib>.profile.{json,tsv}
+    profile = start_profile()
+    try:
+        run_stages(sample_stages(args), threads=args.threads, memory=args.memory,
+                   checkpoints=checkpoints)
+    finally:
+        write_profile(profile, f'{args.lib}.profile')
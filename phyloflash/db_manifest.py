@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# import
+## batteries
+import os
+import re
+import json
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+## package
+from phyloflash.checkpoint import list_files, file_record
+
+# manifest of a database directory, written by make-db
+MANIFEST_NAME = 'phyloFlash_db.manifest.json'
+MANIFEST_VERSION = 1
+# SILVA release in export file names (SILVA_138.1_SSURef...) or download paths (release_138_1)
+SILVA_FILE_VERSION = re.compile(r'SILVA_(\d+(?:\.\d+)?)_')
+SILVA_PATH_VERSION = re.compile(r'release_(\d+)(?:_(\d+))?')
+
+
+def manifest_path(db_home: str) -> str:
+    return os.path.join(db_home, MANIFEST_NAME)
+
+def silva_version(silva_url: str):
+    """
+    SILVA release of a SILVA export URL or file, e.g. "138.1", or None
+    """
+    m = SILVA_FILE_VERSION.search(os.path.basename(silva_url))
+    if m:
+        return m.group(1)
+    m = SILVA_PATH_VERSION.search(silva_url)
+    if m:
+        return m.group(1) + (f'.{m.group(2)}' if m.group(2) else '')
+    return None
+
+def hash_files(files: list, known=None, threads=1) -> dict:
+    """
+    file_record of each file, hashed in parallel (hashlib releases the GIL).
+    Files whose size and mtime match their `known` record are not re-hashed.
+    Return: dict, {file : record}
+    """
+    known = known or {}
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as pool:
+        records = pool.map(lambda x: file_record(x, known.get(x)), files)
+        return dict(zip(files, records))
+
+def load_manifest(db_home: str):
+    """
+    Database manifest, or None if there is none (e.g. a database built
+    by phyloFlash.pl) or it cannot be read
+    """
+    try:
+        with open(manifest_path(db_home)) as inF:
+            return json.load(inF)
+    except (OSError, ValueError):
+        return None
+
+def save_manifest(db_home: str, manifest: dict) -> str:
+    """
+    Write a manifest atomically, so that concurrent readers never see a partial file
+    """
+    out_file = manifest_path(db_home)
+    tmp_file = f'{out_file}.{os.getpid()}.tmp'
+    with open(tmp_file, 'w') as outF:
+        json.dump(manifest, outF, indent=1)
+    os.replace(tmp_file, out_file)
+    return out_file
+
+def write_manifest(db_home: str, paths: list, silva_url=None, known=None, threads=1) -> str:
+    """
+    List the files of a database with their size, mtime and sha256 hash
+    db_home: str, database directory
+    paths: list, database files/directories (within db_home)
+    silva_url: str, SILVA export the database was built from
+    known: dict, {file : file_record} of already hashed files (e.g. from the
+      checkpoint manifests of make-db); reused if size and mtime are unchanged
+    threads: int, number of files hashed in parallel
+    Return: str, manifest file
+    """
+    logging.info(f'Writing database manifest {manifest_path(db_home)}...')
+    files = sorted({x for p in paths for x in list_files(p)})
+    records = hash_files(files, known, threads)
+    manifest = {
+        'version' : MANIFEST_VERSION,
+        'silva_url' : silva_url,
+        'silva_version' : silva_version(silva_url) if silva_url else None,
+        'created' : time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'files' : {os.path.relpath(k, db_home) : v for k,v in records.items()}
+    }
+    return save_manifest(db_home, manifest)
+
+def verify_database(db_home: str, required: list, threads=1):
+    """
+    Check a database directory against its manifest. The fast path only
+    stats the listed files; files whose size or mtime changed (e.g. after
+    copying the database) are re-hashed in parallel, and the manifest is
+    updated if their contents are unchanged (and it is writable). Without
+    a manifest, only the presence of the `required` files is checked.
+    db_home: str, database directory
+    required: list, files needed by the run (relative to db_home)
+    threads: int, number of files re-hashed in parallel
+    Return: dict, manifest; or None if there is none
+    """
+    missing = [x for x in required if not os.path.exists(os.path.join(db_home, x))]
+    if missing:
+        raise OSError(f'Database {db_home} lacks the file(s): {", ".join(missing)}')
+    manifest = load_manifest(db_home)
+    if manifest is None:
+        logging.info(f'  No manifest ({MANIFEST_NAME}) in {db_home}; only checked that the '
+                     'database files are present')
+        return None
+    changed = []
+    for rel,record in manifest['files'].items():
+        try:
+            st = os.stat(os.path.join(db_home, rel))
+        except FileNotFoundError:
+            raise OSError(f'Database file {rel} listed in {manifest_path(db_home)} is missing')
+        if st.st_size != record['size']:
+            raise ValueError(f'Database file {rel} differs from {manifest_path(db_home)} (size); '
+                             'rebuild the database with make-db')
+        if st.st_mtime_ns != record['mtime_ns']:
+            changed.append(rel)
+    if changed:
+        logging.info(f'  Re-hashing {len(changed)} database files with changed modification times...')
+        records = hash_files([os.path.join(db_home, x) for x in changed], threads=threads)
+        for rel in changed:
+            record = records[os.path.join(db_home, rel)]
+            if record['sha256'] != manifest['files'][rel]['sha256']:
+                raise ValueError(f'Database file {rel} differs from {manifest_path(db_home)} '
+                                 '(content); rebuild the database with make-db')
+            manifest['files'][rel] = record
+        try:
+            save_manifest(db_home, manifest)
+        except OSError:
+            # e.g. a read-only shared database; the next run re-hashes again
+            pass
+    return manifest
@@ -0,0 +1,337 @@
+#!/usr/bin/env python
+# import
+## batteries
+import io
+import os
+import json
+import time
+import fcntl
+import shutil
+import hashlib
+import logging
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+# Size of the ranges fetched in parallel
+CHUNK_SIZE = 1 << 24
+# Block size for reading responses and hashing files
+BLOCKSIZE = 1 << 20
+# Checksum algorithm by hex digest length
+HASH_BY_LENGTH = {32 : 'md5', 40 : 'sha1', 64 : 'sha256', 128 : 'sha512'}
+# Published checksum files tried next to a download URL
+CHECKSUM_SUFFIXES = ['.md5', '.sha256']
+TIMEOUT = 600
+# URL schemes that are streamed rather than opened as local files
+URL_SCHEMES = ('http', 'https', 'ftp')
+# remote file version recorded next to each download (see same_version)
+SOURCE_SUFFIX = '.source.json'
+
+
+def file_digest(file_path: str, algorithm='md5') -> str:
+    """
+    Hex digest of a file's contents
+    """
+    h = hashlib.new(algorithm)
+    with open(file_path, 'rb') as inF:
+        for block in iter(lambda: inF.read(BLOCKSIZE), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def parse_checksum(text: str):
+    """
+    Parse a checksum, either "<algorithm>:<hex digest>" or the contents of a
+    published checksum file ("<hex digest>  <file name>"; the algorithm is
+    inferred from the digest length).
+    Return: (algorithm, hex digest), or None if the text holds no checksum
+    """
+    text = text.strip()
+    if not text:
+        return None
+    algorithm,sep,digest = text.partition(':')
+    if sep and algorithm.lower() in hashlib.algorithms_available:
+        return algorithm.lower(), digest.strip().lower()
+    digest = text.split()[0].lower()
+    try:
+        int(digest, 16)
+    except ValueError:
+        return None
+    algorithm = HASH_BY_LENGTH.get(len(digest))
+    if algorithm is None:
+        return None
+    return algorithm, digest
+
+def published_checksum(url: str):
+    """
+    Fetch the checksum published next to `url` (e.g. <url>.md5), as the
+    Perl file_download did.
+    Return: (algorithm, hex digest), or None if no checksum file exists
+    """
+    for suffix in CHECKSUM_SUFFIXES:
+        try:
+            with urllib.request.urlopen(url + suffix, timeout=TIMEOUT) as resp:
+                checksum = parse_checksum(resp.read(4096).decode(errors='replace'))
+        except (urllib.error.URLError, OSError, ValueError):
+            continue
+        if checksum is not None:
+            return checksum
+    return None
+
+def is_url(path: str) -> bool:
+    """
+    Whether `path` is a remote URL (see URL_SCHEMES) rather than a local file
+    """
+    return urllib.parse.urlparse(path).scheme in URL_SCHEMES
+
+def open_url(url: str, blocksize=BLOCKSIZE):
+    """
+    Open a remote file for streaming, without downloading it first.
+    Closing the stream early closes the connection.
+    Return: buffered binary file object (supports peek)
+    """
+    resp = urllib.request.urlopen(url, timeout=TIMEOUT)
+    return io.BufferedReader(resp, buffer_size=blocksize)
+
+def remote_info(url: str) -> dict:
+    """
+    Size, range support and version tags of a remote file (HEAD request)
+    """
+    info = {'size' : None, 'ranges' : False, 'etag' : None, 'last_modified' : None}
+    if urllib.parse.urlparse(url).scheme not in ('http', 'https'):
+        return info
+    req = urllib.request.Request(url, method='HEAD')
+    try:
+        with urllib.request.urlopen(req, timeout=TIMEOUT) as resp:
+            headers = resp.headers
+    except (urllib.error.URLError, OSError):
+        return info
+    size = headers.get('Content-Length')
+    info['size'] = int(size) if size is not None and size.isdigit() else None
+    info['ranges'] = headers.get('Accept-Ranges', '').lower() == 'bytes'
+    info['etag'] = headers.get('ETag')
+    info['last_modified'] = headers.get('Last-Modified')
+    return info
+
+def mirror_path(mirror_dir: str, url: str) -> str:
+    """
+    Location of a URL in the local mirror: <mirror_dir>/<host>/<path>
+    """
+    parts = urllib.parse.urlparse(url)
+    path = [urllib.parse.unquote(x) for x in parts.path.split('/') if x not in ('', '.', '..')]
+    host = parts.netloc.replace(':', '_') or 'local'
+    return os.path.join(mirror_dir, host, *path)
+
+def verify(file_path: str, size=None, checksum=None) -> bool:
+    """
+    Check a local file against the expected size and checksum (if known)
+    """
+    if not os.path.isfile(file_path):
+        return False
+    if size is not None and os.path.getsize(file_path) != size:
+        logging.info(f'  Size mismatch for {file_path}: {os.path.getsize(file_path)} != {size}')
+        return False
+    if checksum is not None:
+        algorithm,digest = checksum
+        local = file_digest(file_path, algorithm)
+        if local != digest:
+            logging.info(f'  {algorithm.upper()} mismatch for {file_path}: {local} != {digest}')
+            return False
+    return True
+
+def write_source(out_file: str, url: str, info: dict) -> None:
+    """
+    Record the URL and remote version (see remote_info) a file was downloaded from
+    """
+    source = {'url' : url, 'size' : info['size'], 'etag' : info['etag'],
+              'last_modified' : info['last_modified']}
+    tmp_file = out_file + SOURCE_SUFFIX + '.tmp'
+    with open(tmp_file, 'w') as outF:
+        json.dump(source, outF)
+    os.replace(tmp_file, out_file + SOURCE_SUFFIX)
+
+def same_version(out_file: str, url: str, info: dict) -> bool:
+    """
+    Whether an existing download is of the current version of `url`: the
+    server must report an ETag or Last-Modified date, equal to the one
+    recorded when the file was downloaded (see write_source)
+    """
+    if info['etag'] is None and info['last_modified'] is None:
+        return False
+    try:
+        with open(out_file + SOURCE_SUFFIX) as inF:
+            source = json.load(inF)
+    except (OSError, ValueError):
+        return False
+    return (source.get('url') == url and source.get('etag') == info['etag'] and
+            source.get('last_modified') == info['last_modified'])
+
+
+class _PartState(object):
+    """
+    Chunks of a partial download that have been completed, persisted
+    next to the partial file so that an interrupted download can resume.
+    """
+    def __init__(self, state_file: str, key: dict):
+        self.state_file = state_file
+        self.key = key
+        self.done = set()
+        self.lock = threading.Lock()
+        try:
+            with open(state_file) as inF:
+                state = json.load(inF)
+            if state.get('key') == key:
+                self.done = set(state['done'])
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def add(self, chunk: int) -> None:
+        with self.lock:
+            self.done.add(chunk)
+            tmp_file = self.state_file + '.tmp'
+            with open(tmp_file, 'w') as outF:
+                json.dump({'key' : self.key, 'done' : sorted(self.done)}, outF)
+            os.replace(tmp_file, self.state_file)
+
+def _fetch_range(url: str, part_file: str, start: int, end: int) -> None:
+    """
+    Fetch bytes start..end (inclusive) of `url` into the same offsets of `part_file`
+    """
+    req = urllib.request.Request(url, headers={'Range' : f'bytes={start}-{end}'})
+    with urllib.request.urlopen(req, timeout=TIMEOUT) as resp:
+        if resp.status != 206:
+            raise ValueError(f'Server did not honour range request for {url} (HTTP {resp.status})')
+        fd = os.open(part_file, os.O_WRONLY)
+        try:
+            pos = start
+            for block in iter(lambda: resp.read(BLOCKSIZE), b''):
+                os.pwrite(fd, block, pos)
+                pos += len(block)
+        finally:
+            os.close(fd)
+    if pos != end + 1:
+        raise ValueError(f'Incomplete range {start}-{end} from {url}: got {pos - start} bytes')
+
+def _fetch_ranges(url: str, part_file: str, info: dict, connections: int, chunk_size: int) -> None:
+    """
+    Parallel ranged download into a preallocated partial file, resuming
+    from the chunks recorded in <part_file>.json
+    """
+    size = info['size']
+    key = {'url' : url, 'size' : size, 'etag' : info['etag'],
+           'last_modified' : info['last_modified'], 'chunk_size' : chunk_size}
+    state = _PartState(part_file + '.json', key)
+    if not state.done or not os.path.isfile(part_file) or os.path.getsize(part_file) != size:
+        state.done = set()
+        with open(part_file, 'wb') as outF:
+            outF.truncate(size)
+    chunks = [i for i in range((size + chunk_size - 1) // chunk_size) if i not in state.done]
+    if state.done:
+        logging.info(f'  Resuming download: {len(state.done)} of {len(state.done) + len(chunks)} chunks done')
+    def fetch(i):
+        start = i * chunk_size
+        _fetch_range(url, part_file, start, min(size, start + chunk_size) - 1)
+        state.add(i)
+    with ThreadPoolExecutor(max_workers=max(1, connections)) as pool:
+        for future in [pool.submit(fetch, i) for i in chunks]:
+            future.result()
+    os.remove(state.state_file)
+
+def _fetch_stream(url: str, part_file: str, info: dict) -> None:
+    """
+    Single-connection download; continues an existing partial file if the
+    server supports ranges
+    """
+    start = 0
+    headers = {}
+    if info['ranges'] and os.path.isfile(part_file):
+        start = os.path.getsize(part_file)
+        if info['size'] is not None and start >= info['size']:
+            start = 0
+        elif start > 0:
+            headers['Range'] = f'bytes={start}-'
+    req = urllib.request.Request(url, headers=headers)
+    with urllib.request.urlopen(req, timeout=TIMEOUT) as resp:
+        if start > 0 and getattr(resp, 'status', 200) == 206:
+            logging.info(f'  Resuming download at byte {start}')
+            mode = 'ab'
+        else:
+            mode = 'wb'
+        with open(part_file, mode) as outF:
+            shutil.copyfileobj(resp, outF, BLOCKSIZE)
+
+def fetch(url: str, out_file: str, connections=4, chunk_size=CHUNK_SIZE, checksum=None) -> str:
+    """
+    Download `url` to `out_file`, unless a verified copy already exists:
+    one that matches the checksum, or, if there is none, was downloaded
+    from the same version of the remote file (see same_version). Large
+    files on servers that support ranges are fetched in chunks over
+    `connections` parallel connections. Partial downloads are kept as
+    <out_file>.part and resumed by the next call.
+    checksum: (algorithm, hex digest) to verify against; if None, the
+      checksum published next to the URL is used (if any)
+    Return: str, out_file
+    """
+    if checksum is None:
+        checksum = published_checksum(url)
+    info = remote_info(url)
+    if verify(out_file, info['size'], checksum):
+        if checksum is not None or same_version(out_file, url, info):
+            logging.info(f'  Verified existing {out_file}; skipping download')
+            return out_file
+        logging.info(f'  Cannot verify existing {out_file} against {url}; downloading again')
+    os.makedirs(os.path.dirname(os.path.abspath(out_file)), exist_ok=True)
+    part_file = out_file + '.part'
+    t0 = time.time()
+    if info['ranges'] and info['size'] is not None and info['size'] > chunk_size:
+        _fetch_ranges(url, part_file, info, connections, chunk_size)
+    else:
+        _fetch_stream(url, part_file, info)
+    if not verify(part_file, info['size'], checksum):
+        os.remove(part_file)
+        raise ValueError(f'Downloaded file from {url} failed verification')
+    os.replace(part_file, out_file)
+    write_source(out_file, url, info)
+    size = os.path.getsize(out_file)
+    logging.info(f'  Downloaded {size} bytes in {time.time() - t0:.1f} s' +
+                 (f' ({checksum[0].upper()} verified)' if checksum else ''))
+    return out_file
+
+def download(url: str, out_file: str, connections=4, checksum=None, mirror_dir=None,
+             chunk_size=CHUNK_SIZE) -> str:
+    """
+    Download a file, optionally through a local mirror directory shared by
+    several builds (e.g. on a cluster file system). With a mirror, the file
+    is fetched into the mirror once (under a lock) and then hard-linked, or
+    copied, to `out_file`.
+    url: str, URL to download
+    out_file: str, output file path
+    connections: int, number of parallel connections for ranged downloads
+    checksum: str, "<algorithm>:<hex digest>" to verify against (default: published checksum)
+    mirror_dir: str, local mirror directory
+    Return: str, out_file
+    """
+    if checksum is not None:
+        checksum = parse_checksum(checksum)
+    if mirror_dir is None:
+        return fetch(url, out_file, connections, chunk_size, checksum)
+    mirror_file = mirror_path(mirror_dir, url)
+    os.makedirs(os.path.dirname(mirror_file), exist_ok=True)
+    with open(mirror_file + '.lock', 'w') as lockF:
+        fcntl.flock(lockF, fcntl.LOCK_EX)
+        try:
+            fetch(url, mirror_file, connections, chunk_size, checksum)
+        finally:
+            fcntl.flock(lockF, fcntl.LOCK_UN)
+    if os.path.abspath(mirror_file) == os.path.abspath(out_file):
+        return out_file
+    os.makedirs(os.path.dirname(os.path.abspath(out_file)), exist_ok=True)
+    if os.path.exists(out_file):
+        os.remove(out_file)
+    try:
+        os.link(mirror_file, out_file)
+    except OSError:
+        shutil.copyfile(mirror_file, out_file)
+    logging.info(f'  Using mirrored copy {mirror_file}')
+    return out_file
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# import
+## batteries
+import io
+import os
+import csv
+import logging
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+## package
+from phyloflash import batch
+from phyloflash.download import TIMEOUT
+
+# ENA portal API report of the read runs of an accession (study, sample, experiment or run)
+ENA_PORTAL = 'https://www.ebi.ac.uk/ena/portal/api/filereport'
+RUN_FIELDS = ['run_accession', 'library_layout', 'read_count', 'base_count',
+              'fastq_ftp', 'fastq_md5', 'fastq_bytes']
+# run table columns
+RUN_COLUMNS = ['accession', 'run_accession', 'library_layout', 'read_count', 'read1', 'read2']
+# FASTQ files of the forward and reverse reads of a paired run; ENA may
+# list a third file of unpaired reads (<run>.fastq.gz)
+PAIR_SUFFIXES = ('_1.fastq.gz', '_2.fastq.gz')
+# number of accessions whose metadata is fetched concurrently
+METADATA_CONNECTIONS = 4
+
+
+def filereport_url(accession: str, portal=ENA_PORTAL) -> str:
+    query = urllib.parse.urlencode({'accession' : accession, 'result' : 'read_run',
+                                    'fields' : ','.join(RUN_FIELDS), 'format' : 'tsv'})
+    return f'{portal}?{query}'
+
+def fetch_runs(accession: str, portal=ENA_PORTAL) -> list:
+    """
+    Metadata of the read runs of an accession from the ENA portal API
+    Return: list of dicts (see RUN_FIELDS)
+    """
+    url = filereport_url(accession, portal)
+    try:
+        with urllib.request.urlopen(url, timeout=TIMEOUT) as resp:
+            text = resp.read().decode()
+    except (urllib.error.URLError, OSError) as e:
+        raise ValueError(f'Could not fetch the runs of {accession} from {portal}: {e}')
+    rows = list(csv.DictReader(io.StringIO(text), delimiter='\t'))
+    for row in rows:
+        row['accession'] = accession
+    return rows
+
+def fastq_url(path: str, protocol='https') -> str:
+    """
+    URL of a FASTQ file listed by ENA ("ftp.sra.ebi.ac.uk/vol1/fastq/...",
+    without scheme); full URLs are kept
+    """
+    return path if '://' in path else f'{protocol}://{path}'
+
+def run_sample(row: dict, protocol='https'):
+    """
+    Sample of one run (see batch.read_manifest), with the FASTQ URLs as reads
+    Return: dict, or None if ENA lists no FASTQ files
+    """
+    paths = [x for x in (row.get('fastq_ftp') or '').split(';') if x]
+    if not paths:
+        return None
+    pair = [next((x for x in paths if x.endswith(s)), None) for s in PAIR_SUFFIXES]
+    if (row.get('library_layout') or '').upper() == 'PAIRED' and all(pair):
+        read1,read2 = pair
+    else:
+        read1,read2 = paths[0],None
+    return {'lib' : row['run_accession'], 'read1' : fastq_url(read1, protocol),
+            'read2' : fastq_url(read2, protocol) if read2 is not None else None,
+            'interleaved' : False, 'read_length' : None}
+
+def ena_samples(accessions: list, portal=ENA_PORTAL, protocol='https') -> tuple:
+    """
+    Samples of the runs of several accessions, fetching their metadata
+    concurrently; runs listed under more than one accession are used once
+    Return: (list of sample dicts, list of run metadata dicts)
+    """
+    with ThreadPoolExecutor(max_workers=METADATA_CONNECTIONS) as pool:
+        reports = list(pool.map(lambda x: fetch_runs(x, portal), accessions))
+    samples,rows = [],[]
+    seen = set()
+    for accession,report in zip(accessions, reports):
+        if not report:
+            logging.warning(f'  No read runs found for {accession}')
+        for row in report:
+            if row['run_accession'] in seen:
+                continue
+            seen.add(row['run_accession'])
+            sample = run_sample(row, protocol)
+            if sample is None:
+                logging.warning(f'  No FASTQ files for run {row["run_accession"]}, skipping')
+                continue
+            row.update(read1=sample['read1'], read2=sample['read2'])
+            samples.append(sample)
+            rows.append(row)
+    return samples, rows
+
+def read_accessions(accession_file: str) -> list:
+    """
+    Accessions listed in a file, one per line (first column); "#" starts a comment
+    """
+    accessions = []
+    with open(accession_file) as inF:
+        for line in inF:
+            fields = line.split('#', 1)[0].split()
+            if fields:
+                accessions.append(fields[0])
+    return accessions
+
+def write_runs(rows: list, out_file: str) -> str:
+    """
+    Write the runs table: accession, run, layout, read count and read URLs
+    """
+    with open(out_file, 'w', newline='') as outF:
+        writer = csv.DictWriter(outF, RUN_COLUMNS, delimiter='\t', lineterminator='\n',
+                                extrasaction='ignore', restval='')
+        writer.writeheader()
+        writer.writerows(rows)
+    return out_file
+
+def main(args):
+    # accessions
+    accessions = list(args.accession)
+    if args.accession_file is not None:
+        accessions += read_accessions(args.accession_file)
+    if not accessions:
+        raise ValueError('No accessions given')
+
+    # runs and their FASTQ URLs
+    logging.info(f'Fetching the read runs of {len(accessions)} accessions from {args.portal_url}...')
+    samples,rows = ena_samples(accessions, args.portal_url, args.protocol)
+    logging.info(f'  Found {len(samples)} runs with FASTQ files')
+    if not samples:
+        return
+    os.makedirs(args.outdir, exist_ok=True)
+    runs_file = write_runs(rows, os.path.join(args.outdir, 'ena_runs.tsv'))
+    logging.info(f'  Runs table: {runs_file}')
+
+    # run the pipeline on all runs (see batch.run_samples); the reads are
+    # streamed into the mapping stage, up to --read-limit reads per run
+    batch.run_samples(args, samples)
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# import
+## batteries
+import os
+import gzip
+
+# Block size for reading/writing FASTA files
+BLOCKSIZE = 1 << 22
+# complement of DNA bases, including ambiguity codes
+COMPLEMENT = bytes.maketrans(b'ATCGatcgYRWSKMDVHByrwskmdvhb', b'TAGCtagcRYWSMKHBDVrywsmkhbdv')
+
+
+def open_fasta(fasta_file: str, blocksize=BLOCKSIZE):
+    """
+    Open a (possibly gzip-compressed) FASTA file for reading in binary mode.
+    Compression is detected from the file contents, not the extension.
+    """
+    inF = open(fasta_file, 'rb', buffering=blocksize)
+    if inF.peek(2)[:2] == b'\x1f\x8b':
+        return gzip.GzipFile(fileobj=inF, mode='rb')
+    return inF
+
+def parse_fasta_block(block: bytes):
+    """
+    Parse a block of complete FASTA records.
+    Return: generator of (header, sequence) tuples; header without ">";
+      sequence with line breaks removed
+    """
+    block = block.lstrip()
+    if not block:
+        return
+    if block.startswith(b'>'):
+        block = block[1:]
+    for rec in block.split(b'\n>'):
+        header,_,seq = rec.partition(b'\n')
+        seq = seq.replace(b'\n', b'')
+        if b'\r' in rec:
+            header = header.rstrip(b'\r')
+            seq = seq.replace(b'\r', b'')
+        yield header, seq
+
+def read_fasta(fasta_file: str, blocksize=BLOCKSIZE):
+    """
+    Stream records from a (possibly gzip-compressed) FASTA file.
+    The file is read (and decompressed) in large blocks rather than line by line.
+    fasta_file: str, FASTA file path
+    Return: generator of (header, sequence) tuples of bytes
+    """
+    with open_fasta(fasta_file, blocksize) as inF:
+        rest = b''
+        while True:
+            block = inF.read(blocksize)
+            if not block:
+                break
+            block = rest + block
+            # only parse up to the start of the last (maybe incomplete) record
+            idx = block.rfind(b'\n>')
+            if idx < 0:
+                rest = block
+                continue
+            rest = block[idx + 1:]
+            yield from parse_fasta_block(block[:idx])
+        yield from parse_fasta_block(rest)
+
+def accession(header: bytes) -> bytes:
+    """
+    Accession (first word) of a FASTA header
+    """
+    return header.split(None, 1)[0] if header else header
+
+def revcomp(seq: bytes) -> bytes:
+    """
+    Reverse complement of a DNA sequence
+    """
+    return seq[::-1].translate(COMPLEMENT)
+
+def write_fasta(records, out_file: str, blocksize=BLOCKSIZE) -> int:
+    """
+    Write FASTA records (one line per sequence), buffering output in large blocks.
+    records: iterable of (header, sequence) tuples of bytes
+    out_file: str, output file path
+    Return: int, number of records written
+    """
+    n = 0
+    with open(out_file, 'wb') as outF:
+        buf = []
+        size = 0
+        for header,seq in records:
+            buf += [b'>', header, b'\n', seq, b'\n']
+            size += len(header) + len(seq) + 3
+            n += 1
+            if size >= blocksize:
+                outF.write(b''.join(buf))
+                buf = []
+                size = 0
+        outF.write(b''.join(buf))
+    return n
+
+def transform_fasta(in_file, out_file: str, exclude=None, max_records=None,
+                    seq_func=None, record_func=None) -> int:
+    """
+    Single streaming pass over a (possibly gzip-compressed) FASTA file that
+    decompresses, filters, normalizes and writes the records.
+    in_file: str, input FASTA file; or an iterable of (header, sequence) records
+    out_file: str, output FASTA file
+    exclude: set, accessions (str or bytes) of records to drop
+    max_records: int, stop after this many records are written
+    seq_func: callable, called as seq_func(header, sequence) and returning the new sequence
+    record_func: callable, called with each written (header, sequence), e.g. SeqStoreWriter.add
+    Return: int, number of records written
+    """
+    if exclude is not None:
+        exclude = {x.encode() if isinstance(x, str) else x for x in exclude}
+    in_records = read_fasta(in_file) if isinstance(in_file, str) else in_file
+    def records():
+        n = 0
+        for header,seq in in_records:
+            if max_records is not None and n >= max_records:
+                break
+            if exclude and accession(header) in exclude:
+                continue
+            if seq_func is not None:
+                seq = seq_func(header, seq)
+            if record_func is not None:
+                record_func(header, seq)
+            n += 1
+            yield header, seq
+    return write_fasta(records(), out_file)
+
+def split_fasta(fasta_file: str, n_shards: int, out_prefix: str, blocksize=BLOCKSIZE) -> list:
+    """
+    Split a FASTA file into `n_shards` files with records distributed round-robin,
+    so that the shards are of similar size.
+    fasta_file: str, input FASTA file (may be gzip-compressed)
+    n_shards: int, number of shards
+    out_prefix: str, shard files are named {out_prefix}.{i}.fasta
+    Return: list, paths of the non-empty shard files
+    """
+    n_shards = max(1, n_shards)
+    out_files = [f'{out_prefix}.{i}.fasta' for i in range(n_shards)]
+    outFs = [open(x, 'wb') for x in out_files]
+    bufs = [[] for _ in out_files]
+    sizes = [0] * n_shards
+    counts = [0] * n_shards
+    try:
+        for i,(header,seq) in enumerate(read_fasta(fasta_file, blocksize)):
+            i = i % n_shards
+            bufs[i] += [b'>', header, b'\n', seq, b'\n']
+            sizes[i] += len(header) + len(seq) + 3
+            counts[i] += 1
+            if sizes[i] >= blocksize:
+                outFs[i].write(b''.join(bufs[i]))
+                bufs[i] = []
+                sizes[i] = 0
+        for outF,buf in zip(outFs, bufs):
+            outF.write(b''.join(buf))
+    finally:
+        for outF in outFs:
+            outF.close()
+    # remove empty shards
+    for out_file,n in zip(out_files, counts):
+        if n == 0:
+            os.remove(out_file)
+    return [x for x,n in zip(out_files, counts) if n > 0]
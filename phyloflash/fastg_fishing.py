@@ -0,0 +1,524 @@
+#!/usr/bin/env python
+# import
+## batteries
+import os
+import re
+import logging
+import tarfile
+from array import array
+## package
+from phyloflash.fasta import read_fasta, open_fasta, accession, revcomp
+from phyloflash.runner import run, stream
+from phyloflash.make_db import BARRNAP_EXE, which
+
+ASSEMBLERS = ('megahit', 'spades')
+# number of an edge of the assembly graph: SPAdes "EDGE_12_length_...", MEGAHIT "NODE_12_length_..."
+EDGE_NUMBER = re.compile(rb'^(?:EDGE|NODE)_(\d+)_')
+# number of the graph edge of a MEGAHIT contig: "k141_12 flag=1 multi=2.0 len=300"
+MEGAHIT_CONTIG = re.compile(rb'^k\d+_(\d+)')
+# SPAdes GFA path of a contig, numbered by gap-separated segment: "NODE_1_length_100_cov_2.5_1"
+SPADES_GFA_PATH = re.compile(rb'^(NODE_\d+_length_\d+_cov_[\d.]+)_\d+$')
+# assembled SSU sequences in a phyloFlash archive
+ZIP_NAME = re.compile(r'^(.+)\.phyloFlash\.tar\.gz$')
+
+
+def edge_key(name: bytes):
+    """
+    Key of a graph edge: its number for SPAdes/MEGAHIT edge names and numeric
+    GFA segment names (as referenced by contigs and paths), else the name.
+    A trailing "'" (reverse complement) is removed.
+    """
+    name = name.rstrip(b"'")
+    m = EDGE_NUMBER.match(name)
+    if m is not None:
+        return int(m.group(1))
+    if name.isdigit():
+        return int(name)
+    return name
+
+
+class UnionFind(object):
+    """
+    Disjoint sets of integer IDs (union by size, path halving), held in
+    two flat arrays; all components are found in near-linear time
+    """
+    def __init__(self):
+        self.parent = array('I')
+        self.size = array('I')
+
+    def __len__(self):
+        return len(self.parent)
+
+    def add(self) -> int:
+        """
+        Add a singleton set
+        Return: int, its ID
+        """
+        i = len(self.parent)
+        self.parent.append(i)
+        self.size.append(1)
+        return i
+
+    def find(self, i: int) -> int:
+        """
+        Representative (root) of the set of `i`
+        """
+        parent = self.parent
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def union(self, i: int, j: int) -> int:
+        """
+        Merge the sets of `i` and `j`
+        Return: int, root of the merged set
+        """
+        i,j = self.find(i),self.find(j)
+        if i == j:
+            return i
+        if self.size[i] < self.size[j]:
+            i,j = j,i
+        self.parent[j] = i
+        self.size[i] += self.size[j]
+        return i
+
+
+class AssemblyGraph(object):
+    """
+    Connectivity of an assembly graph: edges (FASTG records, or GFA
+    segments) are interned as integer IDs as the graph is read, and links
+    merge their components right away, so no adjacency lists are kept.
+    Contig paths through the graph (SPAdes GFA "P" lines) are kept by contig name.
+    """
+    def __init__(self):
+        self.ids = {}
+        self.components = UnionFind()
+        self.paths = {}
+        self.n_links = 0
+
+    def __len__(self):
+        return len(self.ids)
+
+    def edge(self, name: bytes) -> int:
+        """
+        ID of an edge, added if new
+        """
+        key = edge_key(name)
+        try:
+            return self.ids[key]
+        except KeyError:
+            i = self.components.add()
+            self.ids[key] = i
+            return i
+
+    def link(self, a: bytes, b: bytes) -> None:
+        self.components.union(self.edge(a), self.edge(b))
+        self.n_links += 1
+
+    def get(self, name):
+        """
+        ID of an edge (name or key), or None if not in the graph
+        """
+        return self.ids.get(edge_key(name) if isinstance(name, bytes) else name)
+
+    def component(self, i: int) -> int:
+        return self.components.find(i)
+
+def read_fastg(fastg_file: str, graph=None) -> AssemblyGraph:
+    """
+    Read the connectivity of a FASTG assembly graph (SPAdes, or MEGAHIT
+    contig2fastg) from its header lines: ">EDGE:NEXT1,NEXT2';". The
+    sequences are skipped.
+    """
+    graph = graph if graph is not None else AssemblyGraph()
+    with open_fasta(fastg_file) as inF:
+        for line in inF:
+            if not line.startswith(b'>'):
+                continue
+            name,_,links = line[1:].rstrip().rstrip(b';').partition(b':')
+            edge = graph.edge(name)
+            if links:
+                for other in links.split(b','):
+                    graph.components.union(edge, graph.edge(other))
+                    graph.n_links += 1
+    return graph
+
+def read_gfa(gfa_file: str, graph=None) -> AssemblyGraph:
+    """
+    Read the connectivity of a GFA assembly graph: segments ("S"),
+    links ("L") and contig paths ("P", SPAdes)
+    """
+    graph = graph if graph is not None else AssemblyGraph()
+    with open_fasta(gfa_file) as inF:
+        for line in inF:
+            kind = line[:2]
+            line = line.rstrip(b'\r\n')
+            if kind == b'S\t':
+                graph.edge(line.split(b'\t', 2)[1])
+            elif kind == b'L\t':
+                fields = line.split(b'\t', 4)
+                graph.link(fields[1], fields[3])
+            elif kind == b'P\t':
+                _,name,segments = line.split(b'\t', 3)[:3]
+                m = SPADES_GFA_PATH.match(name)
+                if m is not None:
+                    name = m.group(1)
+                graph.paths.setdefault(name, []).extend(
+                    edge_key(x[:-1]) for x in segments.split(b','))
+    return graph
+
+def read_graph(graph_file: str) -> AssemblyGraph:
+    """
+    Read a FASTG or GFA assembly graph (detected from the first line)
+    """
+    with open_fasta(graph_file) as inF:
+        first = inF.readline()
+    if first.startswith(b'>'):
+        graph = read_fastg(graph_file)
+    else:
+        graph = read_gfa(graph_file)
+    logging.info(f'  Read {len(graph)} edges and {graph.n_links} links from {graph_file}')
+    return graph
+
+def read_spades_paths(paths_file: str) -> dict:
+    """
+    Graph edges of each SPAdes contig from a contigs.paths/scaffolds.paths file.
+    Paths of the reverse complements ("NODE_...'") hold the same edges and are skipped.
+    Return: dict, {contig name : [edge key, ...]}
+    """
+    paths = {}
+    current = None
+    with open(paths_file, 'rb') as inF:
+        for line in inF:
+            line = line.strip()
+            if line.startswith(b'NODE_'):
+                current = None if line.endswith(b"'") else paths.setdefault(line, [])
+            elif line and current is not None:
+                current.extend(edge_key(x[:-1]) for x in line.rstrip(b';').split(b',') if x)
+    return paths
+
+def contig_edges(header: bytes, assembler: str, paths: dict) -> list:
+    """
+    Keys of the graph edges of a contig (see edge_key)
+    """
+    name = accession(header)
+    if assembler == 'megahit':
+        m = MEGAHIT_CONTIG.match(name)
+        return [int(m.group(1))] if m is not None else []
+    return paths.get(name, [])
+
+def run_barrnap(fasta_file: str, exe=BARRNAP_EXE, threads=1, reject=0.2) -> list:
+    """
+    Predict rRNA genes in the contigs with barrnap_HGV. Each GFF feature is
+    given an ID (<contig>_<n>) as its first attribute.
+    Return: list, GFF lines (str, without line ends)
+    """
+    logging.info(f'Running barrnap_HGV on {fasta_file}...')
+    which(exe)
+    cmd = [exe, '--quiet', '--threads', threads, '--reject', reject, fasta_file]
+    lines = []
+    counter = {}
+    for line in stream(cmd):
+        fields = line.decode().rstrip('\n').split('\t')
+        if len(fields) >= 9:
+            counter[fields[0]] = counter.get(fields[0], 0) + 1
+            fields[8] = f'ID={fields[0]}_{counter[fields[0]]};' + fields[8]
+        lines.append('\t'.join(fields))
+    return lines
+
+def ssu_hits(gff: list) -> dict:
+    """
+    SSU rRNA features of each contig from barrnap GFF lines
+    Return: dict, {contig : {feature ID : (start, end, strand)}}
+    """
+    hits = {}
+    for line in gff:
+        if line.startswith('#'):
+            continue
+        fields = line.split('\t')
+        if len(fields) >= 9 and 'Name=16S_rRNA' in fields[8]:
+            feature = re.search(r'ID=(.+?);', fields[8]).group(1)
+            hits.setdefault(fields[0], {})[feature] = (int(fields[3]), int(fields[4]), fields[6])
+    return hits
+
+
+class Contigs(object):
+    """
+    Name, length and graph component of each contig, in FASTA order.
+    Sequences are not kept; files are read again to write them.
+    """
+    def __init__(self):
+        self.headers = []
+        self.lengths = array('Q')
+        self.components = array('q')
+
+    def __len__(self):
+        return len(self.headers)
+
+def place_contigs(fasta_file: str, graph: AssemblyGraph, assembler: str, paths=None) -> Contigs:
+    """
+    Assign each contig to the graph component of its edges (the edges of
+    a contig are merged into one component). Contigs without edges in
+    the graph get component -1.
+    paths: dict, SPAdes contig paths (see read_spades_paths); default: the GFA paths
+    """
+    paths = paths if paths is not None else graph.paths
+    contigs = Contigs()
+    missing = 0
+    for header,seq in read_fasta(fasta_file):
+        ids = [graph.get(x) for x in contig_edges(header, assembler, paths)]
+        ids = [x for x in ids if x is not None]
+        if ids:
+            for i in ids[1:]:
+                graph.components.union(ids[0], i)
+        else:
+            missing += 1
+        contigs.headers.append(header)
+        contigs.lengths.append(len(seq))
+        contigs.components.append(ids[0] if ids else -1)
+    # roots only once all contig unions are done
+    for i,x in enumerate(contigs.components):
+        if x >= 0:
+            contigs.components[i] = graph.component(x)
+    if missing:
+        logging.warning(f'  {missing} of {len(contigs)} contigs have no edges in the assembly graph')
+    return contigs
+
+def bait_components(graph: AssemblyGraph, contigs: Contigs, edges=None, names=None) -> set:
+    """
+    Components containing the bait edges (keys or names) or contigs (names)
+    """
+    components = set()
+    for name in edges or []:
+        i = graph.get(name)
+        if i is not None:
+            components.add(graph.component(i))
+    names = set(names or [])
+    for header,x in zip(contigs.headers, contigs.components):
+        if x >= 0 and accession(header) in names:
+            components.add(x)
+    return components
+
+def read_list(list_file: str) -> list:
+    """
+    Names (first word of each line) from a list file
+    """
+    with open(list_file, 'rb') as inF:
+        return [x.split()[0] for x in inF if x.strip()]
+
+def cluster_stats(contigs: Contigs, hits=None, components=None) -> list:
+    """
+    Total length, number of contigs and SSU features of each cluster of
+    connected contigs, sorted by decreasing length; clusters are named
+    bin0, bin1, ... in this order.
+    hits: dict, SSU features by contig (see ssu_hits)
+    components: set, only report these components (default: all)
+    Return: list of dicts
+    """
+    hits = hits if hits is not None else {}
+    clusters = {}
+    for i,(header,x) in enumerate(zip(contigs.headers, contigs.components)):
+        if x < 0 or (components is not None and x not in components):
+            continue
+        clust = clusters.get(x)
+        if clust is None:
+            clust = clusters[x] = {'component' : x, 'length' : 0, 'contigs' : [], 'ssu' : []}
+        clust['length'] += contigs.lengths[i]
+        clust['contigs'].append(i)
+        clust['ssu'] += sorted(hits.get(accession(header).decode(), {}))
+    clusters = sorted(clusters.values(), key=lambda x: (-x['length'], x['contigs'][0]))
+    for i,clust in enumerate(clusters):
+        clust['bin'] = f'bin{i}'
+    return clusters
+
+def write_cluster_stats(clusters: list, out_file: str, cutoff: int, ssu=True) -> str:
+    with open(out_file, 'w') as outF:
+        outF.write('#' + '\t'.join(['bin', 'length', 'contigs'] + (['num_ssu'] if ssu else [])) + '\n')
+        for clust in clusters:
+            if clust['length'] > cutoff:
+                row = [clust['bin'], clust['length'], len(clust['contigs'])]
+                if ssu:
+                    row.append(len(clust['ssu']))
+                outF.write('\t'.join(str(x) for x in row) + '\n')
+    return out_file
+
+def write_ssu_summary(clusters: list, out_file: str, cutoff: int) -> str:
+    """
+    Table of the SSU features found and their bin
+    """
+    rows = []
+    for clust in clusters:
+        note = 'Below length cutoff' if clust['length'] < cutoff else ''
+        rows += [(x, clust['bin'], note) for x in clust['ssu']]
+    with open(out_file, 'w') as outF:
+        outF.write('#ssu_id\tbin\tnote\n')
+        for row in sorted(rows):
+            outF.write('\t'.join(row) + '\n')
+    return out_file
+
+def write_nodes_to_cluster(clusters: list, contigs: Contigs, out_file: str, cutoff: int) -> str:
+    """
+    Table of bin and contig (FASTA header) of the clusters above the length cutoff
+    """
+    with open(out_file, 'wb') as outF:
+        for clust in clusters:
+            if clust['length'] > cutoff:
+                for header in sorted(contigs.headers[i] for i in clust['contigs']):
+                    outF.write(clust['bin'].encode() + b'\t' + header + b'\n')
+    return out_file
+
+def write_bin_fastas(clusters: list, contigs: Contigs, fasta_file: str, prefix: str,
+                     cutoff: int) -> list:
+    """
+    Write the contigs of each cluster above the length cutoff to <prefix>.<bin>.fasta,
+    in one pass over the contigs
+    Return: list, FASTA files
+    """
+    bins = {}
+    for clust in clusters:
+        if clust['length'] > cutoff:
+            for i in clust['contigs']:
+                bins[i] = clust['bin']
+    files = {}
+    try:
+        for i,(header,seq) in enumerate(read_fasta(fasta_file)):
+            name = bins.get(i)
+            if name is None:
+                continue
+            if name not in files:
+                files[name] = open(f'{prefix}.{name}.fasta', 'wb')
+            files[name].write(b'>' + header + b'\n' + seq + b'\n')
+    finally:
+        for outF in files.values():
+            outF.close()
+    return [f'{prefix}.{x}.fasta' for x in files]
+
+def write_ssu_fasta(hits: dict, fasta_file: str, out_file: str) -> str:
+    """
+    Write the sequences of the SSU features found by barrnap, cut from the contigs
+    """
+    with open(out_file, 'wb') as outF:
+        for header,seq in read_fasta(fasta_file):
+            features = hits.get(accession(header).decode())
+            if not features:
+                continue
+            for feature,(start,end,strand) in sorted(features.items()):
+                ssu = seq[start - 1 : end]
+                if strand == '-':
+                    ssu = revcomp(ssu)
+                outF.write(b'>' + feature.encode() + b'\n' + ssu + b'\n')
+    return out_file
+
+def ssu_from_zip(zip_file: str, out_dir: str):
+    """
+    Extract the assembled SSU sequences (<lib>.all.final.fasta) from a
+    phyloFlash archive (<lib>.phyloFlash.tar.gz)
+    Return: str, extracted FASTA file, or None if not found
+    """
+    m = ZIP_NAME.match(os.path.basename(zip_file))
+    if m is None:
+        logging.warning(f'Filename of {zip_file} does not match the name of a phyloFlash tar.gz archive')
+        return None
+    name = f'{m.group(1)}.all.final.fasta'
+    with tarfile.open(zip_file, 'r:gz') as tar:
+        try:
+            member = tar.getmember(name)
+        except KeyError:
+            logging.warning(f'{name} not found in {zip_file}. Perhaps the archive was renamed, '
+                            'or no SSU was assembled?')
+            return None
+        tar.extract(member, out_dir)
+    return os.path.join(out_dir, name)
+
+def compare_ssu(ssu_file: str, barrnap_fasta: str, prefix: str, threads=1) -> None:
+    """
+    Compare SSU sequences (e.g. assembled by phyloFlash) to those found in
+    the contigs: best vsearch hits, and a mafft alignment and guide tree of both
+    """
+    which('vsearch')
+    run(['vsearch', '--usearch_global', barrnap_fasta, '--db', ssu_file, '--id', 0.95,
+         '--maxhits', 1, '--threads', threads, '--quiet',
+         '--alnout', f'{prefix}.compare-ssu.alnout', '--samout', f'{prefix}.compare-ssu.samout'])
+    which('mafft')
+    concat = f'{prefix}.compare-ssu_concat.fasta'
+    with open(concat, 'wb') as outF:
+        for in_file in (ssu_file, barrnap_fasta):
+            with open(in_file, 'rb') as inF:
+                outF.write(inF.read())
+    run(['mafft', '--quiet', '--treeout', concat], stdout=f'{concat}.mafft')
+
+def main(args):
+    if args.assembler not in ASSEMBLERS:
+        raise ValueError(f'Assembler must be one of: {", ".join(ASSEMBLERS)}')
+    out_dir = os.path.dirname(os.path.abspath(args.out))
+    os.makedirs(out_dir, exist_ok=True)
+
+    # SSU rRNA in the contigs
+    gff,hits = None,None
+    if not args.clusteronly:
+        gff = run_barrnap(args.fasta, args.barrnap_path or BARRNAP_EXE, args.threads,
+                          args.min_ssu_frac)
+        hits = ssu_hits(gff)
+        logging.info(f'Number of contigs containing SSU rRNA above {args.min_ssu_frac} of '
+                     f'full-length found: {len(hits)}')
+
+    # graph components, and the component of each contig
+    logging.info(f'Reading contig graph from {args.fastg}')
+    graph = read_graph(args.fastg)
+    paths = None
+    if args.assembler == 'megahit':
+        if args.paths is not None:
+            logging.warning('Ignoring paths file, not part of MEGAHIT output')
+    elif args.paths is not None:
+        paths = read_spades_paths(args.paths)
+    elif not graph.paths:
+        raise ValueError('Please specify the SPAdes paths file (--paths), or a GFA graph with paths')
+    contigs = place_contigs(args.fasta, graph, args.assembler, paths)
+
+    # clusters containing the bait
+    if args.list_fastg is not None:
+        logging.info(f'Using clusters of the graph edges listed in {args.list_fastg}')
+        components = bait_components(graph, contigs, edges=read_list(args.list_fastg))
+    elif args.list_fasta is not None:
+        logging.info(f'Using clusters of the contigs listed in {args.list_fasta}')
+        components = bait_components(graph, contigs, names=read_list(args.list_fasta))
+    elif hits is not None:
+        logging.info('Using clusters of the contigs with SSU rRNA found by barrnap')
+        components = bait_components(graph, contigs, names=[x.encode() for x in hits])
+    else:
+        logging.info('Reporting all clusters of connected contigs')
+        components = None
+    clusters = cluster_stats(contigs, hits, components)
+    n_bins = sum(1 for x in clusters if x['length'] > args.cutoff)
+    logging.info(f'Found {len(clusters)} clusters, {n_bins} longer than {args.cutoff} bp')
+
+    # output
+    out_file = write_cluster_stats(clusters, f'{args.out}.cluster_stats.tab', args.cutoff,
+                                   ssu=not args.clusteronly)
+    logging.info(f'Contig cluster summary written to {out_file}')
+    if hits is not None:
+        out_file = write_ssu_summary(clusters, f'{args.out}.cluster_ssu_summary.tab', args.cutoff)
+        logging.info(f'Table of SSU rRNA vs. bins written to {out_file}')
+    out_file = write_nodes_to_cluster(clusters, contigs, f'{args.out}.nodes_to_cluster.tab',
+                                      args.cutoff)
+    logging.info(f'Contigs per cluster written to {out_file}')
+    if args.outfasta:
+        fasta_files = write_bin_fastas(clusters, contigs, args.fasta, args.out, args.cutoff)
+        logging.info(f'Contigs of {len(fasta_files)} bins written to {args.out}.binXX.fasta')
+    if gff is None:
+        return
+    with open(f'{args.out}.barrnap.gff', 'w') as outF:
+        outF.write(''.join(x + '\n' for x in gff))
+    logging.info(f'barrnap GFF written to {args.out}.barrnap.gff')
+    if not (args.outfasta or args.compare_ssu or args.compare_zip):
+        return
+    barrnap_fasta = write_ssu_fasta(hits, args.fasta, f'{args.out}.barrnap_SSU.fasta')
+    logging.info(f'Sequences of the SSU rRNA found written to {barrnap_fasta}')
+    ssu_file = args.compare_ssu
+    if args.compare_zip is not None:
+        logging.info(f'Using assembled SSU rRNA from phyloFlash archive {args.compare_zip}')
+        ssu_file = ssu_from_zip(args.compare_zip, out_dir)
+    if ssu_file is not None:
+        logging.info(f'Comparing SSU rRNA from the assembly to the sequences in {ssu_file}')
+        compare_ssu(ssu_file, barrnap_fasta, args.out, args.threads)
@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+# import
+## batteries
+import sys
+import gzip
+import queue
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+## package
+from phyloflash.download import is_url, open_url
+
+# Block size for reading (and decompressing) FASTQ files
+BLOCKSIZE = 1 << 22
+# Number of blocks read ahead of the parser
+READ_AHEAD = 4
+# Bases counted for the base composition
+BASES = b'ACGTN'
+
+
+def open_fastq(fastq_file: str, blocksize=BLOCKSIZE):
+    """
+    Open a (possibly gzip-compressed) FASTQ file for reading in binary mode;
+    "-" reads from stdin, and URLs are streamed (see download.open_url).
+    Compression is detected from the contents.
+    """
+    if fastq_file == '-':
+        inF = sys.stdin.buffer
+    elif is_url(fastq_file):
+        inF = open_url(fastq_file, blocksize)
+    else:
+        inF = open(fastq_file, 'rb', buffering=blocksize)
+    if inF.peek(2)[:2] == b'\x1f\x8b':
+        return gzip.GzipFile(fileobj=inF, mode='rb')
+    return inF
+
+def read_blocks(fastq_file: str, blocksize=BLOCKSIZE):
+    """
+    Read (and decompress) a file in blocks on a background thread, a few
+    blocks ahead of the consumer. zlib releases the GIL, so decompression
+    overlaps with parsing. Closing the generator early stops the thread.
+    Return: generator of blocks (bytes)
+    """
+    blocks = queue.Queue(maxsize=READ_AHEAD)
+    stop = threading.Event()
+    def reader():
+        try:
+            inF = open_fastq(fastq_file, blocksize)
+            try:
+                while not stop.is_set():
+                    block = inF.read(blocksize)
+                    blocks.put(block)
+                    if not block:
+                        return
+            finally:
+                # leave stdin open
+                if inF is not sys.stdin.buffer:
+                    inF.close()
+        except Exception as e:
+            blocks.put(e)
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+    try:
+        while True:
+            block = blocks.get()
+            if isinstance(block, Exception):
+                raise block
+            if not block:
+                break
+            yield block
+    finally:
+        stop.set()
+        # unblock the reader if it is waiting on a full queue
+        while thread.is_alive():
+            try:
+                blocks.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+def fastq_line_blocks(fastq_file: str, blocksize=BLOCKSIZE):
+    """
+    Lines of complete FASTQ records, per block: each list holds a multiple
+    of 4 lines (header, sequence, "+", quality) with line ends removed.
+    Return: generator of lists of lines (bytes)
+    """
+    rest = b''
+    for block in read_blocks(fastq_file, blocksize):
+        lines = (rest + block).split(b'\n')
+        n = (len(lines) - 1) // 4 * 4
+        rest = b'\n'.join(lines[n:])
+        if n:
+            yield _strip_cr(lines[:n])
+    lines = rest.split(b'\n')
+    if lines and not lines[-1]:
+        lines.pop()
+    if len(lines) % 4:
+        raise ValueError(f'Truncated FASTQ record at the end of {fastq_file}')
+    if lines:
+        yield _strip_cr(lines)
+
+def _strip_cr(lines: list) -> list:
+    if lines and lines[0].endswith(b'\r'):
+        return [x.rstrip(b'\r') for x in lines]
+    return lines
+
+def read_fastq(fastq_file: str, blocksize=BLOCKSIZE):
+    """
+    Stream records from a (possibly gzip-compressed) FASTQ file ("-" for stdin).
+    Return: generator of (header, sequence, quality) tuples of bytes; header without "@"
+    """
+    for lines in fastq_line_blocks(fastq_file, blocksize):
+        if not lines[0].startswith(b'@'):
+            raise ValueError(f'Not a FASTQ file: {fastq_file}')
+        for header,seq,qual in zip(lines[0::4], lines[1::4], lines[3::4]):
+            yield header[1:], seq, qual
+
+def read_pairs(read1: str, read2=None, interleaved=False):
+    """
+    Stream read pairs from two files or an interleaved file; single-end
+    reads are returned with None as mate.
+    Return: generator of (record, mate record or None) tuples
+    """
+    if read2 is not None:
+        it1,it2 = read_fastq(read1),read_fastq(read2)
+        for rec1 in it1:
+            rec2 = next(it2, None)
+            if rec2 is None:
+                raise ValueError(f'{read2} has fewer reads than {read1}')
+            yield rec1, rec2
+        if next(it2, None) is not None:
+            raise ValueError(f'{read2} has more reads than {read1}')
+    elif interleaved:
+        it = read_fastq(read1)
+        for rec1 in it:
+            rec2 = next(it, None)
+            if rec2 is None:
+                raise ValueError(f'Interleaved file {read1} has an odd number of reads')
+            yield rec1, rec2
+    else:
+        for rec in read_fastq(read1):
+            yield rec, None
+
+def fastq_chunks(read1: str, read2=None, interleaved=False, read_limit=None, chunk_reads=10000):
+    """
+    FASTQ text of the reads of a library, interleaved if paired, e.g. to
+    pipe them into a command. The input is only read up to `read_limit`
+    reads (pairs), so that remote files are not fetched beyond that.
+    Return: generator of bytes, `chunk_reads` reads (pairs) each
+    """
+    pairs = read_pairs(read1, read2, interleaved)
+    chunk = []
+    try:
+        for i,(rec1,rec2) in enumerate(pairs):
+            if read_limit is not None and i >= read_limit:
+                break
+            chunk.append(b'@%s\n%s\n+\n%s\n' % rec1)
+            if rec2 is not None:
+                chunk.append(b'@%s\n%s\n+\n%s\n' % rec2)
+            if len(chunk) >= chunk_reads:
+                yield b''.join(chunk)
+                chunk = []
+    finally:
+        # stop reading (and fetching) ahead
+        pairs.close()
+    if chunk:
+        yield b''.join(chunk)
+
+def fastq_pair_blocks(read1: str, read2=None, interleaved=False, read_limit=None):
+    """
+    Lines of the reads of a library in blocks of whole read (pairs), e.g. to
+    process the blocks in parallel: (forward lines, reverse lines) with the
+    same number of records from two files, or (lines, None) for single-end
+    and interleaved files (an even number of records if interleaved). The
+    input is only read up to `read_limit` reads (pairs).
+    Return: generator of (list, list or None) tuples of lines (see fastq_line_blocks)
+    """
+    # lines per read (pair) in the first list
+    unit = 8 if interleaved and read2 is None else 4
+    left = read_limit * unit if read_limit is not None else None
+    it1 = fastq_line_blocks(read1)
+    it2 = fastq_line_blocks(read2) if read2 is not None else None
+    buf1,buf2 = [],[]
+    try:
+        while left is None or left > 0:
+            # read more of the file that is behind
+            more1 = it2 is None or len(buf1) <= len(buf2)
+            block = next(it1 if more1 else it2, None)
+            if block is None:
+                break
+            if not block[0].startswith(b'@'):
+                raise ValueError(f'Not a FASTQ file: {read1 if more1 else read2}')
+            if more1:
+                buf1 += block
+            else:
+                buf2 += block
+            n = len(buf1) if it2 is None else min(len(buf1), len(buf2))
+            n = n // unit * unit
+            if left is not None:
+                n = min(n, left)
+                left -= n
+            if n:
+                yield buf1[:n], (buf2[:n] if it2 is not None else None)
+                buf1 = buf1[n:]
+                if it2 is not None:
+                    buf2 = buf2[n:]
+        if left is not None and left <= 0:
+            return
+        if it2 is None:
+            if buf1:
+                raise ValueError(f'Interleaved file {read1} has an odd number of reads')
+        elif buf1 or buf2 or next(it1, None) is not None or next(it2, None) is not None:
+            raise ValueError(f'{read1} and {read2} have different numbers of reads')
+    finally:
+        # stop reading (and fetching) ahead
+        it1.close()
+        if it2 is not None:
+            it2.close()
+
+
+class FastqStats(object):
+    """
+    Read count, read-length histogram and base composition of read segments,
+    counted a block of sequences at a time
+    """
+    def __init__(self):
+        self.n_reads = 0
+        self.lengths = Counter()
+        self.bases = Counter()
+
+    def add(self, seqs: list) -> None:
+        """
+        Count a list of sequences (bytes)
+        """
+        self.n_reads += len(seqs)
+        self.lengths.update(map(len, seqs))
+        joined = b''.join(seqs).upper()
+        for base in BASES:
+            self.bases[chr(base)] += joined.count(base)
+        self.bases['other'] += len(joined) - sum(joined.count(b) for b in BASES)
+
+    def update(self, other) -> None:
+        """
+        Add the counts of another FastqStats object
+        """
+        self.n_reads += other.n_reads
+        self.lengths.update(other.lengths)
+        self.bases.update(other.bases)
+
+    def max_length(self) -> int:
+        return max(self.lengths) if self.lengths else 0
+
+    def n_bases(self) -> int:
+        return sum(k * v for k,v in self.lengths.items())
+
+    def gc(self) -> float:
+        """
+        GC fraction of the A/C/G/T bases
+        """
+        acgt = sum(self.bases[x] for x in 'ACGT')
+        return (self.bases['G'] + self.bases['C']) / acgt if acgt else 0.0
+
+    def summary(self) -> dict:
+        return {
+            'reads' : self.n_reads,
+            'bases' : self.n_bases(),
+            'max_length' : self.max_length(),
+            'gc' : self.gc(),
+            'lengths' : dict(sorted(self.lengths.items())),
+            'composition' : dict(self.bases)
+        }
+
+    def write_histogram(self, out_file: str) -> str:
+        """
+        Write the read-length histogram (length, count), as readlength.sh
+        """
+        with open(out_file, 'w') as outF:
+            outF.write('#Length\tCount\n')
+            for length,n in sorted(self.lengths.items()):
+                outF.write(f'{length}\t{n}\n')
+        return out_file
+
+def file_stats(fastq_file: str, max_reads=None) -> FastqStats:
+    """
+    Statistics of (the first `max_reads` reads of) one FASTQ file
+    """
+    stats = FastqStats()
+    for lines in fastq_line_blocks(fastq_file):
+        seqs = lines[1::4]
+        if max_reads is not None and stats.n_reads + len(seqs) >= max_reads:
+            stats.add(seqs[:max_reads - stats.n_reads])
+            break
+        stats.add(seqs)
+    return stats
+
+def fastq_stats(read1: str, read2=None, interleaved=False, read_limit=None) -> dict:
+    """
+    Read counts, read-length histogram and base composition of a library,
+    read in-process. The two files of a pair are read concurrently, each
+    decompressed on its own thread.
+    read1: str, forward (or single-end, or interleaved) read file; "-" for stdin
+    read2: str, reverse read file
+    interleaved: bool, read1 holds both reads of each pair
+    read_limit: int, only read this many reads (pairs)
+    Return: dict, {'pairs' : number of reads (pairs), 'segments' : FastqStats of
+      all segments, 'fwd' : FastqStats, 'rev' : FastqStats or None}
+    """
+    if read2 is not None:
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            fwd,rev = pool.map(file_stats, [read1, read2], [read_limit, read_limit])
+        if fwd.n_reads != rev.n_reads:
+            raise ValueError(f'{read1} and {read2} have different numbers of reads')
+    elif interleaved:
+        limit = 2 * read_limit if read_limit is not None else None
+        fwd = file_stats(read1, limit)
+        if fwd.n_reads % 2:
+            raise ValueError(f'Interleaved file {read1} has an odd number of reads')
+        rev = None
+    else:
+        fwd,rev = file_stats(read1, read_limit),None
+    segments = FastqStats()
+    segments.update(fwd)
+    if rev is not None:
+        segments.update(rev)
+    pairs = fwd.n_reads // 2 if interleaved and read2 is None else fwd.n_reads
+    return {'pairs' : pairs, 'segments' : segments, 'fwd' : fwd, 'rev' : rev}
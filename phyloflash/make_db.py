@@ -4,13 +4,27 @@
 import os
 import re
 import sys
-import gzip
-import pickle
+import zlib
+import glob
 import random
 import shutil
 import logging
-import urllib.request
-from subprocess import Popen, PIPE
+import tempfile
+import urllib.parse
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, as_completed
+## package
+from phyloflash.scheduler import Stage, run_stages
+from phyloflash.checkpoint import Checkpoints
+from phyloflash.fasta import transform_fasta, split_fasta
+from phyloflash.seqstore import SeqStore, SeqStoreWriter, seqstore_path, open_records
+from phyloflash.acc2tax import write_acc2tax, acc2tax_from_fasta
+from phyloflash.download import download
+from phyloflash.tools import registry
+from phyloflash.db_manifest import write_manifest
+from phyloflash.prefilter import build_index
+from phyloflash.runner import run, run_pipeline, stream, bind_stage, set_timeout
+from phyloflash.profiling import start_profile, write_profile
 
 
 # Dict to map IUPAC ambiguous bases to [ATGC]
@@ -29,85 +43,94 @@ IUPAC_DECODE = {
     'N' : 'ACTG'
 }
 
-def run_job(cmd: str) -> None:
-    """
-    Run a shell command and check for errors.
-    cmd: str, shell command
-    """ 
-    p = Popen(cmd, shell=True, stdout=PIPE, stderr=PIPE)
-    output, err = p.communicate()
-    ## check for errors
-    rc = p.returncode
-    if rc != 0:
-        raise ValueError(f'Error running {cmd}: {err.decode()}')
-    
+# steps whose outputs are used by phyloFlash runs, listed in the database manifest
+DB_STAGES = ['univec_trim', 'make_vsearch_udb', 'fix_NR99', 'bbmap_db', 'kmer_prefilter',
+             'fix_NR96', 'sortmerna_index', 'acc2taxstring']
+# barrnap_HGV kingdoms screened for LSU contamination
+LSU_DOMAINS = ['bac', 'arch', 'euk']
+# barrnap_HGV executable
+BARRNAP_EXE = os.path.join(os.path.split(os.path.realpath(__file__))[0],
+                           'barrnap-HGV', 'bin', 'barrnap_HGV')
+
 def which(exe: str) -> None:
     """
-    Check if an executable is in PATH.
+    Check if an executable is in PATH (resolved once, see tools.ToolRegistry).
     exe: str, executable name
     """
-    if shutil.which(exe) is None:
+    if registry().resolve(exe) is None:
         raise ValueError(f'{exe} not found in PATH')
     
-def univec_download(univec_url: str, outdir: str, debug=False):
+def univec_download(univec_url: str, outdir: str, debug=False, connections=4, mirror_dir=None):
     """
     Download the latest version of the univec database from ncbi.
     univec_url: str, URL to download the univec database
     outdir: str, output directory
     debug: bool, if True, do not download the database if it already exists
+    connections: int, number of parallel connections
+    mirror_dir: str, local mirror directory shared between builds
     """
     logging.info('Downloading UniVec database from NCBI...')
     univec_file = os.path.join(outdir, 'UniVec')
     if debug is True and os.path.isfile(univec_file):
         return univec_file
-    urllib.request.urlretrieve(univec_url, univec_file)
-    return univec_file
+    return download(univec_url, univec_file, connections=connections, mirror_dir=mirror_dir)
     
-def silva_download(silva_url: str, outdir: str, debug=False):
+def silva_download(silva_url: str, outdir: str, debug=False, connections=4, mirror_dir=None):
     """
-    Download the latest version of the SILVA SSU RefNR database from www.arb-silva.de
+    Download the latest version of the SILVA SSU RefNR database from www.arb-silva.de.
+    The download is verified against the MD5 sum published next to the file.
     """
     logging.info('Downloading SILVA database from www.arb-silva.de...')
-    silva_file = os.path.join(outdir, 'SILVA_138.1_LSURef_NR99_tax_silva_trunc.fasta.gz')
+    file_name = os.path.basename(urllib.parse.urlparse(silva_url).path)
+    silva_file = os.path.join(outdir, file_name or 'SILVA_SSU.fasta.gz')
     if debug is True and os.path.isfile(silva_file):
         return silva_file
-    urllib.request.urlretrieve(silva_url, silva_file)
-    return silva_file
+    return download(silva_url, silva_file, connections=connections, mirror_dir=mirror_dir)
 
 def silva_uncompress(silva_file: str, outdir: str, num_lines=None) -> str:
     """
-    uncompress the SILVA database (fasta) file
+    uncompress the SILVA database (fasta) file.
+    A SeqStore of the records is written in the same pass, so that later
+    steps can read them without parsing the fasta again.
     """
     logging.info('Uncompressing the SILVA database...')
     out_file = os.path.join(outdir, 'SILVA_SSU.fasta')
-    with gzip.open(silva_file, 'rb') as inF:
-        with open(out_file, 'w') as outF:
-            for i,line in enumerate(inF):
-                outF.write(line.decode())
-                if num_lines is not None and i >= num_lines:
-                    break
+    # SILVA exports have 2 lines per record; only whole records are kept
+    max_records = None if num_lines is None else max(1, num_lines // 2)
+    with SeqStoreWriter(seqstore_path(out_file)) as store:
+        transform_fasta(silva_file, out_file, max_records=max_records, record_func=store.add)
     return out_file
 
-def run_barrnap(cmd: str, barrnap_results: list, domain: str) -> None: 
-    """
-    Run barrnap_HGV and extract sequences with potential LSU contamination
-    """
-    logging.info(f'Running barrnap_HGV for the "{domain}" domain...')
-    # run command
-    p = Popen(cmd, shell=True, stdout=PIPE, stderr=PIPE)
-    output, err = p.communicate()
-    ## check for errors
-    rc = p.returncode
-    if rc != 0:
-        raise ValueError(f'Error running {cmd}: {err.decode()}')
-    # extract LSU contamination in SSU RefNR
+def parse_barrnap_gff(lines) -> set:
+    """
+    Extract the IDs of sequences with LSU hits from barrnap_HGV GFF output.
+    lines: iterable of GFF lines (str or bytes), consumed as they arrive
+    """
     regex = re.compile(r'23S_rRNA|28S_rRNA')
-    for line in output.decode().split('\n'):
-        line = line.split('\t')
-        if line[0] == '' or len(line) < 8:
+    hits = set()
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode()
+        line = line.rstrip('\n').split('\t')
+        if line[0] == '' or line[0].startswith('#') or len(line) < 9:
             continue
         if regex.search(line[8]):
-            barrnap_results.add(line[0])
+            hits.add(line[0])
+    return hits
+
+def run_barrnap(cmd: list, job: str, log_file=None) -> set: 
+    """
+    Run barrnap_HGV and extract sequences with potential LSU contamination.
+    The GFF output is parsed line by line while barrnap_HGV is running;
+    stderr goes to the log file.
+    cmd: list, barrnap_HGV command
+    job: str, job description for logging
+    log_file: str, log file (see runner.Pipeline)
+    Return: set, IDs of sequences with LSU hits
+    """
+    logging.info(f'Running barrnap_HGV: {job}...')
+    # extract LSU contamination in SSU RefNR
+    return parse_barrnap_gff(stream(cmd, log_file))
 
 def subset_fasta(silva_file: str, n=1000) -> str:
     """
@@ -116,75 +139,102 @@ def subset_fasta(silva_file: str, n=1000) -> str:
     logging.warning('NOTE: Using a subset of the SILVA database for debugging purposes...')
     out_file,ext = os.path.splitext(silva_file)
     out_file = out_file + '.subset' + ext
-    with open(silva_file, 'r') as inF, open(out_file, 'w') as outF:
-        for i, line in enumerate(inF):
-            outF.write(line)
-            if i == n:
-                break
+    with open_records(silva_file) as records:
+        transform_fasta(records, out_file, max_records=max(1, n // 2))
     return out_file
 
-def remove_LSU_contamination(silva_file: str, threads=1) -> str:
+def barrnap_LSU_hits(silva_file: str, threads=1, domains=LSU_DOMAINS) -> set:
     """
-    Remove sequences with potential LSU contamination
+    Screen the SILVA database for LSU contamination with barrnap_HGV.
+    The fasta is split into `threads` shards, and each shard x domain job
+    runs single-threaded on a pool of `threads` workers.
+    Return: set, IDs of sequences with LSU hits in any domain
     """
-    logging.info('Removing sequences with potential LSU contamination...')
+    logging.info('Screening the SILVA database for LSU contamination...')
     # check if barrnap_HGV is in PATH
-    base_dir = os.path.split(os.path.realpath(__file__))[0]
-    exe = os.path.join(base_dir, 'barrnap-HGV', 'bin', 'barrnap_HGV')
+    exe = BARRNAP_EXE
     which(exe)
-    # run barrnap_HGV on each domain
+    # split the fasta into shards
+    shard_dir = tempfile.mkdtemp(prefix='barrnap_shards.', dir=os.path.dirname(silva_file) or '.')
     barrnap_results = set()
-    for domain in ['bac', 'arch', 'euk']:
-        cmd = f'{exe} --kingdom {domain} --threads {threads} --evalue 1e-10 --gene lsu --reject 0.01 {silva_file}'
-        run_barrnap(cmd, barrnap_results, domain)
+    try:
+        shards = split_fasta(silva_file, threads, os.path.join(shard_dir, 'shard'))
+        # run barrnap_HGV on each shard and domain; jobs are logged and profiled as part of this stage
+        with ThreadPoolExecutor(max_workers=max(1, threads)) as pool:
+            jobs = []
+            for domain in domains:
+                for i,shard in enumerate(shards):
+                    cmd = [exe, '--kingdom', domain, '--threads', 1, '--evalue', '1e-10',
+                           '--gene', 'lsu', '--reject', 0.01, shard]
+                    job = f'"{domain}" domain, shard {i + 1} of {len(shards)}'
+                    jobs.append(pool.submit(bind_stage(run_barrnap), cmd, job))
+            try:
+                for job in as_completed(jobs):
+                    barrnap_results |= job.result()
+            except Exception:
+                # do not start the remaining jobs
+                for job in jobs:
+                    job.cancel()
+                raise
+    finally:
+        shutil.rmtree(shard_dir, ignore_errors=True)
+    logging.info(f'Sequences with LSU hits: {len(barrnap_results)}')
+    return barrnap_results
+
+def remove_LSU_contamination(silva_file: str, *barrnap_hits) -> str:
+    """
+    Remove sequences with potential LSU contamination
+    silva_file: str, SILVA fasta file
+    barrnap_hits: sets of sequence IDs with LSU hits (see barrnap_LSU_hits)
+    """
+    logging.info('Removing sequences with potential LSU contamination...')
+    barrnap_results = set().union(*barrnap_hits)
     # remove SILVA sequences with potential LSU contamination
     out_file,ext = os.path.splitext(silva_file)
     out_file = out_file + '.noLSU' + ext
-    to_keep = False
-    with open(silva_file, 'r') as inF, open(out_file, 'w') as outF:
-        for line in inF:
-            if line.startswith('>'):
-                if line.lstrip('>') in barrnap_results:
-                    to_keep = False
-                else:
-                    to_keep = True
-            if to_keep is True:
-                outF.write(line)
+    with open_records(silva_file) as records:
+        n = transform_fasta(records, out_file, exclude=barrnap_results)
+    logging.info(f'Sequences removed: {len(barrnap_results)}; sequences kept: {n}')
     # remove the original SILVA file
     #os.remove(silva_file)
     return out_file  
 
-def mask_repeats(silva_file: str, threads: int, memory: int) -> str:
+def bbmask_cmd(silva_file: str, out_file: str, threads: int, memory: int) -> list:
     """
-    Mask repetitive regions in the SILVA database
+    bbmask command to mask repetitive regions (out_file "stdout.fa" writes to stdout)
     """
-    logging.info('Masking repetitive regions in the SILVA database...')
-    # check if bbmask is in PATH
-    exe = 'bbmask.sh'
-    which(exe)
-    out_file = 'SILVA_SSU.noLSU.masked.fasta'
-    # run bbmask
-    cmd = f'{exe} -Xmx{memory}g overwrite=t threads={threads} in={silva_file} out={out_file}'
-    cmd += ' minkr=4 maxkr=8 mr=t minlen=20 minke=4 maxke=8 fastawrap=0'
-    ## run command
-    run_job(cmd)
-    return out_file
+    return ['bbmask.sh', f'-Xmx{memory}g', 'overwrite=t', f'threads={threads}',
+            f'in={silva_file}', f'out={out_file}', 'minkr=4', 'maxkr=8', 'mr=t',
+            'minlen=20', 'minke=4', 'maxke=8', 'fastawrap=0']
 
-def univec_trim(univec_file: str, silva_file: str, threads: int, memory: int, min_length=800) -> str:
+def univec_trim(univec_file: str, silva_file: str, threads: int, memory: int, min_length=800,
+                mask=False) -> str:
     """
-    Run bbduk to trim sequences with UniVec contamination
+    Run bbduk to trim sequences with UniVec contamination.
+    With `mask`, repeats are first masked with bbmask (see bbmask_cmd), whose
+    output is piped into bbduk (see runner.run_pipeline) instead of being
+    written to a file; the two JVMs split the thread and memory budget.
     """
     logging.info('Trimming sequences with UniVec contamination...')
     # check if bbduk is in PATH
     exe = 'bbduk.sh'
     which(exe)
+    out_file,ext = os.path.splitext(silva_file)
+    if mask:
+        logging.info('Masking repetitive regions in the SILVA database...')
+        which('bbmask.sh')
+        out_file += '.masked'
+        threads,memory = max(1, threads // 2),max(1, memory // 2)
+    out_file = out_file + '.trimmed' + ext
     # run bbduk
-    out_file = 'SILVA_SSU.noLSU.masked.trimmed.fasta'
-    cmd = f'{exe} -Xmx{memory}g threads={threads} overwrite=t ref={univec_file}'
-    cmd += f' fastawrap=0 overwrite=t ktrim=r ow=t minlength={min_length} mink=11 hdist=1'
-    cmd += f' in={silva_file} out={out_file} stats={out_file}.UniVec_contamination_stats.txt'
-    ## run command
-    run_job(cmd)
+    cmd = [exe, f'-Xmx{memory}g', f'threads={threads}', 'overwrite=t', f'ref={univec_file}',
+           'fastawrap=0', 'overwrite=t', 'ktrim=r', 'ow=t', f'minlength={min_length}', 'mink=11',
+           'hdist=1', f'in={"stdin.fa" if mask else silva_file}', f'out={out_file}',
+           f'stats={out_file}.UniVec_contamination_stats.txt']
+    if mask:
+        run_pipeline([bbmask_cmd(silva_file, 'stdout.fa', threads, memory), cmd])
+    else:
+        run(cmd)
     return out_file
 
 def make_vsearch_udb(silva_file: str, threads=1) -> str:
@@ -194,11 +244,12 @@ def make_vsearch_udb(silva_file: str, threads=1) -> str:
     logging.info('Making a vsearch database from the SILVA database...')
     exe = 'vsearch'
     which(exe)
-    # create shell command
-    out_file = 'SILVA_SSU.noLSU.masked.trimmed.udb'
-    cmd = f'{exe} --threads {threads} --notrunclabels --makeudb_usearch {silva_file} --output {out_file}'
+    # create command
+    out_file = os.path.splitext(silva_file)[0] + '.udb'
+    cmd = [exe, '--threads', threads, '--notrunclabels', '--makeudb_usearch', silva_file,
+           '--output', out_file]
     ## run command
-    run_job(cmd)
+    run(cmd)
     return out_file
 
 def cluster(silva_file: str, seqid=0.99, threads=1) -> str:
@@ -213,13 +264,50 @@ def cluster(silva_file: str, seqid=0.99, threads=1) -> str:
     out_file,ext = os.path.splitext(silva_file)
     id = 'NR' + str(int(round(seqid* 100, 0)))
     out_file = f'{out_file}.{id}.fasta'
-    # create shell command
-    cmd = f'{exe} --threads {threads} --cluster_fast {silva_file} --id {seqid} --centroids {out_file} --notrunclabels'
+    # create command
+    cmd = [exe, '--threads', threads, '--cluster_fast', silva_file, '--id', seqid,
+           '--centroids', out_file, '--notrunclabels']
     ## run command
-    run_job(cmd)
+    run(cmd)
     return out_file
 
-def fasta_copy_iupac_randomize(silva_file: str) -> str:
+class IupacNormalizer(object):
+    """
+    Normalize sequences on byte buffers:
+    * one translate() call uppercases, turns U into T and deletes "." and "-"
+    * a second translate() call finds the (usually few) ambiguous bases, which
+      are located with bytes.find() and replaced in a bytearray with a base
+      drawn from a seeded RNG
+    The RNG is re-seeded per record from (seed, header), so the output is
+    reproducible and does not depend on record order.
+    seed: int, random seed
+    """
+    def __init__(self, seed=1):
+        self.seed = seed
+        lower = b'abcdefghijklmnopqrstuvwxyz'
+        upper = lower.upper().replace(b'U', b'T')
+        self.table = bytes.maketrans(lower + b'U', upper + b'T')
+        self.delete = b'.-'
+        self.decode = {ord(k) : v.encode() for k,v in IUPAC_DECODE.items()}
+        self.rng = random.Random()
+
+    def __call__(self, header: bytes, seq: bytes) -> bytes:
+        seq = seq.translate(self.table, self.delete)
+        # fast path: only unambiguous bases
+        ambig = [x for x in set(seq.translate(None, b'ACGT')) if x in self.decode]
+        if not ambig:
+            return seq
+        self.rng.seed(zlib.crc32(header, self.seed))
+        seq = bytearray(seq)
+        for x in sorted(ambig):
+            options = self.decode[x]
+            i = seq.find(x)
+            while i >= 0:
+                seq[i] = options[int(self.rng.random() * len(options))]
+                i = seq.find(x, i + 1)
+        return bytes(seq)
+
+def fasta_copy_iupac_randomize(silva_file: str, seed=1) -> str:
     """
     Creates a normalized FASTA file from FASTA file $source.
     * removes alignment characters ("." and "-")
@@ -227,80 +315,136 @@ def fasta_copy_iupac_randomize(silva_file: str) -> str:
     * convert RNA bases to DNA bases
     * replace IUPAC coded ambiguous base with a base randomly chosen from the set of options
       * i.e. replaces B with C, T or G
+    * the random choices are reproducible for a given `seed` (see IupacNormalizer)
+    A SeqStore of the normalized records is written alongside the output file.
     """
     logging.info('Formatting SILVA database...')
     # output file
     out_file,ext = os.path.splitext(silva_file)
     out_file = out_file + '.fixed' + ext
     # format fasta
-    regex1 = re.compile(r'[.-]')
-    regex2 = re.compile(r'([^AGCT])')
-    with open(silva_file) as inF, open(out_file, 'w') as outF:
-        for line in inF:
-            line = line.rstrip()
-            if line == '':
-                continue
-            # maintain header as-is
-            if line.startswith('>'):
-                outF.write(line + '\n')
-                continue
-            # remove alignment, uppercase, turn U into T
-            line = regex1.sub('', line.upper().replace('U', 'T'))
-            # replace any character (x) in line with a random selection from IUPAC_DECODE[x]
-            line = regex2.sub(lambda x: random.choice(IUPAC_DECODE[x.group(0)]), line)
-            # write to file
-            outF.write(line + '\n')
+    with SeqStoreWriter(seqstore_path(out_file)) as store:
+        transform_fasta(silva_file, out_file, seq_func=IupacNormalizer(seed),
+                        record_func=store.add)
     return out_file
     
-def bbmap_db(silva_file: str, out_dir: str, threads=1, memory=4) -> None:
+def bbmap_db(silva_file: str, out_dir: str, threads=1, memory=4) -> str:
     """
     Create a bbmap database from the SILVA database
+    Return: str, path to the bbmap index directory
     """
     logging.info('Creating a bbmap database from the SILVA database...')
     # check executable
     exe = 'bbmap.sh'
     which(exe)
     # run bbmap
-    cmd = f'{exe} -Xmx{memory}g threads={threads} overwrite=t ref={silva_file} path={out_dir}'
+    cmd = [exe, f'-Xmx{memory}g', f'threads={threads}', 'overwrite=t', f'ref={silva_file}',
+           f'path={out_dir}']
     ## run command
-    run_job(cmd)
+    run(cmd)
+    return os.path.join(out_dir, 'ref')
     
-def sortmerna_index(silva_file: str, memory=4) -> None:
+def sortmerna_index(silva_file: str, memory=4) -> list:
     """
-    Create a sortmerna index from the SILVA database
+    Create a sortmerna index from the SILVA database.
+    The index files are written next to `silva_file`, using its name without extension as prefix.
+    Return: list, sortmerna index files
     """
     logging.info('Creating a sortmerna database from the SILVA database...')
     # check executable
     exe = 'indexdb_rna'
     which(exe)
-    # create shell command
+    # create command
     memory = int(round(memory * 1000,0))
-    cmd = f'{exe} -m {memory} --ref {silva_file},SILVA_SSU'
+    prefix = os.path.splitext(silva_file)[0]
+    cmd = [exe, '-m', memory, '--ref', f'{silva_file},{prefix}']
     ## run command
-    run_job(cmd)  
+    run(cmd)
+    return sorted(glob.glob(prefix + '.*.dat') + glob.glob(prefix + '.stats'))
     
 def hash_SILVA_acc_taxstrings_from_fasta(silva_file: str) -> str:
     """
-    * Hash of accession numbers and taxonomy strings from SILVA fasta headers
-    * Store as a perl hash image with Storable
+    * Index of accession numbers and taxonomy strings from SILVA fasta headers
+    * Stored as a memory-mappable, sorted lookup table (see acc2tax.Acc2Tax)
     * For later when wrangling sortmerna SAM output to bbmap-like format
     """
-    logging.info('Hashing accession numbers and taxonomy strings from SILVA fasta headers...')
+    logging.info('Indexing accession numbers and taxonomy strings from SILVA fasta headers...')
     prefix = os.path.splitext(silva_file)[0]
-    hash = dict()
-    with open(silva_file) as inF:
-        for line in inF:
-            line = line.rstrip()
-            if line.startswith('>'):
-                id,taxsplit = line.split(' ',1)
-                hash[id] = taxsplit
-    # pickle the hash
-    out_file = prefix + '.acc2taxstring.hashimage'
-    with open(out_file, 'wb') as out_file:
-        pickle.dump(hash, out_file)
+    out_file = prefix + '.acc2taxstring.idx'
+    with open_records(silva_file) as records:
+        if isinstance(records, SeqStore):
+            # taxonomy strings are already interned in the store
+            write_acc2tax(records, out_file)
+        else:
+            acc2tax_from_fasta(silva_file, out_file)
     return out_file
 
 
+def make_stages(args: dict) -> list:
+    """
+    Dependency graph of the database creation steps.
+    Stages flagged with threads/memory get a share of --threads/--memory
+    when they are started (see scheduler.run_stages).
+    """
+    stages = [
+        # Download the latest version of the univec database from ncbi
+        Stage('univec_download', 
+              partial(univec_download, args.univec_url, args.outdir, debug=args.debug,
+                      connections=args.connections, mirror_dir=args.mirror_dir)),
+        # Download latest SSU RefNR from www.arb-silva.de
+        Stage('silva_download', 
+              partial(silva_download, args.silva_url, args.outdir, debug=args.debug,
+                      connections=args.connections, mirror_dir=args.mirror_dir)),
+        # Uncompress the SILVA database file
+        Stage('silva_uncompress', 
+              partial(silva_uncompress, outdir=args.outdir, num_lines=args.num_lines),
+              deps=['silva_download'])
+    ]
+    stages += [
+        # Screen for LSU contamination; sharded barrnap_HGV runs for all domains
+        Stage('barrnap_LSU', barrnap_LSU_hits,
+              deps=['silva_uncompress'], threads=True, tools=[BARRNAP_EXE]),
+        # Remove sequences with potential LSU contamination
+        Stage('remove_LSU_contamination', remove_LSU_contamination,
+              deps=['silva_uncompress', 'barrnap_LSU']),
+        # Mask repeats in SILVA SSU sequences with bbmask, piped into bbduk to
+        # screen against UniVec and trim matching sequences
+        Stage('univec_trim', partial(univec_trim, mask=True), 
+              deps=['univec_download', 'remove_LSU_contamination'], threads=True, memory=True,
+              tools=['bbmask.sh', 'bbduk.sh']),
+        # Use Vsearch to index the SILVA database and create a UDB file
+        Stage('make_vsearch_udb', make_vsearch_udb,
+              deps=['univec_trim'], threads=True, tools=['vsearch']),
+        # Cluster the SILVA database at 99% identity using Vsearch
+        Stage('cluster_NR99', partial(cluster, seqid=0.99),
+              deps=['univec_trim'], threads=True, tools=['vsearch']),
+        # Format the sequence data
+        Stage('fix_NR99', partial(fasta_copy_iupac_randomize, seed=args.seed),
+              deps=['cluster_NR99']),
+        # Create bbmap index from SILVA database
+        Stage('bbmap_db', partial(bbmap_db, out_dir=args.outdir),
+              deps=['fix_NR99'], threads=True, memory=True, tools=['bbmap.sh']),
+        # k-mer index of the bbmap database, to prefilter reads (run --prefilter);
+        # hashed by one process per thread, each holding a full-size filter
+        Stage('kmer_prefilter', build_index, deps=['fix_NR99'], threads=True, memory=True),
+        # Cluster the SILVA database at 96% identity using Vsearch
+        Stage('cluster_NR96', partial(cluster, seqid=0.96),
+              deps=['univec_trim'], threads=True, tools=['vsearch']),
+        # Format the sequence data
+        Stage('fix_NR96', partial(fasta_copy_iupac_randomize, seed=args.seed),
+              deps=['cluster_NR96'])
+    ]
+    # Create sortmerna index from SILVA database
+    if not args.skip_sortmerna:
+        stages += [
+            # sortmerna_index
+            Stage('sortmerna_index', sortmerna_index, deps=['fix_NR96'], memory=True,
+                  tools=['indexdb_rna']),
+            # Create dict of taxonomy strings from SILVA fasta headers
+            Stage('acc2taxstring', hash_SILVA_acc_taxstrings_from_fasta, deps=['fix_NR96'])
+        ]
+    return stages
+
 def main(args: dict) -> None:
     # Debug status
     if args.debug:
@@ -312,48 +456,31 @@ def main(args: dict) -> None:
     if not os.path.isdir(args.outdir):
         os.makedirs(args.outdir)
     
-    # Download the latest version of the univec database from ncbi
-    univec_file = univec_download(args.univec_url, args.outdir, args.debug)
-
-    # Download latest SSU RefNR from www.arb-silva.de
-    silva_file = silva_download(args.silva_url, args.outdir, args.debug)
-    
-    # Uncompress the SILVA database file
-    silva_file = silva_uncompress(silva_file, args.outdir, num_lines = args.num_lines)
+    # Steps unchanged since a previous run (same inputs, parameters and tools) are skipped
+    checkpoints = Checkpoints(os.path.join(args.outdir, 'checkpoints'), resume=not args.force)
     
-    # Remove sequences with potential LSU contamination
-    silva_file = remove_LSU_contamination(silva_file, threads = args.threads)
-    
-    # Mask repeats in SILVA SSU sequences
-    silva_file = mask_repeats(silva_file, threads=args.threads, memory = args.memory)
-    
-    # Screen SILVA db against UniVec and trim matching sequences with bbduk
-    silva_file = univec_trim(univec_file, silva_file, threads = args.threads, memory = args.memory)
-    
-    # Use Vsearch to index the SILVA database and create a UDB file
-    silva_ubd_file = make_vsearch_udb(silva_file, threads = args.threads)
-    
-    # Cluster the SILVA database at 99% identity using Vsearch
-    silva99_file = cluster(silva_file, seqid = 0.99)
-    
-    # Format the sequence data
-    silva99_file = fasta_copy_iupac_randomize(silva99_file)
-    
-    # Create bbmap index from SILVA database
-    bbmap_db(silva99_file, args.outdir, threads = args.threads, memory = args.memory)
-    
-    # Cluster the SILVA database at 96% identity using Vsearch
-    silva96_file = cluster(silva_file, seqid = 0.96)
+    # Time limit of each external command
+    set_timeout(args.timeout * 60 if args.timeout else None)
 
-    # Format the sequence data
-    silva96_file = fasta_copy_iupac_randomize(silva96_file)
-    
-    # Create sortmerna index from SILVA database
-    if not args.skip_sortmerna:
-        # sortmerna_index
-        sortmerna_index(silva96_file)
-        # Create dict of taxonomy strings from SILVA fasta headers
-        hash_SILVA_acc_taxstrings_from_fasta(silva96_file)
+    # Run all steps, with independent steps in parallel; the output of the
+    # external commands of each step is logged to <outdir>/logs/<step>.log,
+    # and their resource usage to <outdir>/profile.{json,tsv}
+    profile = start_profile()
+    try:
+        results = run_stages(make_stages(args), threads=args.threads, memory=args.memory,
+                             checkpoints=checkpoints, log_dir=os.path.join(args.outdir, 'logs'))
+    finally:
+        write_profile(profile, os.path.join(args.outdir, 'profile'))
+
+    # Manifest of the database files, checked by each run; the files were
+    # already hashed for the checkpoints, so only changed files are hashed again
+    known = {}
+    for name in DB_STAGES:
+        known.update((checkpoints.load(name) or {}).get('outputs', {}))
+    paths = [results[x] for x in DB_STAGES if x in results]
+    paths = [p for x in paths for p in (x if isinstance(x, list) else [x])]
+    write_manifest(args.outdir, paths, silva_url=args.silva_url, known=known,
+                   threads=args.threads)
     
 
 if __name__ == "__main__":
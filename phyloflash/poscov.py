@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# import
+## batteries
+import os
+import random
+import shutil
+import logging
+import platform
+import tempfile
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+## package
+from phyloflash.fastq import read_pairs
+from phyloflash.runner import run, bind_stage
+
+# nhmmer and SSU models shipped with barrnap-HGV
+BARRNAP_DATA = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'data', 'barrnap-HGV')
+SSU_HMM = os.path.join(BARRNAP_DATA, 'ssu', 'ssu_ABE.hmm')
+NHMMER_EXE = os.path.join(BARRNAP_DATA, f'nhmmer-{platform.system().lower()}')
+# number of reads (pairs) sampled from the mapped reads
+SAMPLE_SIZE = 10000
+# minimum number of hits to a model type to write its histogram
+MIN_HITS = 50
+# histogram of each model type; models named 18S_rRNA are eukaryotic
+MODEL_TYPES = ('prok', 'euk')
+
+
+def nhmmer_exe() -> str:
+    """
+    nhmmer executable of barrnap-HGV for this operating system
+    """
+    if not os.path.exists(NHMMER_EXE):
+        raise OSError(f"Executable '{NHMMER_EXE}' not found in package data path")
+    return NHMMER_EXE
+
+def model_type(name: str) -> str:
+    return 'euk' if name == '18S_rRNA' else 'prok'
+
+def hmm_lengths(hmm_file: str) -> dict:
+    """
+    Length of the longest model of each type in an HMMER3 model file
+    Return: dict, {model type : length}
+    """
+    lengths = {x : 0 for x in MODEL_TYPES}
+    name = None
+    with open(hmm_file) as inF:
+        for line in inF:
+            if line.startswith('NAME '):
+                name = line.split()[1]
+            elif line.startswith('LENG '):
+                t = model_type(name)
+                lengths[t] = max(lengths[t], int(line.split()[1]))
+    return lengths
+
+def sample_reads(read1: str, read2=None, n=SAMPLE_SIZE, seed=1) -> list:
+    """
+    Uniform random sample of `n` reads (pairs), drawn in-process in one
+    pass over the reads (reservoir sampling)
+    Return: list of (sequence, mate sequence or None) tuples
+    """
+    rng = random.Random(seed)
+    sample = []
+    for i,(rec1,rec2) in enumerate(read_pairs(read1, read2)):
+        pair = (rec1[1], rec2[1] if rec2 is not None else None)
+        if i < n:
+            sample.append(pair)
+        else:
+            j = rng.randrange(i + 1)
+            if j < n:
+                sample[j] = pair
+    return sample
+
+def write_shards(sample: list, out_dir: str, n_shards: int) -> list:
+    """
+    Write the sampled read segments to `n_shards` FASTA files. Segments
+    are named by their index (2 * pair + segment), used as array index
+    when the hits are parsed.
+    Return: list of FASTA files
+    """
+    files = [os.path.join(out_dir, f'shard{i}.fasta') for i in range(n_shards)]
+    for i,out_file in enumerate(files):
+        with open(out_file, 'wb') as outF:
+            for k in range(i, len(sample), n_shards):
+                for segment,seq in enumerate(sample[k]):
+                    if seq is not None:
+                        outF.write(b'>%d\n%s\n' % (2 * k + segment, seq))
+    return files
+
+def run_nhmmer(exe: str, hmm_file: str, fasta_file: str) -> str:
+    """
+    Search one shard of reads with the SSU models (single-threaded)
+    Return: str, tabular output file
+    """
+    tblout = os.path.splitext(fasta_file)[0] + '.tblout'
+    run([exe, '--cpu', 1, '--tblout', tblout, '-o', os.devnull, hmm_file, fasta_file])
+    return tblout
+
+
+class PositionHistograms(object):
+    """
+    Start positions of reads on the SSU models, counted per model type in
+    flat arrays indexed by model position. Only the best-scoring hit of
+    each read segment is counted; hits are kept per segment index in
+    arrays until all shards have been parsed.
+    lengths: dict, model length of each type (see hmm_lengths)
+    n_reads: int, number of read segment indices (see write_shards)
+    """
+    def __init__(self, lengths: dict, n_reads: int):
+        self.lengths = lengths
+        self.score = array('f', [float('-inf')]) * n_reads
+        self.pos = array('I', [0]) * n_reads
+        self.types = array('b', [-1]) * n_reads
+
+    def add_tblout(self, tblout: str) -> None:
+        """
+        Add the hits of an nhmmer tabular output file
+        """
+        with open(tblout) as inF:
+            for line in inF:
+                if line.startswith('#'):
+                    continue
+                fields = line.split()
+                i,score = int(fields[0]),float(fields[13])
+                if score > self.score[i]:
+                    self.score[i] = score
+                    self.pos[i] = int(fields[4])
+                    self.types[i] = MODEL_TYPES.index(model_type(fields[2]))
+
+    def histograms(self) -> dict:
+        """
+        Return: dict, {model type : array of read counts per model position (1-based)}
+        """
+        hists = {t : array('L', [0]) * (self.lengths[t] + 1) for t in MODEL_TYPES}
+        for pos,t in zip(self.pos, self.types):
+            if t >= 0:
+                hist = hists[MODEL_TYPES[t]]
+                if pos >= len(hist):
+                    hist.extend([0] * (pos + 1 - len(hist)))
+                hist[pos] += 1
+        return hists
+
+def write_histogram(hist, out_file: str) -> str:
+    """
+    Write the positions with hits and their read counts
+    """
+    with open(out_file, 'w') as outF:
+        outF.write(''.join(f'{pos}\t{n}\n' for pos,n in enumerate(hist) if n))
+    return out_file
+
+def nhmmer_model_pos(args, files: dict, threads=1) -> dict:
+    """
+    How evenly the SSU reads cover the length of the gene: positions of a
+    random sample of the mapped reads on the SSU models of barrnap-HGV.
+    Mapping positions cannot be used, as the database sequences differ in
+    length and some are fragments. The sample is drawn in-process and
+    searched in `threads` shards by concurrent single-threaded nhmmer runs.
+    files: dict, output files of the map stage
+    Return: dict, {model type : histogram file, or None if too few hits}
+    """
+    logging.info(f'Subsampling SSU reads of {args.lib} and running nhmmer to check '
+                 'coverage evenness across gene...')
+    exe = nhmmer_exe()
+    paired = args.read2 is not None or args.interleaved
+    n = args.poscov_sample or SAMPLE_SIZE
+    sample = sample_reads(files['reads_mapped_f'], files['reads_mapped_r'] if paired else None, n)
+    n_shards = max(1, min(threads, len(sample)))
+    shard_dir = tempfile.mkdtemp(prefix='nhmmer_shards.', dir=os.path.dirname(os.path.abspath(args.lib)))
+    try:
+        shards = write_shards(sample, shard_dir, n_shards)
+        logging.info(f'  Searching {len(sample)} reads (pairs) in {n_shards} shards')
+        with ThreadPoolExecutor(max_workers=n_shards) as pool:
+            jobs = [pool.submit(bind_stage(run_nhmmer), exe, SSU_HMM, x) for x in shards]
+            tblouts = [x.result() for x in jobs]
+        positions = PositionHistograms(hmm_lengths(SSU_HMM), 2 * len(sample))
+        with open(f'{args.lib}.nhmmer.tblout', 'wb') as outF:
+            for tblout in tblouts:
+                positions.add_tblout(tblout)
+                with open(tblout, 'rb') as inF:
+                    shutil.copyfileobj(inF, outF)
+    finally:
+        shutil.rmtree(shard_dir, ignore_errors=True)
+    out_files = {}
+    for t,hist in positions.histograms().items():
+        total = sum(hist)
+        if total >= MIN_HITS:
+            out_files[t] = write_histogram(hist, f'{args.lib}.nhmmer.{t}.histogram')
+        else:
+            logging.info(f'  Fewer than {MIN_HITS} maps to {t} SSU HMM model, skip plotting histogram...')
+            out_files[t] = None
+    return out_files
@@ -0,0 +1,361 @@
+#!/usr/bin/env python
+# import
+## batteries
+import os
+import zlib
+import logging
+import tempfile
+import multiprocessing
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+## package
+from phyloflash.seqstore import write_section, write_footer, map_sections, open_records
+from phyloflash.fasta import revcomp
+from phyloflash.fastq import fastq_pair_blocks
+
+# Index file layout: the parameters (k, number of bits, number of hash
+# functions, number of k-mers added) and the bits of a Bloom filter of the
+# k-mers of the SSU database sequences (sense strand), followed by a footer
+# (see seqstore.map_sections); memory-mapped by each run
+MAGIC = b'PFKMERBF'
+SECTIONS = ('params', 'bits')
+# k-mer length; 20-mers do not occur by chance in reads (4^20 >> database k-mers)
+KMER = 20
+# filter bits per k-mer position in the database (the number of distinct
+# k-mers is lower) and hash functions: <0.4% false positive k-mers
+BITS_PER_KMER = 12
+N_HASHES = 6
+# distance between the read k-mers looked up, from the last one
+STRIDE = 16
+# k-mers found in the index for a read segment to be kept
+MIN_HITS = 1
+# bytes of the filter merged at a time when combining shards
+MERGE_BLOCK = 1 << 26
+# read (pairs) at the start of a library passed unfiltered to the mapper, to
+# measure the sensitivity of the filter against the unfiltered mapping
+CHECK_READS = 100000
+
+
+def index_path(fasta_file: str) -> str:
+    """
+    Path of the k-mer index written alongside a FASTA file
+    """
+    return os.path.splitext(fasta_file)[0] + '.kmerfilter'
+
+def kmer_hashes(kmer: bytes, n_bits: int, n_hashes: int) -> list:
+    """
+    Filter bits of a k-mer: double hashing of two CRC32 values (of the
+    k-mer and its reverse)
+    """
+    h1 = zlib.crc32(kmer)
+    h2 = zlib.crc32(kmer[::-1]) | 1
+    return [(h1 + j * h2) % n_bits for j in range(n_hashes)]
+
+def _add_shard(fasta_file: str, shard: int, n_shards: int, k: int, n_bits: int,
+               n_hashes: int, out_file: str) -> tuple:
+    """
+    Add the k-mers of every `n_shards`-th sequence to a filter
+    Return: (filter file, number of k-mers added)
+    """
+    bits = bytearray(n_bits // 8)
+    crc = zlib.crc32
+    n = 0
+    with open_records(fasta_file) as records:
+        for i,(_,seq) in enumerate(records):
+            if i % n_shards != shard:
+                continue
+            for j in range(len(seq) - k + 1):
+                kmer = seq[j:j + k]
+                h1 = crc(kmer)
+                h2 = crc(kmer[::-1]) | 1
+                for x in range(n_hashes):
+                    p = (h1 + x * h2) % n_bits
+                    bits[p >> 3] |= 1 << (p & 7)
+            n += max(0, len(seq) - k + 1)
+    with open(out_file, 'wb') as outF:
+        outF.write(bits)
+    return out_file, n
+
+def build_index(fasta_file: str, threads=1, memory=None, k=KMER, bits_per_kmer=BITS_PER_KMER,
+                n_hashes=N_HASHES) -> str:
+    """
+    Build the k-mer prefilter index of an SSU database: a Bloom filter of
+    all k-mers of its sequences. Only the sense strand is indexed: one
+    segment of each read pair is on the sense strand, and single reads are
+    also looked up reverse-complemented. The sequences are split into
+    shards hashed by separate processes, whose filters are OR-ed together.
+    Each shard holds a full-size filter, so there are at most as many
+    shards as filters fit in `memory`.
+    fasta_file: str, database FASTA (read from its SeqStore if there is one)
+    threads: int, maximum number of shards
+    memory: int, memory limit in GB (None: no limit)
+    Return: str, index file (see index_path)
+    """
+    logging.info(f'Building the k-mer prefilter index of {fasta_file}...')
+    with open_records(fasta_file) as records:
+        positions = sum(max(0, len(seq) - k + 1) for _,seq in records)
+    # a multiple of 64 bits, so that the filter can be viewed as 8-byte words
+    n_bits = max(64, -(-positions * bits_per_kmer // 64) * 64)
+    out_file = index_path(fasta_file)
+    n_shards = max(1, threads)
+    if memory is not None:
+        n_shards = max(1, min(n_shards, int(memory * 1e9) // (n_bits // 8)))
+        if n_shards < threads:
+            logging.info(f'  {n_shards} shards of {n_bits // 8 / 1e6:.1f} MB fit in {memory} GB')
+    tmp_dir = tempfile.mkdtemp(prefix='kmerfilter.', dir=os.path.dirname(os.path.abspath(out_file)))
+    try:
+        with ProcessPoolExecutor(max_workers=n_shards) as pool:
+            jobs = [pool.submit(_add_shard, fasta_file, i, n_shards, k, n_bits, n_hashes,
+                                os.path.join(tmp_dir, f'shard{i}.bits')) for i in range(n_shards)]
+            shards = [x.result() for x in jobs]
+        n_kmers = sum(n for _,n in shards)
+        tmp_file = out_file + '.tmp'
+        with open(tmp_file, 'wb') as outF:
+            positions = write_section(outF, array('Q', [k, n_bits, n_hashes, n_kmers]))
+            # filter bits: the shard filters OR-ed block by block
+            inFs = [open(x, 'rb') for x,_ in shards]
+            try:
+                positions.append(outF.tell())
+                while True:
+                    block = inFs[0].read(MERGE_BLOCK)
+                    if not block:
+                        break
+                    merged = int.from_bytes(block, 'little')
+                    for x in inFs[1:]:
+                        merged |= int.from_bytes(x.read(MERGE_BLOCK), 'little')
+                    outF.write(merged.to_bytes(len(block), 'little'))
+                positions.append(n_bits // 8)
+            finally:
+                for x in inFs:
+                    x.close()
+            write_footer(outF, MAGIC, SECTIONS, n_kmers, positions)
+        os.replace(tmp_file, out_file)
+    finally:
+        for name in os.listdir(tmp_dir):
+            os.remove(os.path.join(tmp_dir, name))
+        os.rmdir(tmp_dir)
+    logging.info(f'  {n_kmers} k-mers (k={k}) in a {n_bits // 8 / 1e6:.1f} MB filter')
+    return out_file
+
+
+class KmerIndex(object):
+    """
+    Memory-mapped k-mer prefilter index (see build_index). Lookups may
+    give false positives (<0.4% of k-mers), never false negatives.
+    index_file: str, index file
+    """
+    def __init__(self, index_file: str):
+        self.index_file = index_file
+        self._mm,self.n_kmers,buffers = map_sections(index_file, MAGIC, SECTIONS)
+        self.params = buffers['params'].cast('Q')
+        self.k,self.n_bits,self.n_hashes,_ = self.params
+        self.bits = buffers['bits']
+
+    def close(self) -> None:
+        """
+        Release the memory map
+        """
+        if self._mm is not None:
+            self.params.release()
+            self.bits.release()
+            self._mm.close()
+            self._mm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def __contains__(self, kmer: bytes) -> bool:
+        bits = self.bits
+        return all(bits[p >> 3] >> (p & 7) & 1 for p in kmer_hashes(kmer, self.n_bits, self.n_hashes))
+
+    def hits(self, seq: bytes, min_hits=MIN_HITS, stride=STRIDE) -> int:
+        """
+        Number of the k-mers of a read (the last and every `stride`-th
+        before it) found in the index, counted up to `min_hits`
+        """
+        k,n_bits,n_hashes,bits = self.k,self.n_bits,self.n_hashes,self.bits
+        crc = zlib.crc32
+        n = 0
+        for i in range(len(seq) - k, -1, -stride):
+            kmer = seq[i:i + k]
+            h1 = crc(kmer)
+            p = h1 % n_bits
+            # most k-mers of non-rRNA reads fail on the first bit
+            if not bits[p >> 3] >> (p & 7) & 1:
+                continue
+            h2 = crc(kmer[::-1]) | 1
+            for x in range(1, n_hashes):
+                p = (h1 + x * h2) % n_bits
+                if not bits[p >> 3] >> (p & 7) & 1:
+                    break
+            else:
+                n += 1
+                if n >= min_hits:
+                    break
+        return n
+
+
+# index and settings of a filter worker process (see _init_worker)
+_worker = None
+
+
+def _init_worker(index_file: str, min_hits: int, stride: int) -> None:
+    global _worker
+    _worker = (KmerIndex(index_file), min_hits, stride)
+
+def _close_worker() -> None:
+    global _worker
+    if _worker is not None:
+        _worker[0].close()
+        _worker = None
+
+def filter_block(lines1: list, lines2=None, interleaved=False, check=0) -> tuple:
+    """
+    Filter a block of read (pairs) with the index of this process (see
+    _init_worker): a pair is kept if either segment has a k-mer in the
+    index (a single read: on either strand).
+    lines1, lines2: lists of FASTQ lines (see fastq.fastq_pair_blocks)
+    check: int, read (pairs) at the start of the block kept unfiltered,
+      whose names are returned
+    Return: (FASTQ text of the kept read (pairs), interleaved if paired;
+      read (pairs), kept, reads, bases, checked names, names of the checked
+      read (pairs) the filter would have removed)
+    """
+    index,min_hits,stride = _worker
+    hits = index.hits
+    if interleaved and lines2 is None:
+        recs1 = [lines1[i:i + 4] for i in range(0, len(lines1), 8)]
+        recs2 = [lines1[i + 4:i + 8] for i in range(0, len(lines1), 8)]
+    else:
+        recs1 = [lines1[i:i + 4] for i in range(0, len(lines1), 4)]
+        recs2 = [lines2[i:i + 4] for i in range(0, len(lines2), 4)] if lines2 is not None else None
+    out = []
+    checked,rejected = [],[]
+    for j,rec1 in enumerate(recs1):
+        rec2 = recs2[j] if recs2 is not None else None
+        mate = rec2[1] if rec2 is not None else revcomp(rec1[1])
+        keep = hits(rec1[1], min_hits, stride) >= min_hits or hits(mate, min_hits, stride) >= min_hits
+        if j < check:
+            name = read_name(rec1[0][1:])
+            checked.append(name)
+            if not keep:
+                rejected.append(name)
+            keep = True
+        if keep:
+            out += rec1
+            if rec2 is not None:
+                out += rec2
+    seqs = [x[1] for x in recs1] + ([x[1] for x in recs2] if recs2 is not None else [])
+    text = b'\n'.join(out) + b'\n' if out else b''
+    kept = len(out) // (8 if recs2 is not None else 4)
+    return text, len(recs1), kept, len(seqs), sum(map(len, seqs)), checked, rejected
+
+
+class ReadPrefilter(object):
+    """
+    Streaming filter of the reads (pairs) of a library before they are
+    passed to the mapper (see filter_block). Blocks of reads are filtered
+    by `threads` worker processes, each with its own memory map of the
+    index. The first `check_reads` pairs are all kept, and the names of
+    those the filter would have removed are noted, so that the sensitivity
+    of the filter can be measured on the mapped reads (see sensitivity).
+    index_file: str, k-mer index (see build_index)
+    threads: int, filter processes (1: filter in this process)
+    check_reads: int, read (pairs) passed unfiltered
+    """
+    def __init__(self, index_file: str, threads=1, check_reads=CHECK_READS, min_hits=MIN_HITS,
+                 stride=STRIDE):
+        self.index_file = index_file
+        self.threads = threads
+        self.check_reads = check_reads
+        self.min_hits = min_hits
+        self.stride = stride
+        self.pairs = 0
+        self.kept = 0
+        self.reads = 0
+        self.bases = 0
+        self.checked = set()
+        self.rejected = set()
+
+    def _add(self, result: tuple) -> bytes:
+        text,pairs,kept,reads,bases,checked,rejected = result
+        self.pairs += pairs
+        self.kept += kept
+        self.reads += reads
+        self.bases += bases
+        self.checked.update(checked)
+        self.rejected.update(rejected)
+        return text
+
+    def chunks(self, read1: str, read2=None, interleaved=False, read_limit=None):
+        """
+        FASTQ text of the kept reads of a library, interleaved if paired, in
+        input order (see fastq.fastq_chunks), e.g. to pipe them into a
+        command. Closing the generator early stops the filter processes.
+        Return: generator of bytes
+        """
+        blocks = fastq_pair_blocks(read1, read2, interleaved, read_limit)
+        initargs = (self.index_file, self.min_hits, self.stride)
+        pool = None
+        if self.threads > 1:
+            # spawned rather than forked: this process runs reader threads
+            pool = ProcessPoolExecutor(max_workers=self.threads, initializer=_init_worker,
+                                       initargs=initargs, mp_context=multiprocessing.get_context('spawn'))
+        else:
+            _init_worker(*initargs)
+        pending = deque()
+        submitted = 0
+        try:
+            for lines1,lines2 in blocks:
+                n = len(lines1) // (8 if interleaved and lines2 is None else 4)
+                check = max(0, min(n, self.check_reads - submitted))
+                submitted += n
+                if pool is None:
+                    yield self._add(filter_block(lines1, lines2, interleaved, check))
+                    continue
+                pending.append(pool.submit(filter_block, lines1, lines2, interleaved, check))
+                # one block per process in flight (and one queued), written out in order
+                if len(pending) > self.threads:
+                    yield self._add(pending.popleft().result())
+            while pending:
+                yield self._add(pending.popleft().result())
+        finally:
+            blocks.close()
+            if pool is None:
+                _close_worker()
+            else:
+                for x in pending:
+                    x.cancel()
+                pool.shutdown()
+
+    def sensitivity(self, mapped_fastq: str) -> dict:
+        """
+        Sensitivity of the filter on the unfiltered first read (pairs):
+        the fraction of those mapped that the filter keeps
+        mapped_fastq: str, mapped (forward) reads written by the mapper
+        Return: dict, {'mapped' : mapped check reads (pairs), 'missed' : of which
+          the filter removes, 'sensitivity' : fraction (None if none mapped)}
+        """
+        mapped,missed = set(),0
+        if os.path.exists(mapped_fastq):
+            with open(mapped_fastq, 'rb') as inF:
+                for i,line in enumerate(inF):
+                    if i % 4 == 0:
+                        name = read_name(line[1:])
+                        if name in self.checked and name not in mapped:
+                            mapped.add(name)
+                            missed += name in self.rejected
+        mapped = len(mapped)
+        return {'mapped' : mapped, 'missed' : missed,
+                'sensitivity' : (mapped - missed) / mapped if mapped > 0 else None}
+
+def read_name(header: bytes) -> bytes:
+    """
+    Read name of a FASTQ header (without "@"): first word, without /1 or /2
+    """
+    name = header.split(None, 1)[0] if header.strip() else b''
+    return name[:-2] if name[-2:] in (b'/1', b'/2') else name
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+# import
+## batteries
+import os
+import sys
+import csv
+import json
+import time
+import logging
+import resource
+import threading
+import contextlib
+
+# columns of the TSV profile
+PROFILE_COLUMNS = ['kind', 'stage', 'name', 'status', 'wall_s', 'cpu_s', 'user_s', 'sys_s',
+                   'max_rss_mb', 'read_bytes', 'write_bytes', 'threads', 'memory_gb', 'command']
+# ru_maxrss is in kilobytes on Linux, bytes on macOS
+RSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+MB = 1 << 20
+# seconds between checks for the exit of a child that cannot be waited for
+# without reaping it (see wait_child)
+REAP_POLL = 0.1
+
+# profile of the running command (see start_profile)
+_current = None
+
+
+def start_profile():
+    """
+    Start collecting a new profile, returned and used by `current_profile`
+    """
+    global _current
+    _current = Profile()
+    return _current
+
+def current_profile():
+    """
+    Profile being collected, or None
+    """
+    return _current
+
+def read_proc_io(path: str):
+    """
+    Bytes read and written (rchar, wchar) from a /proc/.../io file
+    Return: (read, written), or None if not available
+    """
+    try:
+        with open(path) as inF:
+            fields = dict(x.split(': ', 1) for x in inF.read().splitlines() if ': ' in x)
+        return int(fields['rchar']), int(fields['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+def thread_io():
+    """
+    Bytes read and written by the calling thread (Linux only; None elsewhere)
+    """
+    return read_proc_io('/proc/thread-self/io')
+
+def wait_child(pid: int, lock=None) -> tuple:
+    """
+    Wait for a child process and collect its resource usage, including that
+    of the descendants it waited for (e.g. the JVM started by a wrapper script).
+    The child is first waited for without reaping it, so that the I/O
+    counters of the exited process can still be read from /proc (on Linux).
+    lock: threading.Lock, held while the child is reaped (see runner.Pipeline.kill)
+    Return: (wait status, resource.struct_rusage, (read, written) bytes or None)
+    """
+    io = None
+    nowait = hasattr(os, 'waitid') and hasattr(os, 'WNOWAIT')
+    if nowait:
+        os.waitid(os.P_PID, pid, os.WEXITED | os.WNOWAIT)
+        io = read_proc_io(f'/proc/{pid}/io')
+    while True:
+        with lock if lock is not None else contextlib.nullcontext():
+            # without waitid, poll so that `lock` is only held briefly
+            done,status,rusage = os.wait4(pid, 0 if nowait else os.WNOHANG)
+        if done:
+            break
+        time.sleep(REAP_POLL)
+    if io is None:
+        # block I/O only
+        io = (rusage.ru_inblock * 512, rusage.ru_oublock * 512)
+    return status, rusage, io
+
+def tool_record(cmd: list, stage, wall: float, returncode: int, rusage, io) -> dict:
+    """
+    Profile record of one external command. On Linux, the peak RSS of a
+    child is at least the RSS of phyloFlash when the child was forked.
+    """
+    return {
+        'kind' : 'tool',
+        'stage' : stage,
+        'name' : os.path.basename(cmd[0]),
+        'status' : 'done' if returncode == 0 else f'exit {returncode}',
+        'wall_s' : round(wall, 3),
+        'cpu_s' : round(rusage.ru_utime + rusage.ru_stime, 3),
+        'user_s' : round(rusage.ru_utime, 3),
+        'sys_s' : round(rusage.ru_stime, 3),
+        'max_rss_mb' : round(rusage.ru_maxrss * RSS_UNIT / MB, 1),
+        'read_bytes' : io[0],
+        'write_bytes' : io[1],
+        'command' : ' '.join(cmd)
+    }
+
+
+class StageTimer(object):
+    """
+    Wall time, CPU time and I/O of a stage running in the current thread.
+    Only the work done in this thread is counted; external commands are
+    recorded separately (see tool_record) and added in Profile.stage_totals.
+    """
+    def __init__(self, name: str, resources=None):
+        self.name = name
+        self.resources = resources if resources is not None else {}
+
+    def __enter__(self):
+        self.t0 = time.time()
+        self.cpu0 = time.thread_time()
+        self.io0 = thread_io()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        profile = current_profile()
+        if profile is None:
+            return False
+        io1 = thread_io()
+        io = [b - a for a,b in zip(self.io0, io1)] if self.io0 and io1 else [None, None]
+        profile.add({
+            'kind' : 'stage',
+            'stage' : self.name,
+            'name' : self.name,
+            'status' : 'failed' if exc_type is not None else 'done',
+            'wall_s' : round(time.time() - self.t0, 3),
+            'cpu_s' : round(time.thread_time() - self.cpu0, 3),
+            'read_bytes' : io[0],
+            'write_bytes' : io[1],
+            'threads' : self.resources.get('threads'),
+            'memory_gb' : self.resources.get('memory')
+        })
+        return False
+
+
+class Profile(object):
+    """
+    Resource usage of the stages of a run and of every external command
+    they started, written as JSON and TSV and summarized in the log
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.records = []
+        self._lock = threading.Lock()
+
+    def add(self, record: dict) -> None:
+        with self._lock:
+            self.records.append(record)
+
+    def stage_totals(self) -> list:
+        """
+        Per-stage totals: wall time of the stage, CPU time and I/O of the
+        stage and its commands, and the peak RSS of its largest command.
+        Return: list of dicts, in order of completion
+        """
+        with self._lock:
+            records = list(self.records)
+        tools = {}
+        for rec in records:
+            if rec['kind'] == 'tool':
+                tools.setdefault(rec['stage'], []).append(rec)
+        totals = []
+        for rec in records:
+            if rec['kind'] != 'stage':
+                continue
+            total = dict(rec)
+            stage_tools = tools.get(rec['stage'], [])
+            total['tools'] = len(stage_tools)
+            total['cpu_s'] = round(rec['cpu_s'] + sum(x['cpu_s'] for x in stage_tools), 3)
+            total['max_rss_mb'] = max([x['max_rss_mb'] for x in stage_tools], default=None)
+            for k in ('read_bytes', 'write_bytes'):
+                values = [rec[k]] + [x[k] for x in stage_tools]
+                total[k] = sum(x for x in values if x is not None)
+            totals.append(total)
+        return totals
+
+    def totals(self) -> dict:
+        """
+        Run totals, including the peak RSS of this (Python) process
+        """
+        self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * RSS_UNIT / MB
+        tool_rss = [x['max_rss_mb'] for x in self.records if x['kind'] == 'tool']
+        return {
+            'started' : time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.started)),
+            'wall_s' : round(time.time() - self.started, 3),
+            'python_max_rss_mb' : round(self_rss, 1),
+            'tool_max_rss_mb' : max(tool_rss, default=None),
+            'cpu_s' : round(sum(x['cpu_s'] for x in self.records), 3)
+        }
+
+    def write(self, prefix: str) -> tuple:
+        """
+        Write <prefix>.json (totals, per-stage totals and all records) and
+        <prefix>.tsv (one line per stage and per command)
+        Return: (json file, tsv file)
+        """
+        json_file,tsv_file = f'{prefix}.json',f'{prefix}.tsv'
+        with open(json_file, 'w') as outF:
+            json.dump({'run' : self.totals(), 'stages' : self.stage_totals(),
+                       'records' : self.records}, outF, indent=1)
+        with open(tsv_file, 'w', newline='') as outF:
+            writer = csv.DictWriter(outF, PROFILE_COLUMNS, delimiter='\t', lineterminator='\n',
+                                    extrasaction='ignore', restval='')
+            writer.writeheader()
+            writer.writerows(self.records)
+        return json_file, tsv_file
+
+    def log_summary(self) -> None:
+        """
+        Log a table of per-stage wall time, CPU time, peak RSS and I/O
+        """
+        logging.info('Resource usage per stage (CPU and I/O include the external commands):')
+        logging.info(f'  {"stage":<32} {"wall_s":>9} {"cpu_s":>9} {"rss_mb":>9} {"read_mb":>9} {"write_mb":>9}')
+        for x in self.stage_totals():
+            rss = f'{x["max_rss_mb"]:.1f}' if x['max_rss_mb'] is not None else '-'
+            logging.info(f'  {x["stage"]:<32} {x["wall_s"]:>9.1f} {x["cpu_s"]:>9.1f} {rss:>9} '
+                         f'{x["read_bytes"] / MB:>9.1f} {x["write_bytes"] / MB:>9.1f}')
+        run = self.totals()
+        logging.info(f'  Total: {run["wall_s"]:.1f} s wall, {run["cpu_s"]:.1f} s CPU; peak RSS: '
+                     f'{run["tool_max_rss_mb"] or 0:.1f} MB (largest command), '
+                     f'{run["python_max_rss_mb"]:.1f} MB (phyloFlash)')
+
+def write_profile(profile, prefix: str) -> None:
+    """
+    Write the profile files and log the summary
+    """
+    if profile is None:
+        return
+    profile.log_summary()
+    json_file,tsv_file = profile.write(prefix)
+    logging.info(f'Profile written to {json_file} and {tsv_file}')
@@ -0,0 +1,411 @@
+#!/usr/bin/env python
+# import
+## batteries
+import os
+import time
+import shlex
+import signal
+import logging
+import tempfile
+import threading
+import contextlib
+from subprocess import Popen, PIPE, DEVNULL
+## package
+from phyloflash.profiling import current_profile, wait_child, tool_record
+
+# seconds between SIGTERM and SIGKILL when stopping a process group
+KILL_GRACE = 10
+# number of log lines quoted in error messages
+ERROR_LINES = 20
+# default time limit (seconds) of each command; None for no limit (see set_timeout)
+DEFAULT_TIMEOUT = None
+
+# (name, log file) of the stage running in the current thread (see stage_log)
+_local = threading.local()
+# pipelines currently running, stopped by terminate_all()
+_active = set()
+_lock = threading.Lock()
+_interrupted = False
+
+
+class CommandError(ValueError):
+    """
+    An external command failed, timed out or was interrupted
+    """
+    def __init__(self, message: str, log_file=None):
+        super().__init__(message)
+        self.log_file = log_file
+
+def format_cmd(cmds: list) -> str:
+    """
+    Shell-like representation of a command or pipeline, for logs and errors
+    """
+    return ' | '.join(' '.join(shlex.quote(str(x)) for x in cmd) for cmd in cmds)
+
+def set_timeout(seconds) -> None:
+    """
+    Set the default time limit of each command (None for no limit)
+    """
+    global DEFAULT_TIMEOUT
+    DEFAULT_TIMEOUT = seconds if seconds else None
+
+@contextlib.contextmanager
+def _stage_context(stage, log_file):
+    previous = getattr(_local, 'stage', (None, None))
+    _local.stage = (stage, log_file)
+    try:
+        yield log_file
+    finally:
+        _local.stage = previous
+
+def stage_log(log_file, stage=None):
+    """
+    Send the output of commands run by the current thread (that do not
+    name their own log file) to `log_file`, which is started afresh, and
+    attribute them to `stage` in the profile.
+    log_file: str, stage log file; None for temporary logs
+    stage: str, stage name
+    """
+    if log_file is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(log_file)), exist_ok=True)
+        open(log_file, 'wb').close()
+    return _stage_context(stage, log_file)
+
+def current_log():
+    """
+    Log file of the stage running in the current thread, or None
+    """
+    return getattr(_local, 'stage', (None, None))[1]
+
+def current_stage():
+    """
+    Name of the stage running in the current thread, or None
+    """
+    return getattr(_local, 'stage', (None, None))[0]
+
+def bind_stage(func):
+    """
+    Wrap `func` to run in the stage context of the calling thread,
+    e.g. for jobs submitted to a thread pool by a stage
+    """
+    context = getattr(_local, 'stage', (None, None))
+    def wrapper(*args, **kwargs):
+        with _stage_context(*context):
+            return func(*args, **kwargs)
+    return wrapper
+
+def _tail(logF, n=ERROR_LINES, size=1 << 16) -> str:
+    """
+    Last `n` lines of an open (binary) log file
+    """
+    logF.flush()
+    logF.seek(0, os.SEEK_END)
+    end = logF.tell()
+    logF.seek(max(0, end - size))
+    lines = logF.read().decode(errors='replace').splitlines()
+    return '\n'.join(lines[-n:])
+
+
+class Pipeline(object):
+    """
+    A command, or several commands connected by OS pipes (stdout of each
+    to stdin of the next), run without a shell. stderr of all commands is
+    written directly to the log file by the children, so output is never
+    held in memory. Each command runs in its own process group, which is
+    terminated as a whole (e.g. a bbtools wrapper script and its JVM) on
+    timeout, on interrupt, or when the pipeline is left early.
+    cmds: list of argv lists
+    log_file: str, log file (appended to); default: the current stage log,
+      or a temporary file that is only used for error messages
+    stdin: str, input file of the first command (default: no input); PIPE
+      to write it to `self.stdin`
+    stdout: str, output file of the last command; PIPE to read it from
+      `self.stdout`; default: the log file
+    timeout: float, time limit in seconds (default: DEFAULT_TIMEOUT)
+    append: bool, append to the log file (False: start it afresh)
+    """
+    def __init__(self, cmds: list, log_file=None, stdin=None, stdout=None, timeout=None,
+                 append=True):
+        self.cmds = [[str(x) for x in cmd] for cmd in cmds]
+        self.log_file = log_file if log_file is not None else current_log()
+        self.stage = current_stage()
+        self.stdin_file = stdin
+        self.stdin = None
+        self.stdout_file = stdout
+        self.timeout = timeout if timeout is not None else DEFAULT_TIMEOUT
+        self.append = append
+        self.procs = []
+        self.stdout = None
+        self.timed_out = False
+        self.interrupted = False
+        self._log = None
+        self._timer = None
+        # held while a command is reaped or signalled (see kill)
+        self._reap_lock = threading.Lock()
+
+    def __str__(self):
+        return format_cmd(self.cmds)
+
+    def start(self):
+        """
+        Start all commands of the pipeline
+        """
+        if self.log_file is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.log_file)), exist_ok=True)
+            self._log = open(self.log_file, 'a+b' if self.append else 'w+b')
+        else:
+            self._log = tempfile.TemporaryFile()
+        self._log.write(f'[{time.strftime("%Y-%m-%d %H:%M:%S")}] $ {self}\n'.encode())
+        self._log.flush()
+        with _lock:
+            if _interrupted:
+                self._log.close()
+                raise CommandError(f'Not running {self}: interrupted')
+            _active.add(self)
+        self._t0 = time.time()
+        if self.stdin_file is None:
+            inF = DEVNULL
+        elif self.stdin_file is PIPE:
+            inF = PIPE
+        else:
+            inF = open(self.stdin_file, 'rb')
+        outF = None
+        try:
+            if self.stdout_file is None:
+                outF = self._log
+            elif self.stdout_file is PIPE:
+                outF = PIPE
+            else:
+                outF = open(self.stdout_file, 'wb')
+            upstream = inF
+            for i,cmd in enumerate(self.cmds):
+                last = i == len(self.cmds) - 1
+                p = Popen(cmd, stdin=upstream, stdout=outF if last else PIPE,
+                          stderr=self._log, start_new_session=True)
+                self.procs.append(p)
+                # the child holds its own copy of the pipe
+                if i > 0:
+                    upstream.close()
+                upstream = p.stdout
+        except OSError as e:
+            self.kill()
+            for p in self.procs:
+                self._reap(p)
+            self._finish()
+            self._log.close()
+            raise CommandError(f'Error running {self}: {e}', self.log_file)
+        finally:
+            for fh in (inF, outF):
+                if fh not in (DEVNULL, PIPE, None, self._log):
+                    fh.close()
+        if self.stdin_file is PIPE:
+            self.stdin = self.procs[0].stdin
+        if self.stdout_file is PIPE:
+            self.stdout = self.procs[-1].stdout
+        if self.timeout is not None:
+            self._timer = threading.Timer(self.timeout, self._expire)
+            self._timer.daemon = True
+            self._timer.start()
+        return self
+
+    def _expire(self) -> None:
+        self.timed_out = True
+        logging.warning(f'Time limit of {self.timeout:g} s reached, stopping: {self}')
+        self.kill()
+
+    def kill(self) -> None:
+        """
+        Terminate the process groups of all commands still running:
+        SIGTERM, then SIGKILL after KILL_GRACE seconds. The commands are
+        reaped by the thread waiting for the pipeline, under the same lock,
+        so that a process group is never signalled once its pid may have
+        been reused.
+        """
+        with self._reap_lock:
+            alive = [p for p in self.procs if _unreaped(p)]
+            for p in alive:
+                _signal_group(p, signal.SIGTERM)
+        if alive:
+            timer = threading.Timer(KILL_GRACE, self._force_kill)
+            timer.daemon = True
+            timer.start()
+
+    def _force_kill(self) -> None:
+        with self._reap_lock:
+            for p in self.procs:
+                if _unreaped(p):
+                    _signal_group(p, signal.SIGKILL)
+
+    def _reap(self, p: Popen) -> int:
+        """
+        Wait for one command and add its resource usage to the profile
+        Return: int, exit code (negative signal number if killed)
+        """
+        if p.returncode is None:
+            status,rusage,io = wait_child(p.pid, self._reap_lock)
+            if os.WIFSIGNALED(status):
+                p.returncode = -os.WTERMSIG(status)
+            else:
+                p.returncode = os.WEXITSTATUS(status)
+            profile = current_profile()
+            if profile is not None:
+                profile.add(tool_record(p.args, self.stage, time.time() - self._t0,
+                                        p.returncode, rusage, io))
+        return p.returncode
+
+    def _finish(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+        with _lock:
+            _active.discard(self)
+
+    def close_stdin(self) -> None:
+        """
+        Close the input pipe (end of input); the command may already have exited
+        """
+        if self.stdin is not None and not self.stdin.closed:
+            try:
+                self.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    def wait(self) -> list:
+        """
+        Wait for all commands to finish and check their exit codes
+        Return: list, exit codes
+        """
+        self.close_stdin()
+        try:
+            rcs = [self._reap(p) for p in self.procs]
+        except BaseException:
+            self.kill()
+            raise
+        finally:
+            self._finish()
+            if self.stdout is not None:
+                self.stdout.close()
+        if self.timed_out:
+            msg = f'Time limit of {self.timeout:g} s exceeded'
+        elif self.interrupted:
+            msg = 'Interrupted'
+        elif any(rcs):
+            msg = ', '.join(f'{cmd[0]} exited with code {rc}'
+                            for cmd,rc in zip(self.cmds, rcs) if rc)
+        else:
+            self._log.close()
+            return rcs
+        msg = f'Error running {self}: {msg}'
+        tail = _tail(self._log)
+        self._log.close()
+        if self.log_file is not None:
+            msg += f' (log: {self.log_file})'
+        raise CommandError(f'{msg}\n{tail}', self.log_file)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close_stdin()
+        if self.stdout is not None:
+            self.stdout.close()
+        # left early (error or consumer stopped reading): stop the commands
+        if any(p.returncode is None for p in self.procs):
+            self.kill()
+            for p in self.procs:
+                self._reap(p)
+        self._finish()
+        if not self._log.closed:
+            self._log.close()
+        return False
+
+def _unreaped(p: Popen) -> bool:
+    """
+    Whether a command has not been reaped yet, i.e. its pid (and process
+    group) cannot have been reused; exited but unreaped commands count
+    """
+    if p.returncode is not None:
+        return False
+    if hasattr(os, 'waitid') and hasattr(os, 'WNOWAIT'):
+        try:
+            os.waitid(os.P_PID, p.pid, os.WEXITED | os.WNOHANG | os.WNOWAIT)
+        except ChildProcessError:
+            return False
+    return True
+
+def _signal_group(p: Popen, sig) -> None:
+    try:
+        os.killpg(p.pid, sig)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+def run(cmd: list, log_file=None, stdin=None, stdout=None, timeout=None, append=True) -> None:
+    """
+    Run a command (argv list) and check for errors; see Pipeline for the arguments
+    """
+    run_pipeline([cmd], log_file, stdin, stdout, timeout, append)
+
+def run_pipeline(cmds: list, log_file=None, stdin=None, stdout=None, timeout=None,
+                 append=True) -> None:
+    """
+    Run commands connected by pipes and check for errors; see Pipeline for the arguments
+    """
+    with Pipeline(cmds, log_file, stdin, stdout, timeout, append) as p:
+        p.wait()
+
+def feed(cmd: list, chunks, log_file=None, stdout=None, timeout=None, append=True) -> None:
+    """
+    Run a command with its input written from `chunks` (e.g. reads streamed
+    from a remote file), and check for errors. If the command exits before
+    reading all input, the remaining chunks are not consumed.
+    chunks: iterable of bytes
+    """
+    with Pipeline([cmd], log_file, PIPE, stdout, timeout, append) as p:
+        try:
+            for chunk in chunks:
+                p.stdin.write(chunk)
+        except BrokenPipeError:
+            pass
+        finally:
+            close = getattr(chunks, 'close', None)
+            if close is not None:
+                close()
+        p.wait()
+
+def stream(cmd: list, log_file=None, timeout=None):
+    """
+    Run a command and yield the lines of its stdout as they are written.
+    The exit code is checked once all output has been read; closing the
+    generator early stops the command.
+    Return: generator of lines (bytes)
+    """
+    with Pipeline([cmd], log_file, stdout=PIPE, timeout=timeout) as p:
+        yield from p.stdout
+        p.wait()
+
+def terminate_all() -> None:
+    """
+    Stop all running commands and refuse to start new ones
+    """
+    global _interrupted
+    with _lock:
+        _interrupted = True
+        running = list(_active)
+    for p in running:
+        p.interrupted = True
+    for p in running:
+        p.kill()
+
+def install_signal_handlers() -> None:
+    """
+    On SIGINT/SIGTERM, stop all running commands before exiting. Commands
+    run in their own process groups, so they do not receive the signal.
+    """
+    def handler(signum, frame):
+        logging.warning(f'Received signal {signum}, stopping all running commands...')
+        signal.signal(signum, signal.SIG_DFL)
+        terminate_all()
+        if signum == signal.SIGINT:
+            raise KeyboardInterrupt
+        raise SystemExit(128 + signum)
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, handler)
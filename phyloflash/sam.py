@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+# import
+## batteries
+import re
+import logging
+## package
+from phyloflash.fasta import open_fasta
+from phyloflash.taxonomy import TaxonomyTrie, ConsensusCounter
+
+# SAM flag bits
+FLAG_PAIRED = 0x1
+FLAG_PROPER = 0x2
+FLAG_UNMAPPED = 0x4
+FLAG_MATE_UNMAPPED = 0x8
+FLAG_REVERSE = 0x10
+FLAG_MATE_REVERSE = 0x20
+FLAG_FIRST = 0x40
+FLAG_LAST = 0x80
+FLAG_SECONDARY = 0x100
+# Block size for reading/writing SAM files
+BLOCKSIZE = 1 << 22
+# SILVA reference name: "<accession>.<start>.<end> <taxonomy string>"
+SILVA_RNAME = re.compile(rb'\w+\.\d+\.\d+\s(.+)')
+# bbmap log lines with the number of input reads and the insert size
+BBMAP_LOG = {
+    'reads' : re.compile(rb'^Reads Used:\s+(\d+)'),
+    'insert_median' : re.compile(rb'^insert median:\s+(\d+)'),
+    'insert_std' : re.compile(rb'^insert std dev:\s+(\d+)')
+}
+
+
+class SamRecord(object):
+    """
+    One SAM alignment, holding only the columns used for processing.
+    The remaining columns (POS to the optional fields) are kept unparsed
+    in `rest`, so that the record can be written back unchanged.
+    """
+    __slots__ = ('qname', 'flag', 'rname', 'rest')
+
+    def __init__(self, qname: bytes, flag: int, rname: bytes, rest: bytes):
+        self.qname = qname
+        self.flag = flag
+        self.rname = rname
+        self.rest = rest
+
+    @classmethod
+    def from_line(cls, line: bytes):
+        """
+        Parse a SAM line; the read name is cut at the first whitespace
+        """
+        qname,flag,rname,rest = line.rstrip(b'\r\n').split(b'\t', 3)
+        return cls(qname.split(None, 1)[0], int(flag), rname, rest)
+
+    def to_line(self) -> bytes:
+        return b'\t'.join((self.qname, b'%d' % self.flag, self.rname, self.rest)) + b'\n'
+
+    def taxonomy(self):
+        """
+        Taxonomy string of a SILVA reference hit, or None if the reference
+        name is not a SILVA header
+        """
+        m = SILVA_RNAME.search(self.rname)
+        return m.group(1) if m else None
+
+    def __repr__(self):
+        return f'SamRecord({self.qname!r}, {self.flag}, {self.rname!r})'
+
+def read_sam(sam_file: str, header_func=None):
+    """
+    Stream alignments from a (possibly gzip-compressed) SAM file.
+    sam_file: str, SAM file path
+    header_func: callable, called with each header line (bytes)
+    Return: generator of SamRecord objects
+    """
+    with open_fasta(sam_file, BLOCKSIZE) as inF:
+        for line in inF:
+            if line.startswith(b'@'):
+                if header_func is not None:
+                    header_func(line)
+                continue
+            if line.strip():
+                yield SamRecord.from_line(line)
+
+def group_bbmap_sam(records, paired=True):
+    """
+    Group bbmap alignments by read (pair), fixing bbmap's handling of
+    secondary alignments of the reverse read on the way: these carry the
+    name and the 0x40 flag of the forward read instead of 0x80.
+    A new group starts at each primary alignment of a first segment
+    (or of any read, for single-end reads), so only one group is held
+    in memory at a time.
+    records: iterable of SamRecord objects, in bbmap output order
+    paired: bool, paired-end reads
+    Return: generator of (read name, [SamRecord, ...]) tuples
+    """
+    key = None
+    group = []
+    rev = False
+    for rec in records:
+        flag = rec.flag
+        secondary = flag & FLAG_SECONDARY
+        if not secondary and (not paired or flag & FLAG_FIRST):
+            if group:
+                yield key, group
+            key = rec.qname
+            group = []
+            rev = False
+        elif paired and not secondary and flag & FLAG_LAST:
+            rev = True
+        if key is None:
+            key = rec.qname
+        if secondary and rev and flag & FLAG_FIRST:
+            rec.qname = key
+            rec.flag = flag - FLAG_FIRST + FLAG_LAST
+        group.append(rec)
+    if group:
+        yield key, group
+
+def read_bbmap_log(log_file: str) -> dict:
+    """
+    Number of input read segments and the insert size statistics from a bbmap log
+    Return: dict, {'reads' : int, 'insert_median' : int, 'insert_std' : int} (None if missing)
+    """
+    values = {k : None for k in BBMAP_LOG}
+    with open(log_file, 'rb') as inF:
+        for line in inF:
+            for k,regex in BBMAP_LOG.items():
+                m = regex.match(line)
+                if m:
+                    values[k] = int(m.group(1))
+    return values
+
+
+class MapStats(object):
+    """
+    Mapping statistics of reads against the SSU database, counted from
+    the flags of each alignment (secondary alignments are ignored).
+    paired: bool, paired-end reads
+    """
+    def __init__(self, paired=True):
+        self.paired = paired
+        self.fwd = 0           # forward segments mapping
+        self.rev = 0           # reverse segments mapping
+        self.pairs = 0         # segments of pairs mapping to the same reference
+        self.bad_pairs = 0     # segments of pairs mapping to different references
+        self.half = 0          # segments whose mate is unmapped
+        self.unmapped = 0      # unmapped segments
+
+    def add(self, flag: int) -> None:
+        """
+        Count one alignment
+        """
+        if flag & FLAG_SECONDARY:
+            return
+        if self.paired:
+            if not flag & FLAG_UNMAPPED:
+                if flag & FLAG_FIRST:
+                    self.fwd += 1
+                elif flag & FLAG_LAST:
+                    self.rev += 1
+        elif flag == 0 or flag & FLAG_REVERSE:
+            self.fwd += 1
+        if flag & FLAG_PROPER:
+            self.pairs += 1
+        elif flag & FLAG_MATE_UNMAPPED:
+            self.half += 1
+        elif flag & FLAG_UNMAPPED:
+            self.unmapped += 1
+        else:
+            self.bad_pairs += 1
+
+    def total_pairs(self):
+        """
+        Read pairs (or reads) with at least one segment mapping
+        """
+        if self.paired:
+            return self.pairs / 2 + self.bad_pairs / 2 + self.half
+        return self.pairs + self.bad_pairs + self.half
+
+    def low_coverage(self, read_length: int) -> bool:
+        """
+        Whether the mapped reads cover less than one SSU (1800 bp),
+        too little for assembly
+        """
+        return self.total_pairs() * 2 * read_length < 1800
+
+    def summary(self, readnr: int) -> dict:
+        """
+        Mapping statistics as reported by phyloFlash, with the mapping
+        ratios for the pie chart under 'mapratio'.
+        readnr: int, number of read segments input to the mapper
+        """
+        total = self.total_pairs()
+        readnr_pairs = readnr / 2 if self.paired else readnr
+        ratio = total / readnr_pairs if readnr_pairs else 0
+        if self.paired:
+            mapratio = [('Mapped pair', self.pairs),
+                        ('Mapped bad pair', self.bad_pairs),
+                        ('Mapped single', self.half)]
+        else:
+            mapratio = [('Unmapped', (1 - ratio) * readnr),
+                        ('Mapped', ratio * readnr)]
+        return {
+            'total_reads' : readnr_pairs,
+            'total_read_segments' : readnr,
+            'ssu_fwd_seg_map' : self.fwd,
+            'ssu_rev_seg_map' : self.rev,
+            'ssu_tot_map' : self.fwd + self.rev,
+            'ssu_tot_pair_map' : total,
+            'ssu_tot_pair_ratio' : ratio,
+            'ssu_tot_pair_ratio_pc' : f'{ratio * 100:.3f}',
+            'mapratio' : mapratio
+        }
+
+
+def diversity_stats(counts: dict) -> tuple:
+    """
+    Chao1 estimate from taxon counts.
+    Return: (chao1 or 'n.d.', 1-tons, 2-tons, 3+-tons)
+    """
+    oneton = sum(1 for x in counts.values() if x == 1)
+    twoton = sum(1 for x in counts.values() if x == 2)
+    moreton = sum(1 for x in counts.values() if x >= 3)
+    if twoton > 0:
+        chao = moreton + oneton * oneton / 2 / twoton
+    else:
+        chao = 'n.d.'
+    return chao, oneton, twoton, moreton
+
+
+class TaxonomyCollector(object):
+    """
+    Taxon counts from the SILVA hits of each read group. By default the
+    consensus (lowest common ancestor) of all ambiguous hits of a read is
+    counted; with `tophit`, only the primary alignment is used. Hits are
+    resolved to nodes of a TaxonomyTrie once per distinct taxonomy string.
+    levels: list, taxonomic levels (1-based) to count at
+    tophit: bool, count the taxonomy of the primary alignment only
+    trie: TaxonomyTrie, e.g. built from the database (default: built from the hits)
+    keep_reads: bool, keep the consensus of each read, for counting subsets of reads
+    """
+    def __init__(self, levels=(4, 7), tophit=False, trie=None, keep_reads=False):
+        self.levels = list(levels)
+        self.tophit = tophit
+        self.trie = trie if trie is not None else TaxonomyTrie()
+        self.reads = ConsensusCounter(self.trie, pad=not tophit, keep_reads=keep_reads)
+        self.malformed = 0
+
+    def add_group(self, group: list) -> None:
+        """
+        Count the reads in one group of alignments (see group_bbmap_sam)
+        """
+        hits = {}
+        for rec in group:
+            if rec.flag & FLAG_UNMAPPED:
+                continue
+            if self.tophit and rec.flag & FLAG_SECONDARY:
+                continue
+            tax = rec.taxonomy()
+            if tax is None:
+                self.malformed += 1
+                logging.warning(f'Malformed database entry for {rec.rname.decode(errors="replace")}')
+                continue
+            node = self.trie.node(tax)
+            if self.tophit:
+                self.reads.add((node,))
+            else:
+                hits.setdefault(rec.qname, []).append(node)
+        for read,nodes in hits.items():
+            self.reads.add(nodes, read)
+
+    def counts(self, reads=None) -> dict:
+        """
+        {level : {taxonomy string : read count}} for all reads, or for the
+        given read names (requires keep_reads)
+        """
+        return self.reads.counts(self.levels, reads)
+
+    def taxa(self, level: int) -> dict:
+        """
+        {taxonomy string : read count} at a taxonomic level
+        """
+        return self.reads.counts([level])[level]
+
+
+def process_bbmap_sam(sam_file: str, out_file=None, paired=True, levels=(4, 7), tophit=False,
+                      trie=None) -> tuple:
+    """
+    Single streaming pass over a bbmap SAM file that fixes the flags of
+    secondary alignments, writes the fixed SAM file, counts the mapping
+    statistics and collects the read taxonomy. Memory use is bounded by
+    the largest group of alignments of one read (pair).
+    sam_file: str, SAM file written by bbmap
+    out_file: str, fixed SAM file (None to skip writing)
+    paired: bool, paired-end reads
+    levels: list, taxonomic levels (1-based) to count at
+    tophit: bool, count the taxonomy of the primary alignment only
+    trie: TaxonomyTrie, taxonomy of the database (see TaxonomyTrie.from_acc2tax)
+    Return: (MapStats, TaxonomyCollector)
+    """
+    stats = MapStats(paired)
+    taxonomy = TaxonomyCollector(levels, tophit, trie)
+    outF = open(out_file, 'wb', buffering=BLOCKSIZE) if out_file is not None else None
+    header_func = outF.write if outF is not None else None
+    n_records = 0
+    n_groups = 0
+    try:
+        for _,group in group_bbmap_sam(read_sam(sam_file, header_func), paired):
+            n_groups += 1
+            n_records += len(group)
+            for rec in group:
+                stats.add(rec.flag)
+            taxonomy.add_group(group)
+            if outF is not None:
+                outF.write(b''.join(rec.to_line() for rec in group))
+    finally:
+        if outF is not None:
+            outF.close()
+    logging.info(f'  Processed {n_records} alignments of {n_groups} reads from {sam_file}')
+    logging.info(f'  Forward read segments mapping: {stats.fwd}')
+    logging.info(f'  Reverse read segments mapping: {stats.rev}')
+    return stats, taxonomy
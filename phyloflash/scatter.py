@@ -0,0 +1,436 @@
+#!/usr/bin/env python
+# import
+## batteries
+import os
+import re
+import json
+import math
+import time
+import uuid
+import shutil
+import socket
+import logging
+import threading
+## package
+from phyloflash.runner import run
+
+# memory (GB) of partition.sh, which streams the reads
+PARTITION_MEMORY = 2
+# seconds between checks of the job queue
+POLL_SECONDS = 5
+# seconds between heartbeats of a worker running a job; a job without
+# heartbeat for STALE_SECONDS is returned to the queue (its worker died)
+HEARTBEAT_SECONDS = 30
+STALE_SECONDS = 300
+# queue subdirectories, one per job state
+QUEUE_DIRS = ('pending', 'running', 'done')
+# placeholders in queued commands, filled in with the resources of the worker
+THREADS = '{threads}'
+MEMORY = '{memory}'
+# summary statistics in bbmap histogram headers ("#Mean\t253.5", "#Median_reads\t100"),
+# recomputed from the merged histogram
+HIST_STAT = re.compile(r'^(Mean|Median|Mode|STDev)(?:_(\w+))?$')
+# read and base count of a bbmap log
+BBMAP_READS = re.compile(rb'^Reads Used:\s+(\d+)(?:\s+\((\d+) bases\))?')
+
+def chunk_reads(scatter_dir: str, n: int, paired=True) -> list:
+    """
+    Read files of the chunks written by partition.sh (see partition_cmd)
+    Return: list of (read1, read2 or None) tuples
+    """
+    return [(os.path.join(scatter_dir, f'chunk{i}_1.fq.gz'),
+             os.path.join(scatter_dir, f'chunk{i}_2.fq.gz') if paired else None)
+            for i in range(n)]
+
+def partition_cmd(scatter_dir: str, n: int, paired=True, read_limit=None, threads=1,
+                  memory=2) -> list:
+    """
+    partition.sh command splitting the reads (pairs) of a library
+    round-robin into `n` gzip-compressed chunks (input arguments not included)
+    """
+    cmd = ['partition.sh', f'-Xmx{memory}g', f'ways={n}', f'threads={threads}',
+           f'out={os.path.join(scatter_dir, "chunk%_1.fq.gz")}', 'zl=1', 'overwrite=t',
+           f'reads={read_limit if read_limit is not None else -1}']
+    if paired:
+        cmd.append(f'out2={os.path.join(scatter_dir, "chunk%_2.fq.gz")}')
+    return cmd
+
+
+class JobQueue(object):
+    """
+    Queue of external commands in a directory on a shared file system,
+    run by `phyloflash scatter-worker` processes on any host that sees it.
+    A job is a JSON file that moves from pending/ to running/ (claimed by
+    an atomic rename) to done/ (with the exit code). The command may hold
+    the THREADS and MEMORY placeholders, filled in by the worker.
+    queue_dir: str, queue directory
+    """
+    def __init__(self, queue_dir: str):
+        self.queue_dir = queue_dir
+        for x in QUEUE_DIRS:
+            os.makedirs(os.path.join(queue_dir, x), exist_ok=True)
+
+    def path(self, state: str, job_id: str) -> str:
+        return os.path.join(self.queue_dir, state, f'{job_id}.json')
+
+    def _write(self, file_path: str, data: dict) -> None:
+        tmp_file = f'{file_path}.{socket.gethostname()}.{os.getpid()}.tmp'
+        with open(tmp_file, 'w') as outF:
+            json.dump(data, outF, indent=1)
+        os.replace(tmp_file, file_path)
+
+    def submit(self, name: str, cmd: list, log_file: str, timeout=None) -> str:
+        """
+        Add a job; all paths must be absolute and visible to the workers
+        Return: str, job ID
+        """
+        job_id = f'{name}.{uuid.uuid4().hex[:12]}'
+        job = {'id' : job_id, 'cmd' : [str(x) for x in cmd], 'log_file' : log_file,
+               'timeout' : timeout, 'submitted' : time.time()}
+        self._write(self.path('pending', job_id), job)
+        return job_id
+
+    def claim(self):
+        """
+        Claim the oldest pending job
+        Return: (job ID, job dict), or None if there is none
+        """
+        for name in sorted(os.listdir(os.path.join(self.queue_dir, 'pending'))):
+            if not name.endswith('.json'):
+                continue
+            job_id = name[:-len('.json')]
+            try:
+                os.rename(self.path('pending', job_id), self.path('running', job_id))
+            except FileNotFoundError:
+                # claimed by another worker
+                continue
+            os.utime(self.path('running', job_id))
+            with open(self.path('running', job_id)) as inF:
+                return job_id, json.load(inF)
+        return None
+
+    def finish(self, job_id: str, result: dict) -> None:
+        self._write(self.path('done', job_id), result)
+        try:
+            os.remove(self.path('running', job_id))
+        except FileNotFoundError:
+            pass
+
+    def cancel(self, job_ids: list) -> None:
+        """
+        Remove jobs that have not been claimed yet
+        """
+        for job_id in job_ids:
+            try:
+                os.remove(self.path('pending', job_id))
+            except FileNotFoundError:
+                pass
+
+    def wait(self, job_ids: list, poll=POLL_SECONDS) -> dict:
+        """
+        Wait for jobs to finish. Running jobs without a heartbeat for
+        STALE_SECONDS (since this call saw them running) are requeued.
+        Return: dict, {job ID : result}
+        Raise: ValueError if a job failed
+        """
+        results = {}
+        running_since = {}
+        try:
+            while len(results) < len(job_ids):
+                for job_id in job_ids:
+                    if job_id in results:
+                        continue
+                    try:
+                        with open(self.path('done', job_id)) as inF:
+                            results[job_id] = json.load(inF)
+                        os.remove(self.path('done', job_id))
+                        continue
+                    except (FileNotFoundError, ValueError):
+                        pass
+                    try:
+                        mtime = os.stat(self.path('running', job_id)).st_mtime
+                    except FileNotFoundError:
+                        continue
+                    now = time.time()
+                    since = running_since.setdefault(job_id, now)
+                    if now - since > STALE_SECONDS and now - mtime > STALE_SECONDS:
+                        logging.warning(f'  No heartbeat from the worker of job {job_id}; requeuing it')
+                        try:
+                            os.rename(self.path('running', job_id), self.path('pending', job_id))
+                        except FileNotFoundError:
+                            pass
+                        running_since.pop(job_id)
+                if len(results) < len(job_ids):
+                    time.sleep(poll)
+        finally:
+            self.cancel([x for x in job_ids if x not in results])
+        failed = [x for x in job_ids if results[x]['returncode'] != 0]
+        if failed:
+            first = results[failed[0]]
+            raise ValueError(f'{len(failed)} of {len(job_ids)} queued jobs failed; {failed[0]} on '
+                             f'{first["host"]}: {first["error"]}')
+        return results
+
+def run_job(job: dict, threads=1, memory=4) -> None:
+    """
+    Run a queued command with the resources of this worker
+    """
+    cmd = [x.replace(THREADS, str(threads)).replace(MEMORY, str(memory)) for x in job['cmd']]
+    run(cmd, log_file=job['log_file'], append=False, timeout=job.get('timeout'))
+
+def _heartbeat(file_path: str, stop: threading.Event) -> None:
+    while not stop.wait(HEARTBEAT_SECONDS):
+        try:
+            os.utime(file_path)
+        except FileNotFoundError:
+            return
+
+def worker(args) -> None:
+    """
+    Run jobs from a queue directory until it has been idle for
+    --idle-exit minutes (or forever), or --max-jobs jobs were run
+    """
+    queue = JobQueue(args.queue_dir)
+    host = f'{socket.gethostname()}:{os.getpid()}'
+    logging.info(f'Worker {host} waiting for jobs in {args.queue_dir} '
+                 f'({args.threads} threads, {args.memory} GB)')
+    n_jobs = 0
+    idle_since = time.time()
+    while args.max_jobs is None or n_jobs < args.max_jobs:
+        claimed = queue.claim()
+        if claimed is None:
+            if args.idle_exit is not None and time.time() - idle_since > args.idle_exit * 60:
+                break
+            time.sleep(args.poll)
+            continue
+        job_id,job = claimed
+        logging.info(f'Running job {job_id}')
+        stop = threading.Event()
+        beat = threading.Thread(target=_heartbeat, args=(queue.path('running', job_id), stop),
+                                daemon=True)
+        beat.start()
+        t0 = time.time()
+        result = {'host' : host, 'returncode' : 0, 'error' : None}
+        try:
+            run_job(job, args.threads, args.memory)
+        except Exception as e:
+            result.update(returncode=1, error=(str(e).splitlines() or [repr(e)])[0])
+            logging.warning(f'  Job {job_id} failed: {e}')
+        finally:
+            stop.set()
+        result['seconds'] = round(time.time() - t0, 3)
+        queue.finish(job_id, result)
+        n_jobs += 1
+        idle_since = time.time()
+    logging.info(f'Worker {host} finished after {n_jobs} jobs')
+
+def main(args):
+    worker(args)
+
+
+# merging of the bbmap outputs of the chunks
+
+def concat_files(files: list, out_file: str) -> str:
+    """
+    Concatenate files (missing files are skipped)
+    """
+    with open(out_file, 'wb') as outF:
+        for in_file in files:
+            if os.path.exists(in_file):
+                with open(in_file, 'rb') as inF:
+                    shutil.copyfileobj(inF, outF, 1 << 20)
+    return out_file
+
+def bbmap_log_reads(log_file: str) -> tuple:
+    """
+    Number of reads and bases used, from a bbmap log
+    Return: (reads, bases); 0 if missing
+    """
+    reads,bases = 0,0
+    with open(log_file, 'rb') as inF:
+        for line in inF:
+            m = BBMAP_READS.match(line)
+            if m:
+                reads,bases = int(m.group(1)),int(m.group(2) or 0)
+    return reads, bases
+
+def _number(text: str):
+    try:
+        return int(text)
+    except ValueError:
+        return float(text)
+
+def _decimals(text: str) -> int:
+    return len(text) - text.index('.') - 1 if '.' in text else 0
+
+def read_histogram(hist_file: str) -> dict:
+    """
+    Parse a bbmap histogram/statistics table: "#Name<TAB>value" summary
+    lines, a "#"-prefixed column header and rows of numbers keyed by the
+    first column
+    Return: dict, {'stats' : [(name, value)], 'columns' : list, 'rows' : {key : [numbers]},
+      'decimals' : [decimals of each value column]}
+    """
+    hist = {'stats' : [], 'columns' : None, 'rows' : {}, 'decimals' : []}
+    with open(hist_file) as inF:
+        for line in inF:
+            fields = line.rstrip('\r\n').split('\t')
+            if line.startswith('#'):
+                fields[0] = fields[0][1:]
+                if len(fields) == 2 and hist['columns'] is None and fields[1] and \
+                   not fields[1][0].isalpha():
+                    hist['stats'].append((fields[0], fields[1]))
+                else:
+                    hist['columns'] = fields
+                continue
+            if not fields[0]:
+                continue
+            hist['rows'][fields[0]] = [_number(x) for x in fields[1:]]
+            decimals = [_decimals(x) for x in fields[1:]]
+            hist['decimals'] = [max(x) for x in zip(decimals, hist['decimals'] + [0] * len(decimals))]
+    return hist
+
+def histogram_stat(name: str, rows: dict, column: int) -> float:
+    """
+    Mean, Median, Mode or STDev of the first column (values) weighted by a count column
+    """
+    points = sorted((float(k), v[column]) for k,v in rows.items())
+    total = sum(w for _,w in points)
+    if total == 0:
+        return 0
+    if name == 'Mode':
+        return max(points, key=lambda x: x[1])[0]
+    if name == 'Median':
+        cum = 0
+        for x,w in points:
+            cum += w
+            if cum >= total / 2:
+                return x
+    mean = sum(x * w for x,w in points) / total
+    if name == 'Mean':
+        return mean
+    return math.sqrt(sum(w * (x - mean) ** 2 for x,w in points) / total)
+
+def _format(value, decimals: int) -> str:
+    return f'{value:.{decimals}f}' if decimals else str(int(round(value)))
+
+def merge_histograms(hist_files: list, out_file: str, weights: list, average=False) -> str:
+    """
+    Merge the bbmap histograms of the chunks of a library
+    hist_files: list, histogram of each chunk (missing files are skipped)
+    weights: list, number of reads of each chunk
+    average: bool, rows hold fractions (base composition, bhist) and are
+      averaged weighted by the reads of each chunk; otherwise rows hold
+      counts (insert size, identity) and are summed
+    Return: str, out_file; or None if there was no histogram
+    """
+    hists = [(read_histogram(x), w) for x,w in zip(hist_files, weights) if os.path.exists(x)]
+    if not hists:
+        return None
+    columns = next((h['columns'] for h,_ in hists if h['columns']), None)
+    keys = []
+    for h,_ in hists:
+        keys += [k for k in h['rows'] if k not in keys]
+    # in the order of the chunks' rows (descending for the identity histogram)
+    first = next((list(h['rows']) for h,_ in hists if len(h['rows']) > 1), keys)
+    keys.sort(key=float, reverse=float(first[0]) > float(first[-1]) if first else False)
+    n_values = max(len(r) for h,_ in hists for r in h['rows'].values()) if keys else 0
+    decimals = [max(h['decimals'][i] if i < len(h['decimals']) else 0 for h,_ in hists)
+                for i in range(n_values)]
+    rows = {}
+    for k in keys:
+        present = [(h['rows'][k], w) for h,w in hists if k in h['rows']]
+        if average:
+            total = sum(w for _,w in present)
+            rows[k] = [sum(r[i] * w for r,w in present) / total if total else
+                       sum(r[i] for r,_ in present) / len(present) for i in range(n_values)]
+        else:
+            rows[k] = [sum(r[i] for r,_ in present) for i in range(n_values)]
+    # summary statistics: recomputed from the histogram, or averaged weighted by reads
+    stats = []
+    total_weight = sum(w for _,w in hists)
+    for name,value in hists[0][0]['stats']:
+        m = HIST_STAT.match(name)
+        column = 0
+        if m and m.group(2) and columns:
+            lower = [x.lower() for x in columns]
+            column = lower.index(m.group(2).lower()) - 1 if m.group(2).lower() in lower else 0
+        if m and not average and keys:
+            new = histogram_stat(m.group(1), rows, column)
+            stats.append((name, _format(new, max(_decimals(value),
+                                                 3 if m.group(1) in ('Mean', 'STDev') else 0))))
+        else:
+            values = [(float(dict(h['stats']).get(name, 0)), w) for h,w in hists]
+            new = (sum(v * w for v,w in values) / total_weight if total_weight else
+                   sum(v for v,_ in values) / len(values))
+            stats.append((name, _format(new, max(_decimals(value), 3 if '.' in value else 0))))
+    with open(out_file, 'w') as outF:
+        for name,value in stats:
+            outF.write(f'#{name}\t{value}\n')
+        if columns:
+            outF.write('#' + '\t'.join(columns) + '\n')
+        for k in keys:
+            outF.write('\t'.join([k] + [_format(v, d) for v,d in zip(rows[k], decimals)]) + '\n')
+    return out_file
+
+def merge_scafstats(stats_files: list, out_file: str) -> str:
+    """
+    Merge the bbmap hit statistics (scafstats) of the chunks of a library:
+    counts are summed per reference and the percentage columns ("%X" of
+    column "X") recomputed, with each chunk's denominator derived from its rows
+    Return: str, out_file; or None if there was no file
+    """
+    tables = [read_histogram(x) for x in stats_files if os.path.exists(x)]
+    tables = [x for x in tables if x['columns']]
+    if not tables:
+        return None
+    columns = tables[0]['columns']
+    values = columns[1:]
+    pct = {i : values.index(x[1:]) for i,x in enumerate(values)
+           if x.startswith('%') and x[1:] in values}
+    denominator = {i : 0.0 for i in pct}
+    rows = {}
+    for table in tables:
+        for i,j in pct.items():
+            # percentage = count * 100 / denominator, the same for all rows of a chunk
+            denominator[i] += next((r[j] * 100 / r[i] for r in table['rows'].values() if r[i]), 0)
+        for name,row in table['rows'].items():
+            if name in rows:
+                rows[name] = [a + b for a,b in zip(rows[name], row)]
+            else:
+                rows[name] = list(row)
+    for row in rows.values():
+        for i,j in pct.items():
+            row[i] = row[j] * 100 / denominator[i] if denominator[i] else 0
+    decimals = [max(t['decimals'][i] if i < len(t['decimals']) else 0 for t in tables)
+                for i in range(len(values))]
+    # sorted by the number of assigned reads, as by bbmap
+    order = values.index('assignedReads') if 'assignedReads' in values else None
+    names = sorted(rows, key=lambda x: -rows[x][order]) if order is not None else list(rows)
+    with open(out_file, 'w') as outF:
+        outF.write('#' + '\t'.join(columns) + '\n')
+        for name in names:
+            outF.write('\t'.join([name] + [_format(v, d) for v,d in zip(rows[name], decimals)]) + '\n')
+    return out_file
+
+def merge_bbmap_logs(log_files: list, out_file: str, insert_hist=None) -> str:
+    """
+    Concatenate the bbmap logs of the chunks, followed by the totals in
+    bbmap's format (read by sam.read_bbmap_log): reads used, and the
+    insert size median and standard deviation of the merged histogram
+    """
+    reads,bases = 0,0
+    for log_file in log_files:
+        r,b = bbmap_log_reads(log_file)
+        reads += r
+        bases += b
+    concat_files(log_files, out_file)
+    lines = [f'Reads Used:           \t{reads}\t({bases} bases)']
+    if insert_hist is not None and os.path.exists(insert_hist):
+        hist = read_histogram(insert_hist)
+        if hist['rows']:
+            lines += [f'insert median:        \t{_format(histogram_stat("Median", hist["rows"], 0), 0)}',
+                      f'insert std dev:       \t{_format(histogram_stat("STDev", hist["rows"], 0), 0)}']
+    with open(out_file, 'a') as outF:
+        outF.write(f'\n# merged from {len(log_files)} chunks\n' + '\n'.join(lines) + '\n')
+    return out_file
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# import
+## batteries
+import os
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+## package
+from phyloflash.checkpoint import decode_result
+from phyloflash.runner import stage_log
+from phyloflash.profiling import StageTimer
+
+
+class Stage(object):
+    """
+    One step of a pipeline and the stages it depends on.
+    name: str, unique stage name
+    func: callable, called with the results of `deps` as positional arguments
+    deps: list, names of the stages that must finish before this one starts
+    threads: bool or int, pass a share of the thread budget to `func` as `threads=`;
+      an int claims that fixed number of threads instead (capped at the total budget)
+    memory: bool or int, pass a share of the memory budget (GB) to `func` as `memory=`;
+      an int claims that fixed amount instead (capped at the total budget)
+    tools: list, external executables used (part of the stage fingerprint)
+    """
+    def __init__(self, name: str, func, deps=None, threads=False, memory=False, tools=None):
+        self.name = name
+        self.func = func
+        self.deps = list(deps) if deps is not None else []
+        self.threads = threads
+        self.memory = memory
+        self.tools = list(tools) if tools is not None else []
+
+    def __repr__(self):
+        return f'Stage({self.name!r}, deps={self.deps!r})'
+
+def check_stages(stages: list) -> None:
+    """
+    Check that stage names are unique, all dependencies exist and
+    that the dependency graph has no cycles.
+    stages: list of Stage objects
+    """
+    names = [s.name for s in stages]
+    dups = set(x for x in names if names.count(x) > 1)
+    if dups:
+        raise ValueError(f'Duplicate stage names: {", ".join(sorted(dups))}')
+    deps = {s.name : s.deps for s in stages}
+    for name,stage_deps in deps.items():
+        for dep in stage_deps:
+            if dep not in deps:
+                raise ValueError(f'Stage "{name}" depends on unknown stage "{dep}"')
+    # Kahn's algorithm; anything left over is part of a cycle
+    n_deps = {name : len(set(x)) for name,x in deps.items()}
+    done = [name for name,n in n_deps.items() if n == 0]
+    for name in done:
+        for other,other_deps in deps.items():
+            if name in other_deps:
+                n_deps[other] -= 1
+                if n_deps[other] == 0:
+                    done.append(other)
+    if len(done) != len(deps):
+        cycle = sorted(set(deps) - set(done))
+        raise ValueError(f'Cyclic stage dependencies: {", ".join(cycle)}')
+
+def _share(free: int, n_waiting: int) -> int:
+    """
+    Even share of the free budget for one of `n_waiting` stages (at least 1)
+    """
+    return max(1, free // max(1, n_waiting))
+
+def _claim(request, free: int, n_waiting: int, total: int):
+    """
+    Amount of a resource to give a stage: an even share for requests of True,
+    the requested amount (capped at `total`) for fixed requests.
+    Return: int, or None if the claim does not fit in the free budget
+    """
+    if request is True:
+        return _share(free, n_waiting) if free >= 1 else None
+    need = min(request, total)
+    return need if free >= need else None
+
+def _dependents(stages: dict, failed: set) -> set:
+    """
+    Names of the stages that directly or indirectly depend on `failed` stages
+    """
+    blocked = set(failed)
+    changed = True
+    while changed:
+        changed = False
+        for name,stage in stages.items():
+            if name not in blocked and any(d in blocked for d in stage.deps):
+                blocked.add(name)
+                changed = True
+    return blocked - set(failed)
+
+def stage_log_file(log_dir: str, name: str) -> str:
+    """
+    Log file of a stage: <log_dir>/<stage name>.log
+    """
+    return os.path.join(log_dir, name.replace(':', '.').replace(os.sep, '_') + '.log')
+
+def _run_stage(stage, args: list, kwargs: dict, checkpoints=None, fingerprint=None, log_dir=None):
+    """
+    Run a stage and, with checkpointing, record its manifest.
+    With `log_dir`, the output of the commands run by the stage goes to its log file.
+    The stage's resource usage is added to the current profile (see profiling).
+    Return: (stage result, output fingerprint or None)
+    """
+    if checkpoints is not None:
+        checkpoints.invalidate(stage.name)
+    log_file = stage_log_file(log_dir, stage.name) if log_dir is not None else None
+    with stage_log(log_file, stage.name), StageTimer(stage.name, kwargs):
+        result = stage.func(*args, **kwargs)
+    if checkpoints is None:
+        return result, None
+    manifest = checkpoints.record(stage, *fingerprint, result)
+    return result, manifest['output_fingerprint']
+
+def run_stages(stages: list, threads=1, memory=1, checkpoints=None, keep_going=False,
+               status=None, log_dir=None) -> dict:
+    """
+    Run a DAG of stages, starting each one as soon as its dependencies have
+    finished. Independent stages run concurrently, and the thread and memory
+    budgets are split evenly between the ready stages that request them.
+    A stage only starts once at least 1 thread/GB of its budget is free.
+    With `checkpoints`, stages whose fingerprint and outputs are unchanged
+    since the last run are skipped and their recorded result is reused.
+    stages: list of Stage objects
+    threads: int, total number of threads
+    memory: int, total memory in GB
+    checkpoints: checkpoint.Checkpoints object, or None to always run all stages
+    keep_going: bool, if a stage fails, only skip the stages depending on it
+      and run all others (no exception is raised)
+    status: dict, filled with {stage_name : {'status' : str, 'seconds' : float, 'error' : str}};
+      status is one of done, cached, failed, skipped (a dependency failed) and not run
+    log_dir: str, directory of the per-stage logs of external commands (see stage_log_file)
+    Return: dict, {stage_name : return value} of the finished stages
+    """
+    if threads < 1 or memory < 1:
+        raise ValueError('The thread and memory budgets must be >= 1')
+    check_stages(stages)
+    pending = {s.name : s for s in stages}
+    results = {}
+    out_fps = {}
+    fingerprints = {}
+    checked = set()
+    running = {}
+    free = {'threads' : threads, 'memory' : memory}
+    total = dict(free)
+    status = status if status is not None else {}
+    for stage in stages:
+        status[stage.name] = {'status' : 'not run', 'seconds' : 0.0, 'error' : ''}
+    error = None
+    with ThreadPoolExecutor(max_workers=len(stages)) as pool:
+        while running or (pending and error is None):
+            ready = [s for s in pending.values() if all(d in results for d in s.deps)]
+            # reuse the results of unchanged stages
+            if checkpoints is not None and error is None:
+                skipped = False
+                for stage in ready:
+                    if stage.name in checked:
+                        continue
+                    checked.add(stage.name)
+                    inputs = {d : out_fps[d] for d in stage.deps}
+                    params,tools,fp = checkpoints.fingerprint(stage, inputs)
+                    fingerprints[stage.name] = (params, tools, inputs, fp)
+                    manifest = checkpoints.lookup(stage, fp)
+                    if manifest is not None:
+                        logging.info(f'Skipping stage "{stage.name}" (unchanged since {manifest["finished"]})')
+                        del pending[stage.name]
+                        results[stage.name] = decode_result(manifest['result'])
+                        out_fps[stage.name] = manifest['output_fingerprint']
+                        status[stage.name]['status'] = 'cached'
+                        skipped = True
+                if skipped:
+                    continue
+            # start all ready stages that fit in the remaining budget
+            n_waiting = {'threads' : sum(1 for s in ready if s.threads is True),
+                         'memory' : sum(1 for s in ready if s.memory is True)}
+            for stage in ready if error is None else []:
+                kwargs = {}
+                for res in ('threads', 'memory'):
+                    request = getattr(stage, res)
+                    if request:
+                        claim = _claim(request, free[res], n_waiting[res], total[res])
+                        if claim is None:
+                            break
+                        kwargs[res] = claim
+                        if request is True:
+                            n_waiting[res] -= 1
+                else:
+                    for res,n in kwargs.items():
+                        free[res] -= n
+                    del pending[stage.name]
+                    args = [results[d] for d in stage.deps]
+                    resources = ', '.join(f'{k}={v}' for k,v in kwargs.items())
+                    logging.info(f'Starting stage "{stage.name}" ({resources or "no resources"})')
+                    future = pool.submit(_run_stage, stage, args, kwargs, checkpoints,
+                                         fingerprints.get(stage.name), log_dir)
+                    running[future] = (stage, kwargs, time.time())
+                    continue
+                # resources were not available; release partial claims
+                for res in kwargs:
+                    if getattr(stage, res) is True:
+                        n_waiting[res] += 1
+            if not running:
+                break
+            # wait for at least one stage to finish and return its resources
+            finished,_ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage,kwargs,t0 = running.pop(future)
+                for res,n in kwargs.items():
+                    free[res] += n
+                status[stage.name]['seconds'] = time.time() - t0
+                try:
+                    results[stage.name],out_fps[stage.name] = future.result()
+                except Exception as e:
+                    logging.error(f'Stage "{stage.name}" failed: {e}')
+                    status[stage.name].update({'status' : 'failed', 'error' : str(e)})
+                    if keep_going:
+                        failed = set(x for x,v in status.items() if v['status'] == 'failed')
+                        for name in _dependents(pending, failed) & set(pending):
+                            logging.info(f'Skipping stage "{name}" (dependency failed)')
+                            del pending[name]
+                            status[name]['status'] = 'skipped'
+                    elif error is None:
+                        error = e
+                else:
+                    logging.info(f'Finished stage "{stage.name}"')
+                    status[stage.name]['status'] = 'done'
+    if error is not None:
+        raise error
+    return results
@@ -0,0 +1,349 @@
+#!/usr/bin/env python
+# import
+## batteries
+import os
+import sys
+import mmap
+import struct
+import contextlib
+from array import array
+## package
+from phyloflash.fasta import read_fasta
+
+# Store file layout: all sequences concatenated, followed by the
+# concatenated accessions, the interned taxonomy strings, the offset
+# arrays and a fixed-size footer with the (position, length) of each section.
+MAGIC = b'PFSEQST1'
+SECTIONS = ('seqs', 'accs', 'taxa', 'seq_offsets', 'acc_offsets',
+            'tax_offsets', 'tax_ids')
+ALIGN = 8
+
+
+def footer_struct(sections: tuple) -> struct.Struct:
+    """
+    Footer of a sectioned file: magic, byte order, number of records and
+    the (position, length) of each section
+    """
+    return struct.Struct('<8s8sQ' + 'QQ' * len(sections))
+
+def write_section(outF, data) -> list:
+    """
+    Write a buffer to `outF`, padded so that array views of it are aligned.
+    Return: list, [position, length] of the section
+    """
+    pos = outF.tell()
+    pad = (-pos) % ALIGN
+    outF.write(b'\0' * pad)
+    data = memoryview(data).cast('B')
+    outF.write(data)
+    return [pos + pad, len(data)]
+
+def write_footer(outF, magic: bytes, sections: tuple, n_records: int, positions: list) -> None:
+    """
+    Write the footer of a sectioned file (see footer_struct)
+    """
+    byteorder = sys.byteorder.encode()
+    outF.write(footer_struct(sections).pack(magic, byteorder, n_records, *positions))
+
+def map_sections(in_file: str, magic: bytes, sections: tuple) -> tuple:
+    """
+    Memory-map a sectioned file and return views of its sections.
+    Return: (mmap object, number of records, {section : memoryview})
+    """
+    footer = footer_struct(sections)
+    with open(in_file, 'rb') as inF:
+        mm = mmap.mmap(inF.fileno(), 0, access=mmap.ACCESS_READ)
+    if len(mm) < footer.size or mm[-footer.size:][:8] != magic:
+        mm.close()
+        raise ValueError(f'Not a {magic.decode()} file: {in_file}')
+    values = footer.unpack(mm[-footer.size:])
+    byteorder,n_records = values[1:3]
+    byteorder = byteorder.rstrip(b'\0').decode()
+    if byteorder != sys.byteorder:
+        mm.close()
+        raise ValueError(f'{in_file} was written on a {byteorder}-endian system')
+    view = memoryview(mm)
+    buffers = {}
+    for i,name in enumerate(sections):
+        pos,length = values[3 + 2 * i : 5 + 2 * i]
+        buffers[name] = view[pos : pos + length]
+    return mm, n_records, buffers
+
+def split_header(header: bytes) -> tuple:
+    """
+    Split a SILVA header into accession and taxonomy string (may be empty)
+    """
+    acc,_,tax = header.partition(b' ')
+    return acc, tax
+
+def seqstore_path(fasta_file: str) -> str:
+    """
+    Path of the SeqStore written alongside a FASTA file
+    """
+    return os.path.splitext(fasta_file)[0] + '.seqstore'
+
+
+class SeqStoreWriter(object):
+    """
+    Write a SeqStore file record by record. Sequences are streamed to disk;
+    only the offsets, accessions and the interned taxonomy table are kept
+    in memory until close().
+    store_file: str, output file path
+    """
+    def __init__(self, store_file: str):
+        self.store_file = store_file
+        self.tmp_file = store_file + '.tmp'
+        self.outF = open(self.tmp_file, 'wb', buffering=1 << 22)
+        self.seq_offsets = array('Q', [0])
+        self.accs = bytearray()
+        self.acc_offsets = array('Q', [0])
+        self.taxa = {}
+        self.tax_ids = array('I')
+
+    def add(self, header: bytes, seq) -> None:
+        """
+        Append one record
+        """
+        acc,tax = split_header(header)
+        self.outF.write(seq)
+        self.seq_offsets.append(self.seq_offsets[-1] + len(seq))
+        self.accs += acc
+        self.acc_offsets.append(len(self.accs))
+        self.tax_ids.append(self.taxa.setdefault(tax, len(self.taxa)))
+
+    def close(self) -> str:
+        """
+        Write the tables and footer, and move the store into place
+        """
+        taxa = sorted(self.taxa, key=self.taxa.get)
+        tax_offsets = array('Q', [0])
+        for tax in taxa:
+            tax_offsets.append(tax_offsets[-1] + len(tax))
+        data = {
+            'accs' : self.accs,
+            'taxa' : b''.join(taxa),
+            'seq_offsets' : self.seq_offsets,
+            'acc_offsets' : self.acc_offsets,
+            'tax_offsets' : tax_offsets,
+            'tax_ids' : self.tax_ids
+        }
+        positions = [0, self.seq_offsets[-1]]
+        for name in SECTIONS[1:]:
+            positions += write_section(self.outF, data[name])
+        write_footer(self.outF, MAGIC, SECTIONS, len(self.tax_ids), positions)
+        self.outF.close()
+        os.replace(self.tmp_file, self.store_file)
+        return self.store_file
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.outF.close()
+            os.remove(self.tmp_file)
+
+
+class SeqStore(object):
+    """
+    Packed, read-only collection of SILVA records.
+    * sequences are concatenated in one buffer and indexed by an offsets array;
+      seq() returns zero-copy memoryview slices
+    * accessions are concatenated in a second buffer with their own offsets
+    * taxonomy strings are interned: each record only holds an integer ID
+      into the taxonomy table
+    A store is built with SeqStore.from_fasta() or loaded with SeqStore.load(),
+    which memory-maps the file so that only the pages that are used are read.
+    """
+    def __init__(self, buffers: dict, n_records: int, mm=None):
+        self._mm = mm
+        self.n_records = n_records
+        self.seqs = buffers['seqs']
+        self.accs = buffers['accs']
+        self.taxa = buffers['taxa']
+        self.seq_offsets = buffers['seq_offsets']
+        self.acc_offsets = buffers['acc_offsets']
+        self.tax_offsets = buffers['tax_offsets']
+        self.tax_ids = buffers['tax_ids']
+        self._acc_index = None
+
+    @classmethod
+    def load(cls, store_file: str):
+        """
+        Memory-map a SeqStore file
+        """
+        mm,n_records,buffers = map_sections(store_file, MAGIC, SECTIONS)
+        for name in ('seq_offsets', 'acc_offsets', 'tax_offsets'):
+            buffers[name] = buffers[name].cast('Q')
+        buffers['tax_ids'] = buffers['tax_ids'].cast('I')
+        return cls(buffers, n_records, mm)
+
+    @classmethod
+    def from_fasta(cls, fasta_file: str, store_file=None):
+        """
+        Build a SeqStore from a (possibly gzip-compressed) FASTA file.
+        If `store_file` is given, the store is also saved there and memory-mapped.
+        """
+        if store_file is not None:
+            with SeqStoreWriter(store_file) as writer:
+                for header,seq in read_fasta(fasta_file):
+                    writer.add(header, seq)
+            return cls.load(store_file)
+        seqs = bytearray()
+        seq_offsets = array('Q', [0])
+        accs = bytearray()
+        acc_offsets = array('Q', [0])
+        taxa = {}
+        tax_ids = array('I')
+        for header,seq in read_fasta(fasta_file):
+            acc,tax = split_header(header)
+            seqs += seq
+            seq_offsets.append(len(seqs))
+            accs += acc
+            acc_offsets.append(len(accs))
+            tax_ids.append(taxa.setdefault(tax, len(taxa)))
+        tax_offsets = array('Q', [0])
+        for tax in taxa:
+            tax_offsets.append(tax_offsets[-1] + len(tax))
+        buffers = {
+            'seqs' : memoryview(seqs),
+            'accs' : memoryview(accs),
+            'taxa' : memoryview(b''.join(taxa)),
+            'seq_offsets' : memoryview(seq_offsets),
+            'acc_offsets' : memoryview(acc_offsets),
+            'tax_offsets' : memoryview(tax_offsets),
+            'tax_ids' : memoryview(tax_ids)
+        }
+        return cls(buffers, len(tax_ids))
+
+    def close(self) -> None:
+        """
+        Release the memory map (if any). Sequence views returned by seq()
+        must have been released; iteration hands out copies.
+        """
+        if self._mm is not None:
+            for name in SECTIONS:
+                getattr(self, name).release()
+            self._mm.close()
+            self._mm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def __len__(self):
+        return self.n_records
+
+    def seq(self, i: int) -> memoryview:
+        """
+        Sequence of record i (zero-copy view)
+        """
+        return self.seqs[self.seq_offsets[i] : self.seq_offsets[i + 1]]
+
+    def acc(self, i: int) -> bytes:
+        """
+        Accession of record i
+        """
+        return bytes(self.accs[self.acc_offsets[i] : self.acc_offsets[i + 1]])
+
+    def n_taxa(self) -> int:
+        return len(self.tax_offsets) - 1
+
+    def taxon(self, tax_id: int) -> bytes:
+        """
+        Taxonomy string with ID tax_id
+        """
+        return bytes(self.taxa[self.tax_offsets[tax_id] : self.tax_offsets[tax_id + 1]])
+
+    def tax(self, i: int) -> bytes:
+        """
+        Taxonomy string of record i
+        """
+        return self.taxon(self.tax_ids[i])
+
+    def header(self, i: int) -> bytes:
+        """
+        Full FASTA header of record i (without ">")
+        """
+        tax = self.tax(i)
+        return self.acc(i) + b' ' + tax if tax else self.acc(i)
+
+    def __getitem__(self, i: int) -> tuple:
+        return self.header(i), self.seq(i)
+
+    def __iter__(self):
+        for i in range(self.n_records):
+            yield self.header(i), bytes(self.seq(i))
+
+    def index(self, acc) -> int:
+        """
+        Record number of an accession (O(1) after the index is built on first use)
+        """
+        if self._acc_index is None:
+            accs = bytes(self.accs)
+            offsets = self.acc_offsets
+            self._acc_index = {accs[offsets[i] : offsets[i + 1]] : i
+                               for i in range(self.n_records)}
+        if isinstance(acc, str):
+            acc = acc.encode()
+        return self._acc_index[acc]
+
+    def get(self, acc) -> tuple:
+        """
+        (header, sequence) of an accession
+        """
+        return self[self.index(acc)]
+
+    def records(self, exclude=None, max_records=None):
+        """
+        Iterate over (header, sequence) tuples of bytes, optionally dropping
+        the accessions in `exclude` and stopping after `max_records` records
+        """
+        if exclude is not None:
+            exclude = {x.encode() if isinstance(x, str) else x for x in exclude}
+        n = 0
+        for i in range(self.n_records):
+            if max_records is not None and n >= max_records:
+                break
+            if exclude and self.acc(i) in exclude:
+                continue
+            n += 1
+            yield self.header(i), bytes(self.seq(i))
+
+    def acc2tax(self) -> dict:
+        """
+        {accession : taxonomy string}, decoded to str
+        """
+        taxa = [self.taxon(i).decode() for i in range(self.n_taxa())]
+        return {self.acc(i).decode() : taxa[self.tax_ids[i]] for i in range(self.n_records)}
+
+
+@contextlib.contextmanager
+def open_records(fasta_file: str):
+    """
+    Records of a FASTA file, read from its SeqStore if one exists that is
+    at least as new as the FASTA file, otherwise parsed from the FASTA file.
+    The store (or FASTA file) is closed on leaving the `with` block.
+    Return: context manager of an iterable of (header, sequence) tuples
+      (a SeqStore, or a read_fasta generator)
+    """
+    store_file = seqstore_path(fasta_file)
+    store = None
+    try:
+        if os.stat(store_file).st_mtime_ns >= os.stat(fasta_file).st_mtime_ns:
+            store = SeqStore.load(store_file)
+    except (OSError, ValueError):
+        pass
+    if store is not None:
+        with store:
+            yield store
+        return
+    records = read_fasta(fasta_file)
+    try:
+        yield records
+    finally:
+        records.close()
@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# import
+## batteries
+import re
+import logging
+## package
+from phyloflash.fasta import revcomp
+from phyloflash.fastq import read_pairs
+from phyloflash.acc2tax import Acc2Tax
+from phyloflash.sam import (SamRecord, MapStats, TaxonomyCollector, read_sam, BLOCKSIZE,
+                            FLAG_PAIRED, FLAG_PROPER, FLAG_UNMAPPED, FLAG_MATE_UNMAPPED,
+                            FLAG_REVERSE, FLAG_MATE_REVERSE, FLAG_FIRST, FLAG_LAST,
+                            FLAG_SECONDARY)
+
+# number of FASTQ reads (pairs) searched ahead for the read of an alignment
+WINDOW = 1000
+# sortmerna log line with the number of input reads
+SORTMERNA_LOG_READS = re.compile(rb'^\s+Total reads = (\d+)$')
+
+
+def read_sortmerna_log(log_file: str):
+    """
+    Number of input read segments from a sortmerna log, or None if missing
+    """
+    reads = None
+    with open(log_file, 'rb') as inF:
+        for line in inF:
+            m = SORTMERNA_LOG_READS.match(line.rstrip(b'\r\n'))
+            if m:
+                reads = int(m.group(1))
+    return reads
+
+
+class ReadSegments(object):
+    """
+    The segments (one, or two for a pair) of one read from the FASTQ file
+    written by sortmerna. Reverse complements are only computed if an
+    alignment to the reverse strand has to be matched by sequence.
+    """
+    __slots__ = ('names', 'seqs', 'quals', '_revcomps')
+
+    def __init__(self, records: list):
+        self.names = tuple(header.split(None, 1)[0] for header,_,_ in records)
+        self.seqs = tuple(seq for _,seq,_ in records)
+        self.quals = tuple(qual for _,_,qual in records)
+        self._revcomps = None
+
+    def revcomps(self) -> tuple:
+        if self._revcomps is None:
+            self._revcomps = tuple(revcomp(x) for x in self.seqs)
+        return self._revcomps
+
+    def segment(self, rec: SamRecord):
+        """
+        Segment (0: forward, 1: reverse) of an alignment: from the read name
+        if the segments are named differently, otherwise from the sequence
+        (sortmerna cuts read names at the first whitespace, so the segments
+        of Casava 1.8 reads share their name).
+        Return: int, or None if the sequence matches neither segment
+        """
+        if len(self.names) == 1:
+            return 0
+        if self.names[0] != self.names[1]:
+            return self.names.index(rec.qname)
+        seq = rec.rest.split(b'\t', 7)[6]
+        seqs = self.revcomps() if rec.flag & FLAG_REVERSE else self.seqs
+        for query in (seq, seq.upper()):
+            for i,x in enumerate(seqs):
+                if query == x or query == x.upper():
+                    return i
+        return None
+
+def read_segments(fastq_file: str, paired=True):
+    """
+    Stream the reads of a FASTQ file written by sortmerna (interleaved if paired)
+    Return: generator of ReadSegments
+    """
+    for rec1,rec2 in read_pairs(fastq_file, interleaved=paired):
+        yield ReadSegments([rec1, rec2] if rec2 is not None else [rec1])
+
+def join_sortmerna(fastq_file: str, sam_file: str, paired=True, window=WINDOW,
+                   header_func=None):
+    """
+    Merge-join the alignments of a sortmerna SAM file with the reads of the
+    FASTQ file written in the same run (--fastx --paired_in). Both files
+    follow the order of the input reads, so the alignments of one read
+    are contiguous and the FASTQ file only has to be read forward: reads
+    without alignments are skipped, up to `window` reads at a time. Only
+    one read and its alignments are held in memory.
+    fastq_file: str, FASTQ file of the aligned reads (interleaved if paired)
+    sam_file: str, SAM file of the aligned reads
+    paired: bool, paired-end reads
+    window: int, maximum number of reads (pairs) skipped to find the read of an alignment
+    header_func: callable, called with each SAM header line (bytes)
+    Return: generator of (ReadSegments, [SamRecord, ...]) tuples
+    """
+    reads = read_segments(fastq_file, paired)
+    read = None
+    group = []
+    for rec in read_sam(sam_file, header_func):
+        if read is None or rec.qname not in read.names:
+            if group:
+                yield read, group
+                group = []
+            for _ in range(window + 1):
+                read = next(reads, None)
+                if read is None:
+                    raise ValueError(f'Read {rec.qname.decode(errors="replace")} of {sam_file} '
+                                     f'not found in {fastq_file}')
+                if rec.qname in read.names:
+                    break
+            else:
+                raise ValueError(f'Read {rec.qname.decode(errors="replace")} of {sam_file} not '
+                                 f'found within {window} reads of {fastq_file}; the files are '
+                                 'not in the same order')
+        group.append(rec)
+    if group:
+        yield read, group
+
+def unmapped_record(read: ReadSegments, segment: int) -> SamRecord:
+    """
+    Alignment line of an unmapped segment of a pair, as written by bbmap
+    """
+    flag = FLAG_PAIRED | FLAG_UNMAPPED | (FLAG_LAST if segment else FLAG_FIRST)
+    rest = b'\t'.join((b'0', b'255', b'*', b'*', b'0', b'0',
+                       read.seqs[segment], read.quals[segment]))
+    return SamRecord(read.names[0], flag, b'*', rest)
+
+
+class SortmernaFixer(object):
+    """
+    Fix the alignments of one read from sortmerna to look like bbmap output:
+    set the pairing and segment flags (0x1, 0x2, 0x8, 0x20, 0x40, 0x80),
+    flag all but the first alignment of each segment as secondary (0x100),
+    name both segments after the forward read, add the taxonomy string
+    to the reference name and insert an unmapped forward segment before
+    a reverse segment whose mate did not align.
+    acc2tax: Acc2Tax, accession -> taxonomy string lookup (None to keep the reference names)
+    paired: bool, paired-end reads
+    """
+    def __init__(self, acc2tax=None, paired=True):
+        self.acc2tax = acc2tax
+        self.paired = paired
+        self.unresolved = 0
+        self._rnames = {}
+
+    def rname(self, rname: bytes) -> bytes:
+        """
+        Reference name with the taxonomy string appended (looked up once per reference)
+        """
+        try:
+            return self._rnames[rname]
+        except KeyError:
+            tax = self.acc2tax.get(rname)
+            new = rname + b' ' + tax.encode() if tax is not None else rname
+            self._rnames[rname] = new
+            return new
+
+    def fix(self, read: ReadSegments, group: list) -> list:
+        """
+        Fix the alignments of one read (see join_sortmerna)
+        Return: list of SamRecord objects, including the inserted unmapped segment
+        """
+        segments = []
+        seen = set()
+        segment = 0
+        for rec in group:
+            if self.paired:
+                found = read.segment(rec)
+                if found is None:
+                    # keep the segment of the previous alignment
+                    self.unresolved += 1
+                else:
+                    segment = found
+                rec.flag |= FLAG_PAIRED | (FLAG_LAST if segment else FLAG_FIRST)
+            else:
+                rec.flag &= ~FLAG_PAIRED
+            if segment in seen:
+                rec.flag |= FLAG_SECONDARY
+            seen.add(segment)
+            segments.append(segment)
+            rec.qname = read.names[0]
+            if self.acc2tax is not None:
+                rec.rname = self.rname(rec.rname)
+        if not self.paired:
+            return group
+        # pairing flags
+        both = len(seen) == 2
+        reverse = {x for rec,x in zip(group, segments) if rec.flag & FLAG_REVERSE}
+        fixed = []
+        for rec,x in zip(group, segments):
+            if both:
+                rec.flag |= FLAG_PROPER
+                if 1 - x in reverse:
+                    rec.flag |= FLAG_MATE_REVERSE
+            else:
+                rec.flag = (rec.flag & ~FLAG_PROPER) | FLAG_MATE_UNMAPPED
+                if x == 1 and not rec.flag & FLAG_SECONDARY:
+                    fixed.append(unmapped_record(read, 0))
+            fixed.append(rec)
+        return fixed
+
+def fix_sortmerna_sam(fastq_file: str, sam_file: str, acc2tax=None, paired=True,
+                      window=WINDOW, header_func=None):
+    """
+    Stream the fixed alignments of a sortmerna SAM file, grouped by read
+    (see join_sortmerna and SortmernaFixer)
+    acc2tax: Acc2Tax, accession -> taxonomy string lookup
+    Return: generator of (read name, [SamRecord, ...]) tuples
+    """
+    fixer = SortmernaFixer(acc2tax, paired)
+    for read,group in join_sortmerna(fastq_file, sam_file, paired, window, header_func):
+        yield read.names[0], fixer.fix(read, group)
+    if fixer.unresolved:
+        logging.warning(f'  Segment not found by sequence for {fixer.unresolved} alignments '
+                        f'of {sam_file}')
+
+def process_sortmerna_sam(fastq_file: str, sam_file: str, out_file=None, acc2tax=None,
+                          paired=True, levels=(4, 7), tophit=False, trie=None,
+                          window=WINDOW) -> tuple:
+    """
+    Single streaming pass over a sortmerna SAM file and the FASTQ file of
+    the aligned reads that fixes the alignments to look like bbmap output,
+    writes the fixed SAM file, counts the mapping statistics and collects
+    the read taxonomy (see process_bbmap_sam). Memory use does not depend
+    on the size of the library.
+    fastq_file: str, FASTQ file written by sortmerna (interleaved if paired)
+    sam_file: str, SAM file written by sortmerna
+    out_file: str, fixed SAM file (None to skip writing)
+    acc2tax: str, accession -> taxonomy string index of the database (see acc2tax.Acc2Tax)
+    paired: bool, paired-end reads
+    levels: list, taxonomic levels (1-based) to count at
+    tophit: bool, count the taxonomy of the primary alignment only
+    trie: TaxonomyTrie, taxonomy of the database
+    window: int, maximum number of FASTQ reads skipped to find the read of an alignment
+    Return: (MapStats, TaxonomyCollector)
+    """
+    stats = MapStats(paired)
+    taxonomy = TaxonomyCollector(levels, tophit, trie)
+    lookup = Acc2Tax(acc2tax) if acc2tax is not None else None
+    outF = open(out_file, 'wb', buffering=BLOCKSIZE) if out_file is not None else None
+    header_func = outF.write if outF is not None else None
+    n_records = 0
+    n_groups = 0
+    try:
+        for _,group in fix_sortmerna_sam(fastq_file, sam_file, lookup, paired, window,
+                                         header_func):
+            n_groups += 1
+            n_records += len(group)
+            for rec in group:
+                stats.add(rec.flag)
+            taxonomy.add_group(group)
+            if outF is not None:
+                outF.write(b''.join(rec.to_line() for rec in group))
+    finally:
+        if outF is not None:
+            outF.close()
+        if lookup is not None:
+            lookup.close()
+    logging.info(f'  Processed {n_records} alignments of {n_groups} reads from {sam_file}')
+    logging.info(f'  Forward read segments mapping: {stats.fwd}')
+    logging.info(f'  Reverse read segments mapping: {stats.rev}')
+    return stats, taxonomy
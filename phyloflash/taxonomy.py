@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# import
+## batteries
+from array import array
+from collections import Counter
+## package
+from phyloflash.acc2tax import Acc2Tax
+
+
+class TaxonomyTrie(object):
+    """
+    SILVA taxonomy paths interned into a trie of integer nodes. Each node
+    holds its parent, depth and the ID of its rank name in flat arrays,
+    so consensus (LCA) and rank lookups are integer operations; names
+    are only joined into strings for reporting. Node 0 is the root.
+    """
+    def __init__(self):
+        self.parent = array('I', [0])
+        self.depth = array('I', [0])
+        self.label = array('I', [0])
+        self.names = [b'']
+        self._name_ids = {}
+        self._children = {}
+        self._taxa = {}
+
+    @classmethod
+    def from_taxa(cls, taxa):
+        """
+        Build a trie from taxonomy strings (bytes, ";"-separated)
+        """
+        trie = cls()
+        for tax in taxa:
+            trie.node(tax)
+        return trie
+
+    @classmethod
+    def from_acc2tax(cls, index_file: str):
+        """
+        Build a trie from the taxonomy table of an accession -> taxonomy index
+        (see acc2tax.write_acc2tax)
+        """
+        with Acc2Tax(index_file) as idx:
+            n_taxa = len(idx.tax_offsets) - 1
+            return cls.from_taxa(idx.taxa[idx.tax_offsets[i] : idx.tax_offsets[i + 1]].tobytes()
+                                 for i in range(n_taxa))
+
+    def __len__(self):
+        return len(self.parent)
+
+    def copy(self):
+        """
+        Independent copy of the trie (e.g. of a database trie shared by
+        libraries that each add the taxonomy strings of their hits)
+        """
+        trie = self.__class__()
+        trie.parent = array('I', self.parent)
+        trie.depth = array('I', self.depth)
+        trie.label = array('I', self.label)
+        trie.names = list(self.names)
+        trie._name_ids = dict(self._name_ids)
+        trie._children = dict(self._children)
+        trie._taxa = dict(self._taxa)
+        return trie
+
+    def add_path(self, path) -> int:
+        """
+        Add a taxonomy path (sequence of rank names) and return its node
+        """
+        node = 0
+        for name in path:
+            name_id = self._name_ids.get(name)
+            if name_id is None:
+                name_id = self._name_ids[name] = len(self.names)
+                self.names.append(name)
+            child = self._children.get((node, name_id))
+            if child is None:
+                child = self._children[(node, name_id)] = len(self.parent)
+                self.parent.append(node)
+                self.depth.append(self.depth[node] + 1)
+                self.label.append(name_id)
+            node = child
+        return node
+
+    def node(self, tax: bytes) -> int:
+        """
+        Node of a taxonomy string; strings not seen before are added
+        """
+        node = self._taxa.get(tax)
+        if node is None:
+            node = self._taxa[tax] = self.add_path(tax.rstrip(b';').split(b';'))
+        return node
+
+    def lca(self, a: int, b: int) -> int:
+        """
+        Lowest common ancestor of two nodes
+        """
+        parent,depth = self.parent,self.depth
+        while depth[a] > depth[b]:
+            a = parent[a]
+        while depth[b] > depth[a]:
+            b = parent[b]
+        while a != b:
+            a = parent[a]
+            b = parent[b]
+        return a
+
+    def consensus(self, nodes) -> int:
+        """
+        Lowest common ancestor of a group of nodes (0 if they only share the root)
+        """
+        it = iter(nodes)
+        node = next(it, 0)
+        for other in it:
+            if other != node:
+                node = self.lca(node, other)
+                if node == 0:
+                    break
+        return node
+
+    def ancestor(self, node: int, level: int) -> int:
+        """
+        Ancestor of a node at depth `level` (the node itself if it is not deeper)
+        """
+        parent = self.parent
+        for _ in range(self.depth[node] - level):
+            node = parent[node]
+        return node
+
+    def path(self, node: int) -> list:
+        """
+        Rank names from the root to a node
+        """
+        names = []
+        while node:
+            names.append(self.names[self.label[node]])
+            node = self.parent[node]
+        names.reverse()
+        return names
+
+    def taxstring(self, node: int, level=None, pad=True) -> str:
+        """
+        Taxonomy string of a node, trimmed to `level` ranks, or (with `pad`)
+        padded by repeating the lowest rank in brackets up to `level`,
+        e.g. Bacteria;Proteobacteria;(Proteobacteria)
+        """
+        if level is not None:
+            node = self.ancestor(node, level)
+        names = self.path(node)
+        if pad and level is not None and 0 < len(names) < level:
+            names += [b'(' + names[-1] + b')'] * (level - len(names))
+        return b';'.join(names).decode()
+
+
+class ConsensusCounter(object):
+    """
+    Per-read consensus taxa, counted in batches. Reads are added as the
+    nodes of their hits; each read's consensus node is appended to an
+    array, and the array is tallied (and cleared) every `batch_size` reads.
+    Counts at any number of taxonomic levels are then derived from the
+    tally of distinct consensus nodes.
+    trie: TaxonomyTrie
+    pad: bool, pad consensus taxa shallower than the report level (see TaxonomyTrie.taxstring)
+    keep_reads: bool, also keep the consensus node of each read by name
+    """
+    def __init__(self, trie: TaxonomyTrie, pad=True, keep_reads=False, batch_size=1 << 16):
+        self.trie = trie
+        self.pad = pad
+        self.batch_size = batch_size
+        self.batch = array('I')
+        self.tally = Counter()
+        self.reads = {} if keep_reads else None
+
+    def add(self, nodes, read=None) -> int:
+        """
+        Add one read by the nodes of its hits.
+        Return: int, consensus node (0 if the hits only share the root)
+        """
+        node = self.trie.consensus(nodes)
+        if node:
+            self.batch.append(node)
+            if len(self.batch) >= self.batch_size:
+                self.flush()
+        if self.reads is not None and read is not None:
+            self.reads[read] = node
+        return node
+
+    def flush(self) -> None:
+        self.tally.update(self.batch)
+        self.batch = array('I')
+
+    def node_counts(self, reads=None) -> Counter:
+        """
+        {consensus node : read count}, for all reads or for the given read
+        names (requires keep_reads)
+        """
+        if reads is None:
+            self.flush()
+            return self.tally
+        return Counter(self.reads[x] for x in reads if self.reads.get(x))
+
+    def counts(self, levels, reads=None) -> dict:
+        """
+        Read counts per taxon at each taxonomic level in `levels`.
+        Return: dict, {level : {taxonomy string : read count}}
+        """
+        node_counts = self.node_counts(reads)
+        counts = {}
+        for level in levels:
+            level_counts = Counter()
+            for node,n in node_counts.items():
+                level_counts[self.trie.ancestor(node, level)] += n
+            counts[level] = {self.trie.taxstring(node, level, self.pad) : n
+                             for node,n in level_counts.items()}
+        return counts
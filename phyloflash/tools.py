@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# import
+## batteries
+import os
+import re
+import json
+import shutil
+import threading
+import subprocess
+
+# arguments printing the version of an executable
+VERSION_ARGS = {
+    'bbmap.sh' : ['--version'],
+    'reformat.sh' : ['--version'],
+    'vsearch' : ['--version'],
+    'mafft' : ['--version'],
+    'spades.py' : ['--version'],
+    'sortmerna' : ['--version'],
+    'barrnap_HGV' : ['--version']
+}
+# minimum versions, as checked by phyloFlash.pl
+MIN_VERSIONS = {
+    'vsearch' : '2.5.0'
+}
+VERSION = re.compile(rb'(\d+\.\d+(?:\.\d+)*)')
+# time limit (seconds) of a version probe
+VERSION_TIMEOUT = 60
+# number of PATH values kept in the cache
+MAX_PATHS = 32
+CACHE_VERSION = 1
+
+# registry of the current PATH (see registry)
+_registry = None
+_lock = threading.Lock()
+
+
+def cache_file() -> str:
+    """
+    Cache file of resolved tools: $PHYLOFLASH_TOOL_CACHE (empty: no cache),
+    or phyloflash/tools.json in the user cache directory
+    """
+    env = os.environ.get('PHYLOFLASH_TOOL_CACHE')
+    if env is not None:
+        return env
+    cache_dir = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_dir, 'phyloflash', 'tools.json')
+
+def path_dirs(path: str) -> dict:
+    """
+    mtime of each directory in a PATH value (None if missing); adding or
+    removing an executable changes the mtime of its directory
+    """
+    dirs = {}
+    for x in path.split(os.pathsep):
+        if x and x not in dirs:
+            try:
+                dirs[x] = os.stat(x).st_mtime_ns
+            except OSError:
+                dirs[x] = None
+    return dirs
+
+def binary_identity(path: str):
+    """
+    Resolved path, size and mtime of an executable, or None if it does not exist
+    """
+    try:
+        real = os.path.realpath(path)
+        st = os.stat(real)
+    except OSError:
+        return None
+    return {'path' : path, 'real_path' : real, 'size' : st.st_size, 'mtime_ns' : st.st_mtime_ns}
+
+def probe_version(path: str, args: list):
+    """
+    First version number printed by `path args`, or None
+    """
+    try:
+        p = subprocess.run([path] + args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                           stdin=subprocess.DEVNULL, timeout=VERSION_TIMEOUT)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    m = VERSION.search(p.stdout)
+    return m.group(1).decode() if m else None
+
+def version_tuple(version: str) -> tuple:
+    return tuple(int(x) for x in version.split('.'))
+
+
+class ToolRegistry(object):
+    """
+    Executables resolved in PATH and their versions, cached in a JSON file
+    shared by all runs. Entries are keyed by the PATH value and reused as
+    long as the mtimes of the PATH directories (i.e. which executables
+    they contain) and the size and mtime of the binary are unchanged, so
+    a run neither searches PATH nor probes versions again.
+    cache_file: str, cache file (None or '': no cache)
+    path: str, PATH value (default: $PATH)
+    """
+    def __init__(self, cache_file=None, path=None):
+        self.cache_file = cache_file or None
+        self.path = path if path is not None else os.environ.get('PATH', os.defpath)
+        self._lock = threading.Lock()
+        self._cache = self._load()
+        dirs = path_dirs(self.path)
+        entry = self._cache['paths'].get(self.path)
+        if entry is None or entry['dirs'] != dirs:
+            entry = {'dirs' : dirs, 'tools' : {}}
+            self._cache['paths'][self.path] = entry
+        self._tools = entry['tools']
+
+    def _load(self) -> dict:
+        if self.cache_file is not None:
+            try:
+                with open(self.cache_file) as inF:
+                    cache = json.load(inF)
+                if cache.get('version') == CACHE_VERSION:
+                    return cache
+            except (OSError, ValueError):
+                pass
+        return {'version' : CACHE_VERSION, 'paths' : {}}
+
+    def _save(self) -> None:
+        """
+        Write the cache atomically; a cache that cannot be written is not an error
+        """
+        if self.cache_file is None:
+            return
+        paths = self._cache['paths']
+        for key in list(paths)[:-MAX_PATHS]:
+            if key != self.path:
+                del paths[key]
+        tmp_file = f'{self.cache_file}.{os.getpid()}.tmp'
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.cache_file)), exist_ok=True)
+            with open(tmp_file, 'w') as outF:
+                json.dump(self._cache, outF, indent=1)
+            os.replace(tmp_file, self.cache_file)
+        except OSError:
+            pass
+
+    def _entry(self, exe: str):
+        """
+        Cached entry of an executable, resolved again if the binary changed
+        """
+        entry = self._tools.get(exe)
+        if entry is not None:
+            if entry['path'] is None:
+                return entry
+            current = binary_identity(entry['path'])
+            if current is not None and all(current[k] == entry[k] for k in current):
+                return entry
+        if os.path.dirname(exe):
+            path = exe if os.access(exe, os.X_OK) else None
+        else:
+            path = shutil.which(exe, path=self.path)
+        entry = (binary_identity(path) if path is not None else None) or {'path' : None}
+        self._tools[exe] = entry
+        self._save()
+        return entry
+
+    def resolve(self, exe: str):
+        """
+        Path of an executable (a name in PATH, or a path), or None if not found
+        """
+        with self._lock:
+            return self._entry(exe)['path']
+
+    def version(self, exe: str):
+        """
+        Version of an executable (see VERSION_ARGS), probed once per binary.
+        Return: str, or None if not found or unknown
+        """
+        with self._lock:
+            entry = self._entry(exe)
+            if entry['path'] is None:
+                return None
+            if 'version' not in entry:
+                args = VERSION_ARGS.get(os.path.basename(exe))
+                entry['version'] = probe_version(entry['path'], args) if args else None
+                self._save()
+            return entry['version']
+
+def registry() -> ToolRegistry:
+    """
+    Tool registry of the current PATH, shared within the process
+    """
+    global _registry
+    with _lock:
+        path = os.environ.get('PATH', os.defpath)
+        if _registry is None or _registry.path != path:
+            _registry = ToolRegistry(cache_file(), path)
+        return _registry
+
+def tool_path(exe: str) -> str:
+    """
+    Path of an executable
+    Raise: OSError if it is not found
+    """
+    path = registry().resolve(exe)
+    if path is None:
+        raise OSError(f"Executable '{exe}' not found in PATH")
+    return path
+
+def check_version(exe: str, minimum=None):
+    """
+    Check that an executable has at least version `minimum` (default: MIN_VERSIONS)
+    Return: str, version; or None if it could not be determined
+    Raise: OSError if the version is too old
+    """
+    minimum = minimum or MIN_VERSIONS.get(os.path.basename(exe))
+    version = registry().version(exe)
+    if minimum is not None and version is not None:
+        if version_tuple(version) < version_tuple(minimum):
+            raise OSError(f'{exe} version {version} found, but at least {minimum} is required')
+    return version
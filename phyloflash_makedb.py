@@ -104,7 +104,7 @@ def silva_download(silva_url: str, outdir: str, debug=False):
     Download the latest version of the SILVA SSU RefNR database from www.arb-silva.de
     """
     logging.info('Downloading SILVA database from www.arb-silva.de...')
-    silva_file = os.path.join(args.outdir, 'SILVA_138.1_LSURef_NR99_tax_silva_trunc.fasta.gz')
+    silva_file = os.path.join(outdir, 'SILVA_138.1_LSURef_NR99_tax_silva_trunc.fasta.gz')
     if debug is True and os.path.isfile(silva_file):
         return silva_file
     urllib.request.urlretrieve(silva_url, silva_file)
@@ -159,7 +159,7 @@ def subset_fasta(silva_file: str, n=1000) -> str:
                 break
     return out_file
 
-def remove_LSU_contamination(silva_file: str) -> str:
+def remove_LSU_contamination(silva_file: str, threads=1) -> str:
     """
     Remove sequences with potential LSU contamination
     """
@@ -171,7 +171,7 @@ def remove_LSU_contamination(silva_file: str) -> str:
     # run barrnap_HGV on each domain
     barrnap_results = set()
     for domain in ['bac', 'arch', 'euk']:
-        cmd = f'{exe} --kingdom {domain} --threads {args.threads} --evalue 1e-10 --gene lsu --reject 0.01 {silva_file}'
+        cmd = f'{exe} --kingdom {domain} --threads {threads} --evalue 1e-10 --gene lsu --reject 0.01 {silva_file}'
         run_barrnap(cmd, barrnap_results, domain)
     # remove SILVA sequences with potential LSU contamination
     out_file,ext = os.path.splitext(silva_file)
@@ -358,7 +358,7 @@ def main(args: dict) -> None:
     silva_file = silva_uncompress(silva_file, args.outdir, num_lines=args.num_lines)
     
     # Remove sequences with potential LSU contamination
-    silva_file = remove_LSU_contamination(silva_file)
+    silva_file = remove_LSU_contamination(silva_file, threads=args.threads)
     
     # Mask repeats in SILVA SSU sequences
     silva_file = mask_repeats(silva_file, threads=args.threads, memory=args.memory)
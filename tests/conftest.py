@@ -0,0 +1,108 @@
+import threading
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+
+class FileServer(ThreadingHTTPServer):
+    """
+    Local HTTP server of in-memory files, with range requests, ETags and a
+    log of the requests served.
+    files: {path : bytes, or callable(query dict) -> bytes}
+    etags: {path : ETag header}
+    ranges: bool, answer range requests
+    truncate: set of range start offsets answered (once) with half the range
+    sent: {path : bytes of the last GET sent before the client closed (or all)}
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), FileHandler)
+        self.files = {}
+        self.etags = {}
+        self.ranges = True
+        self.truncate = set()
+        self.requests = []
+        self.sent = {}
+        self.lock = threading.Lock()
+
+    def url(self, path: str) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}{path}'
+
+    def gets(self, path: str) -> list:
+        """
+        Range headers (None: whole file) of the GET requests of `path`
+        """
+        return [r for m,p,r in self.requests if m == 'GET' and p == path]
+
+
+class FileHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _body(self):
+        parts = urllib.parse.urlparse(self.path)
+        server = self.server
+        with server.lock:
+            server.requests.append((self.command, parts.path, self.headers.get('Range')))
+        data = server.files.get(parts.path)
+        if callable(data):
+            data = data(dict(urllib.parse.parse_qsl(parts.query)))
+        if data is None:
+            self.send_error(404)
+            return None
+        status,start,end = 200,0,len(data) - 1
+        rng = self.headers.get('Range')
+        if rng is not None and server.ranges:
+            first,_,last = rng.split('=', 1)[1].partition('-')
+            start = int(first)
+            end = min(int(last), end) if last else end
+            status = 206
+        body = data[start:end + 1]
+        with server.lock:
+            if status == 206 and start in server.truncate:
+                server.truncate.discard(start)
+                body = body[:len(body) // 2]
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body) if self.command == 'GET' else len(data)))
+        if server.ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        if status == 206:
+            self.send_header('Content-Range', f'bytes {start}-{end}/{len(data)}')
+        if parts.path in server.etags:
+            self.send_header('ETag', server.etags[parts.path])
+        self.end_headers()
+        return body
+
+    def do_HEAD(self):
+        self._body()
+
+    def do_GET(self):
+        body = self._body()
+        if body is None:
+            return
+        # written in pieces, to see how much a client reads before closing
+        sent = 0
+        try:
+            for i in range(0, len(body), 1 << 16):
+                self.wfile.write(body[i:i + (1 << 16)])
+                sent += len(body[i:i + (1 << 16)])
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+        self.server.sent[urllib.parse.urlparse(self.path).path] = sent
+
+
+@pytest.fixture
+def http_server():
+    server = FileServer()
+    thread = threading.Thread(target=server.serve_forever, kwargs={'poll_interval' : 0.05},
+                              daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,55 @@
+import os
+import sys
+import importlib
+from functools import partial
+
+import pytest
+
+from phyloflash import checkpoint, tools
+
+
+def write_tool(path, version):
+    path.write_text(f'#!/bin/sh\necho "vsearch v{version}_linux_x86_64, 62.6GB RAM"\n')
+    path.chmod(0o755)
+    return str(path)
+
+@pytest.fixture
+def bin_dir(tmp_path, monkeypatch):
+    path = tmp_path / 'bin'
+    path.mkdir()
+    monkeypatch.setenv('PATH', f'{path}{os.pathsep}{os.environ.get("PATH", "")}')
+    monkeypatch.setenv('PHYLOFLASH_TOOL_CACHE', str(tmp_path / 'tools.json'))
+    return path
+
+
+def test_tool_fingerprint(bin_dir):
+    exe = write_tool(bin_dir / 'vsearch', '2.22.1')
+    fp = checkpoint.tool_fingerprint('vsearch')
+    assert (fp['path'], fp['real_path'], fp['version']) == (exe, exe, '2.22.1')
+    assert tools.registry().resolve('vsearch') == exe
+    # a new version of the tool
+    write_tool(bin_dir / 'vsearch', '2.28.0')
+    os.utime(exe, ns=(0, 0))
+    assert checkpoint.tool_fingerprint('vsearch')['version'] == '2.28.0'
+    assert checkpoint.tool_fingerprint('no-such-tool') == {'path' : None}
+
+def test_code_fingerprint(tmp_path, monkeypatch):
+    # the code of a stage without tools
+    module_file = tmp_path / 'pf_test_stage.py'
+    module_file.write_text('def transform(x, seed=1):\n    return x\n')
+    monkeypatch.syspath_prepend(str(tmp_path))
+    module = importlib.import_module('pf_test_stage')
+    try:
+        params = checkpoint.func_params(partial(module.transform, seed=2))
+        assert params['func'] == 'pf_test_stage.transform'
+        assert params['code'] == checkpoint.file_sha256(str(module_file))
+        assert params['kwargs'] == {'seed' : 2}
+        module_file.write_text('def transform(x, seed=1):\n    return x[::-1]\n')
+        os.utime(module_file, ns=(0, 0))
+        changed = checkpoint.func_params(partial(module.transform, seed=2))
+        assert changed['code'] != params['code']
+        fingerprints = [checkpoint.stage_fingerprint(x, {}, {}) for x in (params, changed)]
+        assert fingerprints[0] != fingerprints[1]
+    finally:
+        del sys.modules['pf_test_stage']
+    assert checkpoint.code_fingerprint(len) is None
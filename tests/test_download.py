@@ -0,0 +1,158 @@
+import os
+import json
+import random
+import hashlib
+
+import pytest
+
+from phyloflash import download
+
+
+@pytest.fixture
+def data():
+    rng = random.Random(1)
+    return bytes(rng.getrandbits(8) for _ in range(10000))
+
+
+def test_ranged_parallel_fetch(http_server, data, tmp_path):
+    http_server.files['/db/silva.fasta.gz'] = data
+    out_file = str(tmp_path / 'silva.fasta.gz')
+    download.download(http_server.url('/db/silva.fasta.gz'), out_file, connections=4,
+                      chunk_size=1000)
+    with open(out_file, 'rb') as inF:
+        assert inF.read() == data
+    ranges = http_server.gets('/db/silva.fasta.gz')
+    assert sorted(ranges) == sorted(f'bytes={i}-{i + 999}' for i in range(0, 10000, 1000))
+    assert sorted(os.listdir(tmp_path)) == ['silva.fasta.gz', 'silva.fasta.gz.source.json']
+
+def test_small_file_single_request(http_server, data, tmp_path):
+    http_server.files['/db/univec'] = data[:500]
+    out_file = str(tmp_path / 'univec')
+    download.download(http_server.url('/db/univec'), out_file, chunk_size=1000)
+    with open(out_file, 'rb') as inF:
+        assert inF.read() == data[:500]
+    assert http_server.gets('/db/univec') == [None]
+
+def test_resume_after_truncated_part(http_server, data, tmp_path):
+    http_server.files['/db/silva.fasta.gz'] = data
+    http_server.truncate = {3000}
+    url = http_server.url('/db/silva.fasta.gz')
+    out_file = str(tmp_path / 'silva.fasta.gz')
+    with pytest.raises(ValueError, match='Incomplete range 3000-3999'):
+        download.download(url, out_file, connections=1, chunk_size=1000)
+    assert not os.path.exists(out_file)
+    with open(out_file + '.part.json') as inF:
+        assert json.load(inF)['done'] == [0, 1, 2, 4, 5, 6, 7, 8, 9]
+    # only the missing chunk is fetched again
+    n = len(http_server.gets('/db/silva.fasta.gz'))
+    download.download(url, out_file, connections=1, chunk_size=1000)
+    assert http_server.gets('/db/silva.fasta.gz')[n:] == ['bytes=3000-3999']
+    with open(out_file, 'rb') as inF:
+        assert inF.read() == data
+    assert not os.path.exists(out_file + '.part')
+    assert not os.path.exists(out_file + '.part.json')
+
+def test_resume_key_mismatch_restarts(http_server, data, tmp_path):
+    http_server.files['/db/silva.fasta.gz'] = data
+    http_server.etags['/db/silva.fasta.gz'] = '"v1"'
+    http_server.truncate = {3000}
+    url = http_server.url('/db/silva.fasta.gz')
+    out_file = str(tmp_path / 'silva.fasta.gz')
+    with pytest.raises(ValueError):
+        download.download(url, out_file, connections=1, chunk_size=1000)
+    # a new version on the server: the finished chunks of the old one are not used
+    data = data[::-1]
+    http_server.files['/db/silva.fasta.gz'] = data
+    http_server.etags['/db/silva.fasta.gz'] = '"v2"'
+    n = len(http_server.gets('/db/silva.fasta.gz'))
+    download.download(url, out_file, connections=1, chunk_size=1000)
+    assert len(http_server.gets('/db/silva.fasta.gz')[n:]) == 10
+    with open(out_file, 'rb') as inF:
+        assert inF.read() == data
+
+@pytest.mark.parametrize('algorithm', ['md5', 'sha256'])
+def test_checksum_mismatch(http_server, data, tmp_path, algorithm):
+    http_server.files['/db/silva.fasta.gz'] = data
+    url = http_server.url('/db/silva.fasta.gz')
+    out_file = str(tmp_path / 'silva.fasta.gz')
+    wrong = hashlib.new(algorithm, b'other').hexdigest()
+    with pytest.raises(ValueError, match='failed verification'):
+        download.download(url, out_file, checksum=f'{algorithm}:{wrong}', chunk_size=1000)
+    assert os.listdir(tmp_path) == []
+    right = hashlib.new(algorithm, data).hexdigest()
+    download.download(url, out_file, checksum=f'{algorithm}:{right}', chunk_size=1000)
+    assert download.file_digest(out_file, algorithm) == right
+
+def test_published_checksum(http_server, data, tmp_path):
+    http_server.files['/db/silva.fasta.gz'] = data
+    http_server.files['/db/silva.fasta.gz.md5'] = b'%s  silva.fasta.gz\n' % \
+        hashlib.md5(b'other').hexdigest().encode()
+    url = http_server.url('/db/silva.fasta.gz')
+    out_file = str(tmp_path / 'silva.fasta.gz')
+    with pytest.raises(ValueError, match='failed verification'):
+        download.download(url, out_file, chunk_size=1000)
+    http_server.files['/db/silva.fasta.gz.md5'] = hashlib.md5(data).hexdigest().encode()
+    download.download(url, out_file, chunk_size=1000)
+    assert download.file_digest(out_file) == hashlib.md5(data).hexdigest()
+    # a verified copy is not downloaded again
+    n = len(http_server.gets('/db/silva.fasta.gz'))
+    download.download(url, out_file, chunk_size=1000)
+    assert len(http_server.gets('/db/silva.fasta.gz')) == n
+
+def test_mirror_reuse(http_server, data, tmp_path):
+    http_server.files['/db/silva.fasta.gz'] = data
+    http_server.etags['/db/silva.fasta.gz'] = '"v1"'
+    url = http_server.url('/db/silva.fasta.gz')
+    mirror_dir = str(tmp_path / 'mirror')
+    out1,out2 = str(tmp_path / 'a' / 'silva.fasta.gz'),str(tmp_path / 'b' / 'silva.fasta.gz')
+    download.download(url, out1, mirror_dir=mirror_dir, chunk_size=1000)
+    n = len(http_server.gets('/db/silva.fasta.gz'))
+    mirror_file = download.mirror_path(mirror_dir, url)
+    with open(mirror_file + download.SOURCE_SUFFIX) as inF:
+        assert json.load(inF) == {'url' : url, 'size' : len(data), 'etag' : '"v1"',
+                                  'last_modified' : None}
+    # same ETag: the mirrored copy is linked without fetching it again
+    download.download(url, out2, mirror_dir=mirror_dir, chunk_size=1000)
+    assert len(http_server.gets('/db/silva.fasta.gz')) == n
+    assert os.path.samefile(out2, mirror_file)
+    # new ETag: fetched again
+    data = data[::-1]
+    http_server.files['/db/silva.fasta.gz'] = data
+    http_server.etags['/db/silva.fasta.gz'] = '"v2"'
+    download.download(url, out2, mirror_dir=mirror_dir, chunk_size=1000)
+    assert len(http_server.gets('/db/silva.fasta.gz')) > n
+    with open(out2, 'rb') as inF:
+        assert inF.read() == data
+    # the mirror is only reused for the URL it was downloaded from
+    with open(mirror_file + download.SOURCE_SUFFIX) as inF:
+        source = json.load(inF)
+    source['url'] = http_server.url('/other/silva.fasta.gz')
+    with open(mirror_file + download.SOURCE_SUFFIX, 'w') as outF:
+        json.dump(source, outF)
+    n = len(http_server.gets('/db/silva.fasta.gz'))
+    download.download(url, out2, mirror_dir=mirror_dir, chunk_size=1000)
+    assert len(http_server.gets('/db/silva.fasta.gz')) > n
+
+def test_unverifiable_download_not_reused(http_server, data, tmp_path):
+    # no checksum and no ETag or Last-Modified date: the version of an
+    # existing file cannot be checked, so it is downloaded again
+    http_server.files['/db/silva.fasta.gz'] = data
+    url = http_server.url('/db/silva.fasta.gz')
+    out_file = str(tmp_path / 'silva.fasta.gz')
+    download.download(url, out_file, chunk_size=1000)
+    n = len(http_server.gets('/db/silva.fasta.gz'))
+    download.download(url, out_file, chunk_size=1000)
+    assert len(http_server.gets('/db/silva.fasta.gz')) > n
+    # nor is a stale file of the same size
+    with open(out_file, 'wb') as outF:
+        outF.write(data[::-1])
+    download.download(url, out_file, chunk_size=1000)
+    with open(out_file, 'rb') as inF:
+        assert inF.read() == data
+
+def test_parse_checksum():
+    digest = hashlib.md5(b'x').hexdigest()
+    assert download.parse_checksum(f'{digest}  SILVA.fasta.gz\n') == ('md5', digest)
+    assert download.parse_checksum(f'SHA256:{"A" * 64}') == ('sha256', 'a' * 64)
+    assert download.parse_checksum('not a checksum') is None
+    assert download.parse_checksum('') is None
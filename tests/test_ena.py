@@ -0,0 +1,99 @@
+import gzip
+import time
+import random
+
+import pytest
+
+from phyloflash import ena
+from phyloflash.fastq import fastq_chunks
+
+
+def filereport(runs):
+    """
+    ENA filereport TSV of runs: (run accession, layout, FASTQ paths)
+    """
+    lines = ['\t'.join(ena.RUN_FIELDS)]
+    for run,layout,paths in runs:
+        lines.append('\t'.join([run, layout, '1000', '150000', ';'.join(paths), '', '']))
+    return ('\n'.join(lines) + '\n').encode()
+
+def fastq_gz(name: bytes, n_members: int) -> bytes:
+    """
+    Gzipped FASTQ of `n_members` gzip members of 1000 reads each
+    """
+    rng = random.Random(name)
+    reads = b''.join(b'@%s.%d\n%s\n+\n%s\n' % (name, i, bytes(rng.choices(b'ACGT', k=100)), b'I' * 100)
+                     for i in range(1000))
+    return gzip.compress(reads, compresslevel=1) * n_members
+
+@pytest.fixture
+def portal(http_server):
+    host = http_server.url('')[len('http://'):]
+    vol = f'{host}/vol1/fastq'
+    reports = {
+        'PRJ1' : filereport([
+            ('SRR1', 'PAIRED', [f'{vol}/SRR1.fastq.gz', f'{vol}/SRR1_1.fastq.gz', f'{vol}/SRR1_2.fastq.gz']),
+            ('SRR2', 'SINGLE', [f'{vol}/SRR2.fastq.gz']),
+            # paired, but only one file listed
+            ('SRR3', 'PAIRED', [f'{vol}/SRR3.fastq.gz']),
+            ('SRR4', 'PAIRED', [])]),
+        # SRR1 again, under its sample
+        'SAM1' : filereport([('SRR1', 'PAIRED', [f'{vol}/SRR1_1.fastq.gz', f'{vol}/SRR1_2.fastq.gz'])]),
+        'EMPTY' : filereport([])
+    }
+    http_server.files['/filereport'] = lambda query: reports.get(query['accession'])
+    return http_server
+
+
+def test_fetch_runs(portal):
+    rows = ena.fetch_runs('PRJ1', portal.url('/filereport'))
+    assert [x['run_accession'] for x in rows] == ['SRR1', 'SRR2', 'SRR3', 'SRR4']
+    assert all(x['accession'] == 'PRJ1' for x in rows)
+    assert ena.fetch_runs('EMPTY', portal.url('/filereport')) == []
+    with pytest.raises(ValueError, match='Could not fetch the runs of MISSING'):
+        ena.fetch_runs('MISSING', portal.url('/filereport'))
+
+def test_ena_samples(portal):
+    vol = portal.url('/vol1/fastq')
+    samples,rows = ena.ena_samples(['PRJ1', 'SAM1', 'EMPTY'], portal.url('/filereport'), 'http')
+    # SRR1 is used once; SRR4 has no FASTQ files
+    assert [x['lib'] for x in samples] == ['SRR1', 'SRR2', 'SRR3']
+    assert [x['accession'] for x in rows] == ['PRJ1', 'PRJ1', 'PRJ1']
+    # the pair of a paired run, not its unpaired reads
+    assert (samples[0]['read1'], samples[0]['read2']) == (f'{vol}/SRR1_1.fastq.gz', f'{vol}/SRR1_2.fastq.gz')
+    assert (samples[1]['read1'], samples[1]['read2']) == (f'{vol}/SRR2.fastq.gz', None)
+    assert (samples[2]['read1'], samples[2]['read2']) == (f'{vol}/SRR3.fastq.gz', None)
+    assert rows[0]['read1'] == samples[0]['read1']
+    queries = [p for m,p,_ in portal.requests if p == '/filereport']
+    assert len(queries) == 3
+
+def test_run_sample_full_urls():
+    row = {'run_accession' : 'SRR5', 'library_layout' : 'paired',
+           'fastq_ftp' : 'ftp://host/SRR5_1.fastq.gz;ftp://host/SRR5_2.fastq.gz'}
+    sample = ena.run_sample(row)
+    assert (sample['read1'], sample['read2']) == ('ftp://host/SRR5_1.fastq.gz', 'ftp://host/SRR5_2.fastq.gz')
+    assert ena.run_sample({'run_accession' : 'SRR6', 'fastq_ftp' : ''}) is None
+
+def test_streaming_stops_at_read_limit(portal):
+    # 1000000 read pairs (42 MB per file); far more than are read ahead of the limit
+    for x in ('1', '2'):
+        portal.files[f'/vol1/fastq/SRR1_{x}.fastq.gz'] = fastq_gz(b'SRR1_' + x.encode(), 1000)
+    samples,_ = ena.ena_samples(['PRJ1'], portal.url('/filereport'), 'http')
+    read1,read2 = samples[0]['read1'],samples[0]['read2']
+    text = b''.join(fastq_chunks(read1, read2, read_limit=2500))
+    headers = text.split(b'\n')[0::4][:-1]
+    assert len(headers) == 5000
+    assert headers[:2] == [b'@SRR1_1.0', b'@SRR1_2.0'] and headers[-1] == b'@SRR1_2.499'
+    # the downloads were closed early
+    for x in ('1', '2'):
+        path = f'/vol1/fastq/SRR1_{x}.fastq.gz'
+        for _ in range(100):
+            if path in portal.sent:
+                break
+            time.sleep(0.05)
+        assert portal.sent[path] < len(portal.files[path]) / 2
+
+def test_read_accessions(tmp_path):
+    accession_file = tmp_path / 'accessions.txt'
+    accession_file.write_text('# study\nPRJ1\tsoil\n\nSRR2  # run\n')
+    assert ena.read_accessions(str(accession_file)) == ['PRJ1', 'SRR2']
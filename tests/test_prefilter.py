@@ -0,0 +1,123 @@
+import random
+
+import pytest
+
+from phyloflash import prefilter
+from phyloflash.fasta import revcomp
+
+
+def random_dna(rng, n):
+    return bytes(rng.choices(b'ACGT', k=n))
+
+def write_fastq(path, reads):
+    with open(path, 'wb') as outF:
+        for name,seq in reads:
+            outF.write(b'@%s\n%s\n+\n%s\n' % (name, seq, b'I' * len(seq)))
+    return str(path)
+
+def read_names(chunks):
+    text = b''.join(chunks)
+    return [x[1:] for x in text.split(b'\n')[0::4] if x]
+
+@pytest.fixture(scope='module')
+def refs():
+    rng = random.Random(1)
+    return [random_dna(rng, 600) for _ in range(3)]
+
+@pytest.fixture(scope='module')
+def index_file(refs, tmp_path_factory):
+    fasta_file = tmp_path_factory.mktemp('db') / 'SILVA_SSU.fasta'
+    with open(fasta_file, 'wb') as outF:
+        for i,seq in enumerate(refs):
+            outF.write(b'>ref%d\n%s\n' % (i, seq))
+    # a sparse filter, so that random reads rarely hit by chance
+    return prefilter.build_index(str(fasta_file), threads=2, bits_per_kmer=64)
+
+
+def test_hits(refs, index_file):
+    rng = random.Random(2)
+    with prefilter.KmerIndex(index_file) as index:
+        assert index.hits(refs[0][100:250]) == 1
+        assert index.hits(refs[1][:150], min_hits=3) == 3
+        assert index.hits(random_dna(rng, 150)) == 0
+        # only the sense strand is indexed
+        assert index.hits(revcomp(refs[0][100:250])) == 0
+        assert refs[2][:20] in index
+
+def test_single_reads_either_strand(refs, index_file, tmp_path):
+    rng = random.Random(3)
+    reads = [(b'fwd', refs[0][:150]), (b'rc', revcomp(refs[1][200:350])),
+             (b'other', random_dna(rng, 150)), (b'short', refs[2][:19])]
+    read1 = write_fastq(tmp_path / 'r.fq', reads)
+    filt = prefilter.ReadPrefilter(index_file, check_reads=0)
+    assert read_names(filt.chunks(read1)) == [b'fwd', b'rc']
+    assert (filt.pairs, filt.kept, filt.reads, filt.bases) == (4, 2, 4, 469)
+
+def test_pairs_either_mate(refs, index_file, tmp_path):
+    rng = random.Random(4)
+    other = [random_dna(rng, 150) for _ in range(4)]
+    fwd = [(b'mate1/1', refs[0][:150]), (b'mate2/1', other[0]), (b'none/1', other[1])]
+    rev = [(b'mate1/2', other[2]), (b'mate2/2', refs[1][300:450]), (b'none/2', other[3])]
+    read1 = write_fastq(tmp_path / 'r_1.fq', fwd)
+    read2 = write_fastq(tmp_path / 'r_2.fq', rev)
+    filt = prefilter.ReadPrefilter(index_file, check_reads=0)
+    assert read_names(filt.chunks(read1, read2)) == [b'mate1/1', b'mate1/2', b'mate2/1', b'mate2/2']
+    assert (filt.pairs, filt.kept, filt.reads) == (3, 2, 6)
+    # the same pairs interleaved
+    interleaved = write_fastq(tmp_path / 'r.fq', [x for pair in zip(fwd, rev) for x in pair])
+    filt = prefilter.ReadPrefilter(index_file, check_reads=0)
+    assert read_names(filt.chunks(interleaved, interleaved=True)) == \
+        [b'mate1/1', b'mate1/2', b'mate2/1', b'mate2/2']
+
+def test_check_reads(refs, index_file, tmp_path):
+    rng = random.Random(5)
+    reads = [(b'other0', random_dna(rng, 150)), (b'ssu1', refs[0][:150]),
+             (b'other2', random_dna(rng, 150)), (b'other3', random_dna(rng, 150)),
+             (b'ssu4', refs[1][:150])]
+    read1 = write_fastq(tmp_path / 'r.fq', reads)
+    filt = prefilter.ReadPrefilter(index_file, check_reads=3)
+    # the first 3 reads pass unfiltered
+    assert read_names(filt.chunks(read1)) == [b'other0', b'ssu1', b'other2', b'ssu4']
+    assert filt.checked == {b'other0', b'ssu1', b'other2'}
+    assert filt.rejected == {b'other0', b'other2'}
+    # sensitivity on the checked reads that the mapper mapped
+    mapped = write_fastq(tmp_path / 'mapped.fq', [reads[0], reads[1], reads[4]])
+    assert filt.sensitivity(mapped) == {'mapped' : 2, 'missed' : 1, 'sensitivity' : 0.5}
+    assert filt.sensitivity(str(tmp_path / 'missing.fq'))['sensitivity'] is None
+
+def test_read_limit(refs, index_file, tmp_path):
+    reads = [(b'ssu%d' % i, refs[i % 3][i:i + 150]) for i in range(10)]
+    read1 = write_fastq(tmp_path / 'r.fq', reads)
+    filt = prefilter.ReadPrefilter(index_file, check_reads=0)
+    assert read_names(filt.chunks(read1, read_limit=4)) == [b'ssu0', b'ssu1', b'ssu2', b'ssu3']
+    assert filt.pairs == 4
+
+def test_order_with_processes(refs, index_file, tmp_path):
+    # several blocks of reads (see fastq.BLOCKSIZE), filtered by 2 processes
+    rng = random.Random(6)
+    fwd,rev,expect = [],[],[]
+    for i in range(30000):
+        ssu = i % 3 == 0
+        ref = refs[i % len(refs)]
+        start = rng.randrange(len(ref) - 150)
+        seq = ref[start:start + 150] if ssu else random_dna(rng, 150)
+        fwd.append((b'r%d/1' % i, seq))
+        rev.append((b'r%d/2' % i, random_dna(rng, 150)))
+        if ssu:
+            expect += [b'r%d/1' % i, b'r%d/2' % i]
+    read1 = write_fastq(tmp_path / 'r_1.fq', fwd)
+    read2 = write_fastq(tmp_path / 'r_2.fq', rev)
+    single = read_names(prefilter.ReadPrefilter(index_file, check_reads=0).chunks(read1, read2))
+    filt = prefilter.ReadPrefilter(index_file, threads=2, check_reads=0)
+    kept = read_names(filt.chunks(read1, read2))
+    assert kept == single
+    # all SSU pairs, besides the odd false positive
+    ssu = set(expect)
+    assert [x for x in kept if x in ssu] == expect
+    assert filt.pairs == 30000 and filt.kept == len(kept) // 2 < 10010
+    assert prefilter._worker is None
+
+def test_read_name():
+    assert prefilter.read_name(b'read1/1') == b'read1'
+    assert prefilter.read_name(b'read1 1:N:0:ACGT') == b'read1'
+    assert prefilter.read_name(b'') == b''
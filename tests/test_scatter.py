@@ -0,0 +1,151 @@
+import math
+
+import pytest
+
+from phyloflash import scatter
+from phyloflash.sam import read_bbmap_log
+
+
+def median(values):
+    return sorted(values)[(len(values) + 1) // 2 - 1]
+
+def stdev(values):
+    mean = sum(values) / len(values)
+    return math.sqrt(sum((x - mean) ** 2 for x in values) / len(values))
+
+def write_ihist(path, inserts, pairs):
+    """
+    bbmap insert size histogram (ihist) of the inserts of `pairs` read pairs
+    """
+    with open(path, 'w') as outF:
+        outF.write(f'#Mean\t{sum(inserts) / len(inserts):.3f}\n#Median\t{median(inserts)}\n'
+                   f'#Mode\t{max(sorted(set(inserts)), key=inserts.count)}\n'
+                   f'#STDev\t{stdev(inserts):.3f}\n#PercentOfPairs\t{100 * len(inserts) / pairs:.3f}\n'
+                   '#InsertSize\tCount\n')
+        for x in sorted(set(inserts)):
+            outF.write(f'{x}\t{inserts.count(x)}\n')
+    return str(path)
+
+def write_idhist(path, ids):
+    """
+    bbmap identity histogram (idhist) of (identity, read length) tuples
+    """
+    reads = [x for x,_ in ids]
+    bases = [x for x,n in ids for _ in range(n)]
+    with open(path, 'w') as outF:
+        for name,values in (('reads', reads), ('bases', bases)):
+            outF.write(f'#Mean_{name}\t{sum(values) / len(values):.3f}\n'
+                       f'#Median_{name}\t{median(values)}\n#STDev_{name}\t{stdev(values):.3f}\n')
+        outF.write('#Identity\tReads\tBases\n')
+        for x in sorted(set(reads), reverse=True):
+            outF.write(f'{x:.1f}\t{reads.count(x)}\t{sum(n for i,n in ids if i == x)}\n')
+    return str(path)
+
+def write_bhist(path, seqs):
+    """
+    bbmap base composition by position (bhist) of reads of equal length
+    """
+    with open(path, 'w') as outF:
+        outF.write('#Pos\tA\tC\tG\tT\tN\n')
+        for i in range(len(seqs[0])):
+            column = [x[i] for x in seqs]
+            outF.write(f'{i}\t' + '\t'.join(f'{column.count(b) / len(column):.5f}' for b in 'ACGTN') + '\n')
+    return str(path)
+
+def write_scafstats(path, hits, total):
+    """
+    bbmap hit statistics (scafstats): hits are (reference, unambiguous,
+    read length) tuples of the mapped reads; `total` is the number of reads
+    """
+    with open(path, 'w') as outF:
+        outF.write('#name\t%unambiguousReads\tunambiguousMB\t%ambiguousReads\tambiguousMB\t'
+                   'unambiguousReads\tambiguousReads\tassignedReads\tassignedBases\n')
+        refs = sorted(set(x for x,_,_ in hits), key=lambda x: -sum(1 for h in hits if h[0] == x))
+        for ref in refs:
+            unamb = [n for x,u,n in hits if x == ref and u]
+            amb = [n for x,u,n in hits if x == ref and not u]
+            outF.write(f'{ref}\t{100 * len(unamb) / total:.5f}\t{sum(unamb) / 1e6:.6f}\t'
+                       f'{100 * len(amb) / total:.5f}\t{sum(amb) / 1e6:.6f}\t{len(unamb)}\t{len(amb)}\t'
+                       f'{len(unamb) + len(amb)}\t{sum(unamb) + sum(amb)}\n')
+    return str(path)
+
+def write_log(path, reads, bases, inserts=None):
+    with open(path, 'w') as outF:
+        outF.write(f'Java version\nReads Used:           \t{reads}\t({bases} bases)\n')
+        if inserts is not None:
+            outF.write(f'insert median:        \t{median(inserts)}\n'
+                       f'insert std dev:       \t{int(round(stdev(inserts)))}\n')
+    return str(path)
+
+def assert_same_table(merged, single):
+    merged,single = scatter.read_histogram(merged),scatter.read_histogram(single)
+    assert merged['columns'] == single['columns']
+    assert list(merged['rows']) == list(single['rows'])
+    for k,row in single['rows'].items():
+        assert merged['rows'][k] == pytest.approx(row, abs=1e-5)
+    assert [k for k,_ in merged['stats']] == [k for k,_ in single['stats']]
+    for (_,a),(_,b) in zip(merged['stats'], single['stats']):
+        assert float(a) == pytest.approx(float(b), abs=1e-3)
+
+
+# two chunks of a library: read pairs (a chunk's pairs with an insert size)
+CHUNKS = [
+    {'pairs' : 10, 'inserts' : [200, 200, 250, 250, 250, 300, 310, 500]},
+    {'pairs' : 6, 'inserts' : [180, 250, 300, 300, 300]}
+]
+
+
+def test_merge_insert_histograms(tmp_path):
+    files = [write_ihist(tmp_path / f'chunk{i}.ihist', x['inserts'], x['pairs'])
+             for i,x in enumerate(CHUNKS)]
+    single = write_ihist(tmp_path / 'single.ihist', sum((x['inserts'] for x in CHUNKS), []),
+                         sum(x['pairs'] for x in CHUNKS))
+    merged = scatter.merge_histograms(files, str(tmp_path / 'merged.ihist'),
+                                      [2 * x['pairs'] for x in CHUNKS])
+    assert_same_table(merged, single)
+
+def test_merge_identity_histograms(tmp_path):
+    chunks = [[(100.0, 150), (100.0, 150), (99.3, 150), (98.0, 120)],
+              [(100.0, 150), (97.5, 80), (99.3, 150)]]
+    files = [write_idhist(tmp_path / f'chunk{i}.idhist', x) for i,x in enumerate(chunks)]
+    single = write_idhist(tmp_path / 'single.idhist', chunks[0] + chunks[1])
+    merged = scatter.merge_histograms(files, str(tmp_path / 'merged.idhist'), [4, 3])
+    assert_same_table(merged, single)
+
+def test_merge_base_composition(tmp_path):
+    chunks = [['ACGTA', 'ACGTT', 'TCGAN', 'GGGGA'], ['ACCTA', 'TTGTA']]
+    files = [write_bhist(tmp_path / f'chunk{i}.bhist', x) for i,x in enumerate(chunks)]
+    single = write_bhist(tmp_path / 'single.bhist', chunks[0] + chunks[1])
+    merged = scatter.merge_histograms(files, str(tmp_path / 'merged.bhist'), [4, 2], average=True)
+    assert_same_table(merged, single)
+
+def test_merge_missing_histograms(tmp_path):
+    files = [write_ihist(tmp_path / 'chunk0.ihist', CHUNKS[0]['inserts'], CHUNKS[0]['pairs']),
+             str(tmp_path / 'chunk1.ihist')]
+    merged = scatter.merge_histograms(files, str(tmp_path / 'merged.ihist'), [20, 12])
+    assert_same_table(merged, files[0])
+    assert scatter.merge_histograms([files[1]], str(tmp_path / 'none.ihist'), [12]) is None
+
+def test_merge_scafstats(tmp_path):
+    chunks = [([('ref1', True, 150), ('ref1', True, 150), ('ref2', False, 150), ('ref3', True, 100)], 10),
+              ([('ref2', True, 150), ('ref2', True, 150), ('ref2', False, 120), ('ref1', False, 150)], 6)]
+    files = [write_scafstats(tmp_path / f'chunk{i}.scafstats', *x) for i,x in enumerate(chunks)]
+    single = write_scafstats(tmp_path / 'single.scafstats', chunks[0][0] + chunks[1][0], 16)
+    merged = scatter.merge_scafstats(files, str(tmp_path / 'merged.scafstats'))
+    assert_same_table(merged, single)
+    # sorted by assigned reads
+    assert list(scatter.read_histogram(merged)['rows']) == ['ref2', 'ref1', 'ref3']
+
+def test_merge_bbmap_logs(tmp_path):
+    logs = [write_log(tmp_path / f'chunk{i}.bbmap.out', 2 * x['pairs'], 300 * x['pairs'], x['inserts'])
+            for i,x in enumerate(CHUNKS)]
+    inserts = sum((x['inserts'] for x in CHUNKS), [])
+    single = write_log(tmp_path / 'single.bbmap.out', 32, 4800, inserts)
+    ihist = write_ihist(tmp_path / 'single.ihist', inserts, 16)
+    merged = scatter.merge_bbmap_logs(logs, str(tmp_path / 'merged.bbmap.out'), ihist)
+    assert read_bbmap_log(merged) == read_bbmap_log(single)
+    assert read_bbmap_log(merged)['reads'] == 32
+    assert scatter.bbmap_log_reads(merged) == (32, 4800)
+    # the chunk logs are kept
+    with open(merged) as inF:
+        assert inF.read().count('Java version') == 2
@@ -0,0 +1,195 @@
+import os
+import re
+import shutil
+import logging
+import subprocess
+
+import pytest
+
+from phyloflash import sortmerna
+from phyloflash.fasta import revcomp
+
+
+def write_fastq(path, reads):
+    with open(path, 'wb') as outF:
+        for header,seq in reads:
+            outF.write(b'@%s\n%s\n+\n%s\n' % (header, seq, b'I' * len(seq)))
+    return str(path)
+
+def write_sam(path, alignments):
+    """
+    sortmerna SAM file of (read name, flag, reference, aligned sequence) tuples
+    """
+    with open(path, 'wb') as outF:
+        outF.write(b'@HD\tVN:1.0\tSO:unsorted\n@SQ\tSN:AB1.1.1500\tLN:1500\n')
+        for qname,flag,rname,seq in alignments:
+            outF.write(b'%s\t%d\t%s\t10\t255\t%dM\t*\t0\t0\t%s\t%s\tAS:i:40\n'
+                       % (qname, flag, rname, len(seq), seq, b'I' * len(seq)))
+    return str(path)
+
+def fixed_lines(fastq_file, sam_file, **kwargs):
+    lines = []
+    for _,group in sortmerna.fix_sortmerna_sam(fastq_file, sam_file, **kwargs):
+        lines += [rec.to_line().rstrip(b'\n').split(b'\t') for rec in group]
+    return lines
+
+def columns(lines):
+    """
+    QNAME, FLAG, RNAME and SEQ of SAM lines
+    """
+    return [(x[0], int(x[1]), x[2], x[9]) for x in lines]
+
+
+# the two segments of each read pair (interleaved)
+SEQS = {
+    b'p1' : (b'ACGTTGCAAGGCTTAACCGA', b'TTGACCGATAGGCATCCAGT'),
+    b'p2' : (b'GGCATTACCGTAGCTAGCAA', b'CCATGGTACGATTGCAGGTA'),
+    b'p3' : (b'TAGGCTAACCGTTAGCATGC', b'ATCCGGTAGCTTAGGCAATC'),
+    b'p4' : (b'CGATCGGATTACGCATTAGC', b'GCTTACCAGTAGGATCCAGA'),
+}
+REF1 = b'AB1.1.1500'
+REF2 = b'CD2.10.1400'
+TAX = {REF1 : 'Bacteria;Proteobacteria', REF2 : 'Archaea;Euryarchaeota'}
+# sortmerna alignments of the pairs
+ALIGNMENTS = [
+    # both segments: proper pair, the first also hits a second reference
+    (b'p1/1', 0, REF1, SEQS[b'p1'][0]),
+    (b'p1/1', 0, REF2, SEQS[b'p1'][0]),
+    (b'p1/2', 16, REF1, revcomp(SEQS[b'p1'][1])),
+    # p2 not aligned; only the reverse segment of p3
+    (b'p3/2', 16, REF2, revcomp(SEQS[b'p3'][1])),
+    (b'p3/2', 16, REF1, revcomp(SEQS[b'p3'][1])),
+    # only the forward segment of p4, on the reverse strand
+    (b'p4/1', 16, REF1, revcomp(SEQS[b'p4'][0])),
+]
+# directory of PhyloFlash.pm
+PERL_LIB = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def fastq_file(tmp_path):
+    reads = [(b'%s/%d' % (name, i + 1), seq) for name,pair in SEQS.items() for i,seq in enumerate(pair)]
+    return write_fastq(tmp_path / 'aligned.fq', reads)
+
+
+def test_fix_flags(fastq_file, tmp_path):
+    sam_file = write_sam(tmp_path / 'aligned.sam', ALIGNMENTS)
+    lines = fixed_lines(fastq_file, sam_file, acc2tax=TAX)
+    tax1,tax2 = b'AB1.1.1500 Bacteria;Proteobacteria',b'CD2.10.1400 Archaea;Euryarchaeota'
+    assert columns(lines) == [
+        # 0x1 0x2 0x20 0x40; 0x100 for the second alignment of a segment
+        (b'p1/1', 0x63, tax1, SEQS[b'p1'][0]),
+        (b'p1/1', 0x163, tax2, SEQS[b'p1'][0]),
+        # 0x1 0x2 0x10 0x80
+        (b'p1/1', 0x93, tax1, revcomp(SEQS[b'p1'][1])),
+        # unmapped forward segment inserted before the primary alignment
+        # of a reverse segment whose mate did not align: 0x1 0x4 0x40
+        (b'p3/1', 0x45, b'*', SEQS[b'p3'][0]),
+        # 0x1 0x8 0x10 0x80
+        (b'p3/1', 0x99, tax2, revcomp(SEQS[b'p3'][1])),
+        (b'p3/1', 0x199, tax1, revcomp(SEQS[b'p3'][1])),
+        # 0x1 0x8 0x10 0x40
+        (b'p4/1', 0x59, tax1, revcomp(SEQS[b'p4'][0])),
+    ]
+    # the remaining columns are kept; the inserted segment has no alignment
+    assert lines[0][3:9] == [b'10', b'255', b'20M', b'*', b'0', b'0']
+    assert lines[0][10:] == [b'I' * 20, b'AS:i:40']
+    assert lines[3][3:9] + lines[3][10:] == [b'0', b'255', b'*', b'*', b'0', b'0', b'I' * 20]
+
+@pytest.mark.skipif(shutil.which('perl') is None, reason='perl not installed')
+def test_same_as_perl(fastq_file, tmp_path):
+    sam_file = write_sam(tmp_path / 'aligned.sam', ALIGNMENTS)
+    script = ('my (undef, undef, $lines) = fix_hash_sortmerna_sam($ARGV[0], $ARGV[1], undef, 0);'
+              'print "$_\\n" foreach @$lines;')
+    out = subprocess.run(['perl', '-I', PERL_LIB, '-MPhyloFlash', '-e', script, fastq_file, sam_file],
+                         stdout=subprocess.PIPE, check=True).stdout
+    perl = [x.split(b'\t') for x in out.splitlines()]
+    lines = fixed_lines(fastq_file, sam_file)
+    assert len(lines) == len(perl) == 7
+    for x,y in zip(lines, perl):
+        # where the Perl version is wrong: reverse segments are not renamed
+        # after the forward read, 0x20 is never set and the inserted segment
+        # has no sequence (looked up under the name of the reverse segment)
+        assert x[0] == re.sub(rb'([:/_])2$', rb'\g<1>1', y[0])
+        assert int(x[1]) & ~sortmerna.FLAG_MATE_REVERSE == int(y[1])
+        assert x[2:9] + x[11:] == y[2:9] + y[11:]
+        assert x[9:11] == y[9:11] or y[9:11] == [b'', b'']
+
+def test_fix_single_end(fastq_file, tmp_path):
+    reads = [(b'%s/1' % name, pair[0]) for name,pair in SEQS.items()]
+    read1 = write_fastq(tmp_path / 'single.fq', reads)
+    sam_file = write_sam(tmp_path / 'aligned.sam', [
+        (b'p1/1', 1, REF1, SEQS[b'p1'][0]),
+        (b'p1/1', 0, REF2, SEQS[b'p1'][0]),
+        (b'p4/1', 16, REF1, revcomp(SEQS[b'p4'][0])),
+    ])
+    # 0x1 removed; no reference taxonomy without acc2tax
+    assert columns(fixed_lines(read1, sam_file, paired=False)) == [
+        (b'p1/1', 0, REF1, SEQS[b'p1'][0]),
+        (b'p1/1', 0x100, REF2, SEQS[b'p1'][0]),
+        (b'p4/1', 0x10, REF1, revcomp(SEQS[b'p4'][0])),
+    ]
+
+def test_segment_by_sequence(tmp_path, caplog):
+    # Casava 1.8 names: sortmerna cuts both segments to the same name
+    reads = [(b'%s %d:N:0:ACGT' % (name, i + 1), seq)
+             for name,pair in SEQS.items() for i,seq in enumerate(pair)]
+    fastq_file = write_fastq(tmp_path / 'aligned.fq', reads)
+    sam_file = write_sam(tmp_path / 'aligned.sam', [
+        (b'p1', 16, REF1, revcomp(SEQS[b'p1'][1])),
+        (b'p1', 0, REF1, SEQS[b'p1'][0]),
+        # lower case sequence of the reverse segment
+        (b'p2', 0, REF2, SEQS[b'p2'][1].lower()),
+        # matches neither segment: the segment of the previous alignment is kept
+        (b'p2', 0, REF1, b'N' * 20),
+        # ... or the forward segment for the first alignment of a read
+        (b'p3', 0, REF1, b'N' * 20),
+    ])
+    with caplog.at_level(logging.WARNING):
+        lines = fixed_lines(fastq_file, sam_file)
+    assert columns(lines) == [
+        (b'p1', 0x93, REF1, revcomp(SEQS[b'p1'][1])),
+        (b'p1', 0x63, REF1, SEQS[b'p1'][0]),
+        (b'p2', 0x45, b'*', SEQS[b'p2'][0]),
+        (b'p2', 0x89, REF2, SEQS[b'p2'][1].lower()),
+        (b'p2', 0x189, REF1, b'N' * 20),
+        (b'p3', 0x49, REF1, b'N' * 20),
+    ]
+    assert 'Segment not found by sequence for 2 alignments' in caplog.text
+
+def test_segment():
+    read = sortmerna.ReadSegments([(b'r1/1', b'ACGTAA', b'IIIIII'), (b'r1/2', b'ACGTAA', b'IIIIII')])
+    rec = sortmerna.SamRecord(b'r1/2', 0, REF1, b'1\t255\t6M\t*\t0\t0\tACGTAA\tIIIIII')
+    # by name if the segments are named differently, even if the sequences are the same
+    assert read.segment(rec) == 1
+    single = sortmerna.ReadSegments([(b'r1', b'ACGTAA', b'IIIIII')])
+    assert single.segment(rec) == 0
+
+def test_join_window(fastq_file, tmp_path):
+    sam_file = write_sam(tmp_path / 'aligned.sam', [
+        (b'p1/1', 0, REF1, SEQS[b'p1'][0]),
+        (b'p4/2', 0, REF1, SEQS[b'p4'][1]),
+    ])
+    groups = list(sortmerna.join_sortmerna(fastq_file, sam_file, window=2))
+    assert [(read.names, len(group)) for read,group in groups] == \
+        [((b'p1/1', b'p1/2'), 1), ((b'p4/1', b'p4/2'), 1)]
+    # two reads without alignments lie between p1 and p4
+    with pytest.raises(ValueError, match=r'Read p4/2 of .* not found within 1 reads of .*; '
+                                         'the files are not in the same order'):
+        list(sortmerna.join_sortmerna(fastq_file, sam_file, window=1))
+
+def test_join_out_of_order(fastq_file, tmp_path):
+    sam_file = write_sam(tmp_path / 'aligned.sam', [
+        (b'p3/1', 0, REF1, SEQS[b'p3'][0]),
+        (b'p1/1', 0, REF1, SEQS[b'p1'][0]),
+    ])
+    with pytest.raises(ValueError, match=r'Read p1/1 of .* not found in .*aligned\.fq$'):
+        list(sortmerna.join_sortmerna(fastq_file, sam_file))
+
+def test_read_sortmerna_log(tmp_path):
+    log_file = tmp_path / 'sortmerna.log'
+    log_file.write_bytes(b' Results:\n    Total reads = 2000\n    Total reads passing E-value '
+                         b'threshold = 120 (6.00%)\n')
+    assert sortmerna.read_sortmerna_log(str(log_file)) == 2000
+    log_file.write_bytes(b'Results:\n')
+    assert sortmerna.read_sortmerna_log(str(log_file)) is None
@@ -0,0 +1,30 @@
+import os
+
+from phyloflash import core
+from phyloflash.acc2tax import write_acc2tax
+from phyloflash.taxonomy import TaxonomyTrie
+
+
+TAXA = [
+    (b'AB1.1.1500', b'Bacteria;Proteobacteria;Gammaproteobacteria;Enterobacterales'),
+    (b'AB2.1.1500', b'Bacteria;Proteobacteria;Alphaproteobacteria;Rhizobiales'),
+    (b'CD3.1.1400', b'Archaea;Euryarchaeota;Methanobacteria'),
+]
+
+
+def test_database_trie(tmp_path):
+    index_file = write_acc2tax(TAXA, str(tmp_path / core.ACC2TAX_INDEX))
+    trie = core.database_trie(str(tmp_path))
+    assert len(trie) == len(TaxonomyTrie.from_acc2tax(index_file)) == 10
+    gamma = trie.node(TAXA[0][1])
+    alpha = trie.node(TAXA[1][1])
+    assert trie.taxstring(trie.lca(gamma, alpha), pad=False) == 'Bacteria;Proteobacteria'
+    # hits of one library do not change the trie of another
+    trie.node(b'Bacteria;Firmicutes;Bacilli')
+    other = core.database_trie(str(tmp_path))
+    assert (len(trie), len(other)) == (12, 10)
+    assert other.node(TAXA[0][1]) == gamma
+    # built once per index file
+    assert [x for x in core._tries if x[0] == index_file] == \
+        [(index_file, os.path.getsize(index_file), os.stat(index_file).st_mtime_ns)]
+    assert core.database_trie(str(tmp_path / 'missing')) is None